@@ -8,9 +8,10 @@
 
 # ## Import libraries
 
-# In[1]:
+# In[ ]:
 
 
+import argparse
 import pathlib
 import pandas as pd
 import re
@@ -23,11 +24,24 @@ import loaddata_utils as ld_utils
 
 # ## Set paths
 
-# In[2]:
+# In[ ]:
 
 
+parser = argparse.ArgumentParser(
+    description="Create LoadData CSV files to run illumination correction"
+)
+parser.add_argument(
+    "--round_id",
+    type=str,
+    default="Round_4_data",
+    help="Round of data to create the LoadData CSVs for (e.g., Round_4_data)",
+)
+
+# Parse arguments (the defaults are used when running as a notebook)
+args = parser.parse_args(args=sys.argv[1:] if "ipykernel" not in sys.argv[0] else [])
+
 # Paths for parameters to make loaddata csv
-batch_name = "Round_4_data"
+batch_name = args.round_id
 index_directory = pathlib.Path(f"/media/18tbdrive/ALSF_pilot_data/{batch_name}/")
 config_dir_path = pathlib.Path("./config_files").absolute()
 output_csv_dir = pathlib.Path(f"./loaddata_csvs/{batch_name}")
@@ -5,9 +5,10 @@
 
 # ## Import libraries
 
-# In[1]:
+# In[ ]:
 
 
+import argparse
 import pathlib
 import pprint
 
@@ -19,14 +20,27 @@ import cp_parallel
 
 # ## Set paths and variables
 
-# In[2]:
+# In[ ]:
 
 
 # set the run type for the parallelization
 run_name = "illum_correction"
 
+parser = argparse.ArgumentParser(
+    description="Calculate illumination correction functions with CellProfiler"
+)
+parser.add_argument(
+    "--round_id",
+    type=str,
+    default="Round_4_data",
+    help="Round of data to process (e.g., Round_4_data)",
+)
+
+# Parse arguments (the defaults are used when running as a notebook)
+args = parser.parse_args(args=sys.argv[1:] if "ipykernel" not in sys.argv[0] else [])
+
 # Batch name to process
-batch_name = "Round_4_data"
+batch_name = args.round_id
 
 # set path for CellProfiler pipeline
 path_to_pipeline = pathlib.Path("./pipelines/illum.cppipe").resolve(strict=True)
@@ -15,12 +15,12 @@ conda activate alsf_cp_env
 # convert all notebooks to python scripts (if any exist)
 jupyter nbconvert --to=script --FilesWriter.build_directory=nbconverted/ *.ipynb
 
-# run the LoadData CSV creation script once before submitting jobs
-python nbconverted/0.create_loaddata_csvs.py --HPC
-
 # define the round variable
 round="Round_3_data"
 
+# run the LoadData CSV creation script once before submitting jobs
+python nbconverted/0.create_loaddata_csvs.py --HPC --round_id "$round"
+
 # build the data directory path using the variable
 data_dir="./loaddata_csvs/${round}"
 
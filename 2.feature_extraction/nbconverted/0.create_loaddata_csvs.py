@@ -23,26 +23,31 @@ import loaddata_utils as ld_utils
 
 # ## Set paths
 
-# In[2]:
+# In[ ]:
 
 
 argparse = argparse.ArgumentParser(
     description="Create LoadData CSV files to run CellProfiler on the cluster"
 )
 argparse.add_argument("--HPC", action="store_true", help="Type of compute to run on")
+argparse.add_argument(
+    "--round_id",
+    type=str,
+    default="Round_3_data",
+    help="Round of data to create the LoadData CSVs for (e.g., Round_4_data)",
+)
 
 # Parse arguments
 args = argparse.parse_args(args=sys.argv[1:] if "ipykernel" not in sys.argv[0] else [])
 HPC = args.HPC
+batch_name = args.round_id
 
 print(f"HPC: {HPC}")
 
 
-# In[3]:
+# In[ ]:
 
 
-# Batch name to find images
-batch_name = "Round_2_data"
 # Set the index directory based on whether HPC is used or not
 if HPC:
     # Path for index directory to make loaddata csvs though compute cluster (HPC)
@@ -30,12 +30,9 @@ except NameError:
 # In[ ]:
 
 
-# Batch name to process
+# Batch name to process (when running as a script, the round is the folder of the LoadData CSV if not given)
 batch_name = "Round_1_data"
 
-#  directory where loaddata CSVs are located within the folder
-loaddata_dir = pathlib.Path(f"./loaddata_csvs/{batch_name}").resolve(strict=True)
-
 if not in_notebook:
     print("Running as script")
     # set up arg parser
@@ -48,11 +45,20 @@ if not in_notebook:
         type=str,
         help="Path to the LoadData CSV file to process images",
     )
+    parser.add_argument(
+        "--round_id",
+        type=str,
+        default=None,
+        help="Round of data of the LoadData CSV (e.g., Round_4_data)",
+    )
 
     args = parser.parse_args()
     loaddata_csv = pathlib.Path(args.input_csv).resolve(strict=True)
+    batch_name = args.round_id or loaddata_csv.parent.name
 else:
     print("Running in a notebook")
+    #  directory where loaddata CSVs are located within the folder
+    loaddata_dir = pathlib.Path(f"./loaddata_csvs/{batch_name}").resolve(strict=True)
     loaddata_csv = pathlib.Path(
         f"{loaddata_dir}/BR00143976_concatenated_with_illum.csv"
     ).resolve(strict=True)
@@ -63,9 +69,10 @@ run_name = "analysis"
 # set path for CellProfiler pipeline
 path_to_pipeline = pathlib.Path("./analysis.cppipe").resolve(strict=True)
 
-# set main output dir for all plates if it doesn't exist
-output_dir = pathlib.Path("./sqlite_outputs")
-output_dir.mkdir(exist_ok=True)
+# set main output dir for all plates of the round if it doesn't exist (the preprocessing reads the
+# SQLite outputs per round)
+output_dir = pathlib.Path(f"./sqlite_outputs/{batch_name}")
+output_dir.mkdir(parents=True, exist_ok=True)
 
 
 # ## Create dictionary to process data
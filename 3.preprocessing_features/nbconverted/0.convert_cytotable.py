@@ -3,11 +3,12 @@
 
 # # Convert SQLite outputs to parquet files with cytotable
 
-# In[1]:
+# In[ ]:
 
 
-# Set parameter for papermill to use for processing
+# Set parameters for papermill to use for processing
 plate_id = "BR00145816"
+round_id = "Round_4_data"
 
 
 # In[2]:
@@ -19,10 +20,11 @@ plate_id = "BR00148746"
 
 # ## Import libraries
 
-# In[3]:
+# In[ ]:
 
 
 import pathlib
+import sys
 import pandas as pd
 
 # cytotable will merge objects from SQLite file into single cells and save as parquet file
@@ -33,10 +35,13 @@ import logging
 # Set the logging level to a higher level to avoid outputting unnecessary errors from config file in convert function
 logging.getLogger().setLevel(logging.ERROR)
 
+sys.path.append("../utils")
+from compact_dtype_utils import compact_profiles, write_compact_report
+
 
 # ## Set paths and variables
 
-# In[4]:
+# In[ ]:
 
 
 # preset configurations based on typical CellProfiler outputs
@@ -57,8 +62,9 @@ joins = joins.replace(
 # type of file output from cytotable (currently only parquet)
 dest_datatype = "parquet"
 
-# set the round of data that will be processed
-round_id = "Round_4_data"
+# save the profiles with compact data types (float32 features where the precision loss is negligible,
+# categorical metadata, and downcast integers), with a report of the maximum absolute error per feature
+compact_dtypes = False
 
 # set path to directory with SQLite files
 sqlite_dir = pathlib.Path(f"../2.feature_extraction/sqlite_outputs/{round_id}")
@@ -104,7 +110,7 @@ print(f"Plate {plate_id} has been converted with cytotable!")
 
 # # Load in converted profiles to update
 
-# In[6]:
+# In[ ]:
 
 
 # Directory with converted profiles
@@ -140,6 +146,17 @@ assert {"Image_Metadata_Row", "Image_Metadata_Col"}.issubset(
     converted_df.columns
 ), "Missing required Metadata columns: Row and/or Col"
 
+# Convert to compact data types if requested and save the validation report of the downcast features
+if compact_dtypes:
+    converted_df, compact_report_df = compact_profiles(converted_df)
+    write_compact_report(
+        compact_report_df,
+        pathlib.Path(
+            f"{output_dir}/compact_reports/{round_id}/{plate_id}_compact_report.csv"
+        ),
+        plate_id=plate_id,
+    )
+
 # Save the processed DataFrame as Parquet in the same path
 converted_df.to_parquet(file_path, index=False)
 
@@ -29,182 +29,57 @@
 # 
 # 
 
-# In[1]:
+# In[ ]:
 
 
 import pathlib
 import re
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-import matplotlib.pyplot as plt
 import pandas as pd
-import seaborn as sns
 
 from cytodataframe import CytoDataFrame
 from cosmicqc import find_outliers
 
+import sys
+
+sys.path.append("../utils")
+from qc_results_utils import write_qc_results
+from qc_plot_utils import (
+    compute_cluster_nuclei_plot_data,
+    compute_solidity_histogram_data,
+    render_cluster_nuclei_outliers,
+    render_nuclei_solidity_histogram,
+)
+from crop_cache_utils import build_crop_cache
+
 # Ignore FutureWarnings from cytodataframe due to skimage deprecation (does not affect functionality)
 import warnings
 
 warnings.filterwarnings("ignore", category=FutureWarning)
 
 
-# # Set functions for plotting
-
-# ### Function to plot scatterplot
-
-# In[2]:
-
-
-def plot_cluster_nuclei_outliers(
-    plate_df: pd.DataFrame,
-    outliers_df: pd.DataFrame,
-    plate_name: str,
-    qc_fig_dir: pathlib.Path,
-) -> None:
-    """Plot scatterplot of the cluster nuclei outliers.
-
-    Args:
-        plate_df (pd.DataFrame): Dataframe of the CytoTable output with the morphology profiles.
-        outliers_df (pd.DataFrame): Dataframe of the coSMicQC output which includes the identified outliers.
-        plate_name (str): String of the plate's name or ID.
-        qc_fig_dir (pathlib.Path): Path to the directory to save the plot.
-    """
-    # Create a copy of plate_df to avoid modifying the original
-    plate_df = plate_df.copy()
-
-    # Set the default 'Outlier_Status' to 'Single-cell passed QC'
-    plate_df["Outlier_Status"] = "Single-cell passed QC"
-
-    # Update 'Outlier_Status' for cells that failed QC
-    plate_df.loc[plate_df.index.isin(outliers_df.index), "Outlier_Status"] = (
-        "Single-cell failed QC"
-    )
-
-    # Create scatter plot
-    plt.figure(figsize=(10, 6))
-    sns.scatterplot(
-        data=plate_df,
-        x="Nuclei_Intensity_MassDisplacement_CorrDNA",
-        y="Nuclei_Intensity_IntegratedIntensity_CorrDNA",
-        hue="Outlier_Status",
-        palette={
-            "Single-cell passed QC": "#006400",
-            "Single-cell failed QC": "#990090",
-        },
-        alpha=0.2,
-    )
-
-    # Add threshold lines
-    plt.axvline(
-        x=outliers_df["Nuclei_Intensity_MassDisplacement_CorrDNA"].min(),
-        color="r",
-        linestyle="--",
-        label="Min. threshold for Nuclei Mass Displacement",
-    )
-    plt.axhline(
-        y=outliers_df["Nuclei_Intensity_IntegratedIntensity_CorrDNA"].min(),
-        color="b",
-        linestyle="--",
-        label="Min. threshold for Nuclei Intensity",
-    )
-
-    # Customize plot
-    plt.title(
-        f"Nuclei Mass Displacement vs. Nuclei Integrated Intensity for plate {plate_name}"
-    )
-    plt.xlabel("Nuclei Mass Displacement (Hoechst)")
-    plt.ylabel("Nuclei Integrated Intensity (Hoechst)")
-    plt.tight_layout()
-
-    # Show legend
-    plt.legend(loc="upper right", bbox_to_anchor=(1.0, 1.0), prop={"size": 10})
-
-    # Save figure without showing it
-    plt.savefig(
-        pathlib.Path(f"{qc_fig_dir}/{plate_name}_cluster_nuclei_outliers.png"), dpi=500
-    )
-    plt.close()  # Close the plot to prevent it from displaying
-
-
-# ### Function to plot KDE
-
-# In[3]:
-
-
-def plot_nuclei_solidity_histogram(
-    plate_df: pd.DataFrame,
-    outliers_df: pd.DataFrame,
-    plate_name: str,
-    qc_fig_dir: pathlib.Path,
-) -> None:
-    """Plot histogram of the nuclei solidity outliers.
-
-    Args:
-        plate_df (pd.DataFrame): Dataframe of the CytoTable output with the morphology profiles.
-        outliers_df (pd.DataFrame): Dataframe of the coSMicQC output which includes the identified outliers.
-        plate_name (str): String of the plate's name or ID.
-        qc_fig_dir (pathlib.Path): Path to the directory to save the plot.
-    """
-    # Create a copy of plate_df to avoid modifying the original
-    plate_df = plate_df.copy()
+# # Set up background rendering of QC plots
+# 
+# The data for the QC figures (stratified sample of points for the scatterplot and histogram counts) is computed with NumPy from boolean outlier masks, and the figures are rendered in a background process so QC is not blocked on matplotlib.
 
-    # Set the default 'Outlier_Status' to 'Single-cell passed QC'
-    plate_df["Outlier_Status"] = "Single-cell passed QC"
+# In[ ]:
 
-    # Update 'Outlier_Status' for cells that failed QC
-    plate_df.loc[plate_df.index.isin(outliers_df.index), "Outlier_Status"] = (
-        "Single-cell failed QC"
-    )
 
-    # Create histogram
-    plt.figure(figsize=(10, 6))
-    sns.histplot(
-        data=plate_df,
-        x="Nuclei_AreaShape_Solidity",
-        hue="Outlier_Status",
-        palette={
-            "Single-cell passed QC": "#006400",
-            "Single-cell failed QC": "#990090",
-        },
-        multiple="stack",  # Stacks bars based on hue
-        bins=50,  # Number of bins
-        kde=False,
-    )
-
-    # Add threshold line
-    max_threshold = outliers_df["Nuclei_AreaShape_Solidity"].max()
-    plt.axvline(
-        x=max_threshold,
-        color="r",
-        linestyle="--",
-        label=f"Threshold for Outliers: < {max_threshold}",
-    )
-
-    # Customize plot
-    plt.ylabel("Count")
-    plt.xlabel("Nuclei Solidity")
-    plt.title(f"Distribution of Nuclei Solidity for plate {plate_name}")
-    plt.legend()
-    plt.tight_layout()
-
-    # Save figure without showing it
-    plt.savefig(
-        pathlib.Path(
-            f"{qc_fig_dir}/{plate_name}_nuclei_solidity_outliers_histogram.png"
-        ),
-        dpi=500,
-    )
-    plt.close()  # Close the plot to prevent it from displaying
+# Set up a process pool to render the QC figures in the background
+plot_executor = ProcessPoolExecutor(max_workers=2)
+plot_futures = []
 
 
 # ## Set paths and variables
 
-# In[4]:
+# In[ ]:
 
 
-# Set parameter for papermill to use for processing
+# Set parameters for papermill to use for processing
 plate_id = "BR00147482"
+round_id = "Round_4_data"
 
 
 # In[5]:
@@ -216,12 +91,9 @@ plate_id = "BR00148746"
 
 # ## Injected parameter from papermill that updates for every plate being processed
 
-# In[6]:
+# In[ ]:
 
 
-# Set the round of data being processed
-round_id = "Round_4_data"
-
 # Directory containing the converted profiles
 data_dir = pathlib.Path(f"./data/converted_profiles/{round_id}")
 
@@ -243,6 +115,31 @@ all_qc_data_frames = {}
 # Set the compartment of choice to perform QC at the start (will change later)
 compartment = "Nuclei"
 
+# Set the QC conditions with the features and z-score thresholds used to detect them
+# (saved with the QC results so the thresholds travel with the flags)
+qc_rules = {
+    "Failed_ClusteredNuclei": {
+        "compartment": "Nuclei",
+        "feature_thresholds": {
+            "Nuclei_Intensity_MassDisplacement_CorrDNA": 0.05,  # Set very low as to detect all instances of clustering nuclei
+            "Nuclei_Intensity_IntegratedIntensity_CorrDNA": 1.5,  # Set higher than displacement to avoid false positives
+        },
+    },
+    "Failed_SolidityNuclei": {
+        "compartment": "Nuclei",
+        "feature_thresholds": {
+            "Nuclei_AreaShape_Solidity": -1.6,  # Set at this point where it looks like it starts to detect good quality nuclei
+        },
+    },
+    "Failed_CellsMultipleNuclei": {
+        "compartment": "Cells",
+        "feature_thresholds": {
+            # Set low to attempt to detect all instances of abnormally high int in nuclei for whole cells
+            "Cells_Intensity_IntegratedIntensity_CorrDNA": 0.5,
+        },
+    },
+}
+
 
 # ## Load in plate to perform QC on
 
@@ -358,17 +255,14 @@ next(iter(outline_to_orig_mapping.items()))
 
 # ## Detect segmentations of clustered nuclei
 
-# In[12]:
+# In[ ]:
 
 
 # Find large nuclei outliers for the current plate
 nuclei_clustered_outliers = find_outliers(
     df=filtered_plate_df,
     metadata_columns=metadata_columns,
-    feature_thresholds={
-        "Nuclei_Intensity_MassDisplacement_CorrDNA": 0.05,  # Set very low as to detect all instances of clustering nuclei
-        "Nuclei_Intensity_IntegratedIntensity_CorrDNA": 1.5,  # Set higher than displacement to avoid false positives
-    },
+    feature_thresholds=qc_rules["Failed_ClusteredNuclei"]["feature_thresholds"],
 )
 
 # MUST SET DATA AS DATAFRAME FOR OUTLINE DIR TO WORK
@@ -394,15 +288,27 @@ nuclei_clustered_outliers_cdf.sample(n=2, random_state=0)
 
 # ### Plot the outliers
 
-# In[13]:
+# In[ ]:
 
 
-# Save cluster nuclei scatterplot
-plot_cluster_nuclei_outliers(
-    plate_df=plate_df,
-    outliers_df=nuclei_clustered_outliers_cdf,
-    plate_name=plate_id,
-    qc_fig_dir=qc_fig_dir,
+# Set a boolean mask of the cluster nuclei outliers aligned to the plate rows
+clustered_nuclei_failed = plate_df.index.isin(nuclei_clustered_outliers.index)
+
+# Compute a stratified sample of passing/failing single-cells and render the scatterplot in the background
+cluster_nuclei_plot_data = compute_cluster_nuclei_plot_data(
+    mass_displacement=plate_df["Nuclei_Intensity_MassDisplacement_CorrDNA"].to_numpy(),
+    integrated_intensity=plate_df[
+        "Nuclei_Intensity_IntegratedIntensity_CorrDNA"
+    ].to_numpy(),
+    failed_mask=clustered_nuclei_failed,
+)
+plot_futures.append(
+    plot_executor.submit(
+        render_cluster_nuclei_outliers,
+        plot_data=cluster_nuclei_plot_data,
+        plate_name=plate_id,
+        qc_fig_dir=qc_fig_dir,
+    )
 )
 
 
@@ -410,16 +316,14 @@ plot_cluster_nuclei_outliers(
 # 
 # **NOTE:** For the pilot data, we are determining optimal conditions (seeding density and time point). This means all cells are not treated and should be in a "healthy" state. Given that `solidity` measures how irregular the shape of a nuclei is, we would expect that cells treated with a drug/compound could yield interesting shapes or phenotypes. Since we are not working with drug treatments at this time, we can use this feature to identify technically incorrect segmentations.
 
-# In[14]:
+# In[ ]:
 
 
 # Find low nuclei solidity outliers for the current plate
 solidity_nuclei_outliers = find_outliers(
     df=filtered_plate_df,
     metadata_columns=metadata_columns,
-    feature_thresholds={
-        "Nuclei_AreaShape_Solidity": -1.6,  # Set at this point where it looks like it starts to detect good quality nuclei
-    },
+    feature_thresholds=qc_rules["Failed_SolidityNuclei"]["feature_thresholds"],
 )
 
 # MUST SET DATA AS DATAFRAME FOR OUTLINE DIR TO WORK
@@ -444,15 +348,24 @@ solidity_nuclei_outliers_cdf.sample(n=2, random_state=0)
 
 # ### Plot the outliers
 
-# In[15]:
+# In[ ]:
 
 
-# Save low nuclei solidity histogram
-plot_nuclei_solidity_histogram(
-    plate_df=plate_df,
-    outliers_df=solidity_nuclei_outliers,
-    plate_name=plate_id,
-    qc_fig_dir=qc_fig_dir,
+# Set a boolean mask of the low nuclei solidity outliers aligned to the plate rows
+solidity_nuclei_failed = plate_df.index.isin(solidity_nuclei_outliers.index)
+
+# Compute the histogram counts with NumPy and render the histogram in the background
+solidity_hist_data = compute_solidity_histogram_data(
+    solidity=plate_df["Nuclei_AreaShape_Solidity"].to_numpy(),
+    failed_mask=solidity_nuclei_failed,
+)
+plot_futures.append(
+    plot_executor.submit(
+        render_nuclei_solidity_histogram,
+        hist_data=solidity_hist_data,
+        plate_name=plate_id,
+        qc_fig_dir=qc_fig_dir,
+    )
 )
 
 
@@ -528,17 +441,14 @@ filtered_plate_df = plate_df[metadata_columns + qc_features]
 
 # ### Detect cell outliers
 
-# In[18]:
+# In[ ]:
 
 
 # Find cell outliers for the current plate
 cell_outliers = find_outliers(
     df=filtered_plate_df,
     metadata_columns=metadata_columns,
-    feature_thresholds={
-        # Set low to attempt to detect all instances of abnormally high int in nuclei for whole cells
-        "Cells_Intensity_IntegratedIntensity_CorrDNA": 0.5,
-    },
+    feature_thresholds=qc_rules["Failed_CellsMultipleNuclei"]["feature_thresholds"],
 )
 
 # MUST SET DATA AS DATAFRAME FOR OUTLINE DIR TO WORK
@@ -561,9 +471,48 @@ print(cell_outliers_cdf.shape)
 cell_outliers_cdf.sample(n=2, random_state=0)
 
 
-# ## Save the outlier indices to use for reporting
+# ## Cache image crops of sampled outliers for review
+# 
+# Viewing outliers with `CytoDataFrame` opens the full-field images and outlines each time a sample is displayed.
+# We extract the bounding box crops for a sample of outliers per QC condition into a compact NumPy memmap in a background thread pool, so reviewing outliers and reporting can read the crops with `CropCache` from `utils/crop_cache_utils.py` instead of the whole fields.
 
-# In[19]:
+# In[ ]:
+
+
+# Set the number of outliers to sample per QC condition for the crop cache
+num_crop_samples = 100
+
+# Directory to save the crop caches for this plate (one per QC condition)
+crop_cache_dir = pathlib.Path(f"./qc_crop_cache/{round_id}/{plate_id}")
+
+# Build the crop caches in a background thread so the QC results are saved without waiting
+crop_executor = ThreadPoolExecutor(max_workers=1)
+crop_cache_futures = [
+    crop_executor.submit(
+        build_crop_cache,
+        outliers_df=pd.DataFrame(outliers).sample(
+            n=min(num_crop_samples, outliers.shape[0]), random_state=0
+        ),
+        compartment=qc_rules[condition]["compartment"],
+        cache_dir=crop_cache_dir / condition,
+        outline_dir=pathlib.Path(
+            f"../2.feature_extraction/sqlite_outputs/{round_id}/{plate_id}"
+        ),
+    )
+    for condition, outliers in {
+        "Failed_ClusteredNuclei": nuclei_clustered_outliers,
+        "Failed_SolidityNuclei": solidity_nuclei_outliers,
+        "Failed_CellsMultipleNuclei": cell_outliers,
+    }.items()
+    if outliers.shape[0] > 0
+]
+
+
+# ## Save the QC results to use for reporting
+# 
+# The QC results are saved as one boolean column per QC condition, aligned to the row order of the converted profiles, with the QC conditions and thresholds stored in the file metadata.
+
+# In[ ]:
 
 
 # Identify failing indices from both outlier dataframes
@@ -571,43 +520,27 @@ outlier_indices = pd.concat(
     [nuclei_clustered_outliers, solidity_nuclei_outliers, cell_outliers]
 ).index.unique()
 
-# Create a new dataframe with only the failing rows
-failing_df = plate_df.loc[outlier_indices, metadata_columns].copy()
-
-# Add failure condition columns, marking all rows as True for each condition they failed
-failing_df["Failed_ClusteredNuclei"] = failing_df.index.isin(
-    nuclei_clustered_outliers.index
-)
-failing_df["Failed_SolidityNuclei"] = failing_df.index.isin(
-    solidity_nuclei_outliers.index
-)
-failing_df["Failed_CellsMultipleNuclei"] = failing_df.index.isin(cell_outliers.index)
-
-# Ensure boolean dtype
-failing_df = failing_df.astype(
-    {
-        "Failed_ClusteredNuclei": bool,
-        "Failed_SolidityNuclei": bool,
-        "Failed_CellsMultipleNuclei": bool,
-    }
-)
-
-# Keep original indices for later
-failing_df = failing_df.reset_index().rename(columns={"index": "original_indices"})
+# Set a boolean flag per QC condition aligned to the rows of the converted profiles
+qc_flags = {
+    "Failed_ClusteredNuclei": clustered_nuclei_failed,
+    "Failed_SolidityNuclei": solidity_nuclei_failed,
+    "Failed_CellsMultipleNuclei": plate_df.index.isin(cell_outliers.index),
+}
 
-# Save the indices dataframe as CSV
-failing_df.to_csv(
-    pathlib.Path(f"{qc_results_dir}/{plate_id}_failed_qc_indices.csv.gz"),
-    compression="gzip",
-    index=False,
+# Save the QC flags with the QC conditions and thresholds in the file metadata
+write_qc_results(
+    plate_df=plate_df,
+    qc_flags=qc_flags,
+    qc_rules=qc_rules,
+    output_path=pathlib.Path(f"{qc_results_dir}/{plate_id}_qc_results.parquet"),
 )
 
 # Calculate percentage failed
 total_rows = plate_df.shape[0]
-failed_percentage = (failing_df.shape[0] / total_rows) * 100
+failed_percentage = (len(outlier_indices) / total_rows) * 100
 
 # Print summary with percentage
-print(f"Total failing single cells: {failing_df.shape[0]} ({failed_percentage:.2f}%)")
+print(f"Total failing single cells: {len(outlier_indices)} ({failed_percentage:.2f}%)")
 
 
 # ## Clean and save the data
@@ -626,3 +559,20 @@ print(
     f"{plate_id} has been cleaned and saved with the shape: {plate_df_cleaned.shape}."
 )
 
+
+# ## Wait for the QC figures and crop caches to finish
+
+# In[ ]:
+
+
+# Make sure all QC figures were saved (raises any errors from the background process)
+for future in plot_futures:
+    print(f"Saved QC figure: {future.result()}")
+
+# Make sure all crop caches were saved (raises any errors from reading the images)
+for future in crop_cache_futures:
+    print(f"Saved outlier crop cache: {future.result()}")
+
+plot_executor.shutdown()
+crop_executor.shutdown()
+
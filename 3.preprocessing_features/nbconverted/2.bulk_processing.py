@@ -5,7 +5,7 @@
 
 # ## Import libraries
 
-# In[1]:
+# In[ ]:
 
 
 import pathlib
@@ -13,18 +13,32 @@ import pprint
 
 import pandas as pd
 
-from pycytominer import aggregate, annotate, normalize, feature_select
 from pycytominer.cyto_utils import output
 
+import sys
+
+sys.path.append("../utils")
+from bulk_utils import aggregate_median_from_parquet
+from feature_select_utils import (
+    compute_feature_select_stats_from_dataframe,
+    select_round_features,
+)
+from pipeline_utils import ProfilePipeline
+from plate_registry import get_plate_info_dictionary, index_plate_files
+
 
 # ## Set paths and variables
 
 # In[ ]:
 
 
-# Set round to be processed
+# Set parameter for papermill to use for processing (round of data to be processed)
 round_id = "Round_4_data"
 
+
+# In[ ]:
+
+
 # Path to dir with cleaned data from single-cell QC
 cleaned_dir = pathlib.Path(f"./data/cleaned_profiles/{round_id}")
 
@@ -32,17 +46,13 @@ cleaned_dir = pathlib.Path(f"./data/cleaned_profiles/{round_id}")
 output_dir = pathlib.Path(f"./data/bulk_profiles/{round_id}")
 output_dir.mkdir(parents=True, exist_ok=True)
 
-# extract the plate names from the file name
-plate_names = [file.stem.split("_")[0] for file in cleaned_dir.glob("*.parquet")]
+# index the cleaned files by plate name (scans the directory once)
+cleaned_files = index_plate_files(cleaned_dir, "_cleaned.parquet")
+plate_names = list(cleaned_files)
 
 # path for platemap directory
 platemap_dir = pathlib.Path("../0.download_data/metadata/platemaps")
 
-# load in barcode platemap
-barcode_platemap = pd.read_csv(
-    pathlib.Path(f"{platemap_dir}/Barcode_platemap_pilot_data.csv")
-)
-
 # operations to perform for feature selection
 feature_select_ops = [
     "variance_threshold",
@@ -51,51 +61,32 @@ feature_select_ops = [
     "drop_na_columns",
 ]
 
+# only the feature-selected profiles are saved by default, set to True to also save the
+# aggregated, annotated, and normalized profiles
+save_intermediate_profiles = False
+
+# number of feature columns to read at a time when computing the well medians
+columns_per_batch = 250
+
+# set to True to select one set of features for the round from statistics pooled across plates
+# (saved to a manifest) instead of selecting features separately for each plate
+round_level_feature_selection = False
+feature_manifest_path = pathlib.Path(f"{output_dir}/{round_id}_feature_manifest.json")
+
 plate_names
 
 
 # ## Set dictionary with plates to process
 
-# In[3]:
+# In[ ]:
 
 
-# create plate info dictionary
-plate_info_dictionary = {
-    name: {
-        "profile_path": (
-            str(
-                pathlib.Path(
-                    list(cleaned_dir.rglob(f"{name}_cleaned.parquet"))[0]
-                ).resolve(strict=True)
-            )
-            if list(cleaned_dir.rglob(f"{name}_cleaned.parquet"))
-            else None
-        ),
-        # Find the platemap file based on barcode match and append .csv
-        "platemap_path": (
-            str(
-                pathlib.Path(
-                    list(
-                        platemap_dir.rglob(
-                            f"{barcode_platemap.loc[barcode_platemap['barcode'] == name, 'platemap_file'].values[0]}.csv"
-                        )
-                    )[0]
-                ).resolve(strict=True)
-            )
-            if name in barcode_platemap["barcode"].values
-            else None
-        ),
-        # Get the time_point based on the barcode match
-        "time_point": (
-            barcode_platemap.loc[
-                barcode_platemap["barcode"] == name, "time_point"
-            ].values[0]
-            if name in barcode_platemap["barcode"].values
-            else None
-        ),
-    }
-    for name in plate_names
-}
+# create plate info dictionary (platemap path and time point are looked up from the cached plate registry)
+plate_info_dictionary = get_plate_info_dictionary(
+    platemap_dir=platemap_dir,
+    plate_files={"profile_path": cleaned_files},
+    plate_names=plate_names,
+)
 
 # Display the dictionary to verify the entries
 pprint.pprint(plate_info_dictionary, indent=4)
@@ -107,75 +98,106 @@ pprint.pprint(plate_info_dictionary, indent=4)
 
 
 # Process plates with pycytominer (U2-OS specific normalization removed)
-for plate, info in plate_info_dictionary.items():
-    print(f"Now performing pycytominer pipeline for {plate}")
-
-    # Output file paths for each file
-    output_aggregated_file = str(pathlib.Path(f"{output_dir}/{plate}_bulk.parquet"))
-    output_annotated_file = str(
-        pathlib.Path(f"{output_dir}/{plate}_bulk_annotated.parquet")
-    )
-
-    # Normalized and feature-selected files (whole-plate normalization)
-    output_normalized_file = str(
-        pathlib.Path(f"{output_dir}/{plate}_bulk_normalized.parquet")
-    )
-    output_feature_select_file = str(
-        pathlib.Path(f"{output_dir}/{plate}_bulk_feature_selected.parquet")
-    )
-
-    # Load single-cell profiles
-    single_cell_df = pd.read_parquet(info["profile_path"])
-
-    # Load platemap
-    platemap_df = pd.read_csv(info["platemap_path"])
+# normalized profiles and output paths per plate for round-level feature selection
+normalized_profiles = {}
+feature_selected_files = {}
+
+# annotate, normalize, and feature select run in memory and files are saved in a background thread
+with ProfilePipeline(
+    feature_select_ops=feature_select_ops,
+    na_cutoff=0,
+    normalize_samples="all",
+    save_intermediate_profiles=save_intermediate_profiles,
+) as pipeline:
+    for plate, info in plate_info_dictionary.items():
+        print(f"Now performing pycytominer pipeline for {plate}")
+
+        # Output file paths for each file (normalization is always whole-plate)
+        output_aggregated_file = pathlib.Path(f"{output_dir}/{plate}_bulk.parquet")
+        output_files = {
+            "annotated": pathlib.Path(f"{output_dir}/{plate}_bulk_annotated.parquet"),
+            "normalized": pathlib.Path(f"{output_dir}/{plate}_bulk_normalized.parquet"),
+            "feature_selected": pathlib.Path(
+                f"{output_dir}/{plate}_bulk_feature_selected.parquet"
+            ),
+        }
+
+        # Load platemap
+        platemap_df = pd.read_csv(info["platemap_path"])
+
+        # Step 1: Aggregation (exact well medians computed from batches of columns
+        # so the single-cell profiles are never fully loaded)
+        aggregated_df = aggregate_median_from_parquet(
+            profile_path=info["profile_path"],
+            strata=["Image_Metadata_Plate", "Image_Metadata_Well"],
+            columns_per_batch=columns_per_batch,
+        )
+        if save_intermediate_profiles:
+            pipeline.persist(aggregated_df, output_aggregated_file)
+
+        if round_level_feature_selection:
+            # Steps 2-3: Annotation (with time point) and normalization, features are selected
+            # for the round after all plates are normalized
+            normalized_profiles[plate] = pipeline.annotate_and_normalize(
+                profiles=aggregated_df,
+                platemap=platemap_df,
+                output_files=output_files,
+                join_on=["Metadata_well", "Image_Metadata_Well"],
+                added_metadata={"Metadata_time_point": info["time_point"]},
+            )
+            feature_selected_files[plate] = output_files["feature_selected"]
+            continue
 
-    # Step 1: Aggregation
-    aggregate(
-        population_df=single_cell_df,
-        operation="median",
-        strata=["Image_Metadata_Plate", "Image_Metadata_Well"],
-        output_file=output_aggregated_file,
-        output_type="parquet",
-    )
+        # Steps 2-4: Annotation (with time point), normalization, and feature selection
+        feature_selected_df = pipeline.run(
+            profiles=aggregated_df,
+            platemap=platemap_df,
+            output_files=output_files,
+            join_on=["Metadata_well", "Image_Metadata_Well"],
+            added_metadata={"Metadata_time_point": info["time_point"]},
+        )
 
-    # Step 2: Annotation
-    annotated_df = annotate(
-        profiles=output_aggregated_file,
-        platemap=platemap_df,
-        join_on=["Metadata_well", "Image_Metadata_Well"],
-    )
+output_feature_select_file = output_files["feature_selected"]
 
-    # Add 'Metadata_time_point' column based on the plate's time_point from dict
-    annotated_df["Metadata_time_point"] = info["time_point"]
 
-    # Step 3: Output annotated DataFrame
-    output(
-        df=annotated_df,
-        output_filename=output_annotated_file,
-        output_type="parquet",
-    )
+# ## Select features for the round (optional)
 
-    # Step 4: Normalization (always whole-plate)
-    samples = "all"
-    print(f"Normalizing using samples: {samples}")
+# In[ ]:
 
-    normalize(
-        profiles=annotated_df,
-        method="standardize",
-        output_file=output_normalized_file,
-        output_type="parquet",
-        samples=samples,
-    )
 
-    # Step 5: Feature selection
-    feature_select(
-        output_normalized_file,
+if round_level_feature_selection:
+    # Pool the feature selection statistics across all plates
+    round_stats = None
+    for plate, normalized_df in normalized_profiles.items():
+        plate_stats = compute_feature_select_stats_from_dataframe(normalized_df)
+        round_stats = (
+            plate_stats if round_stats is None else round_stats.merge(plate_stats)
+        )
+
+    # Select one set of features and save it to the manifest
+    manifest = select_round_features(
+        stats=round_stats,
+        manifest_path=feature_manifest_path,
+        plates=list(normalized_profiles),
         operation=feature_select_ops,
         na_cutoff=0,
-        output_file=output_feature_select_file,
-        output_type="parquet",
+        columns=list(next(iter(normalized_profiles.values())).columns),
     )
+    print(
+        f"Selected {len(manifest['selected_features'])} of {len(manifest['features'])} features"
+    )
+
+    # Project every plate onto the selected features
+    for plate, normalized_df in normalized_profiles.items():
+        output(
+            df=normalized_df.drop(
+                columns=manifest["excluded_features"], errors="ignore"
+            ),
+            output_filename=str(feature_selected_files[plate]),
+            output_type="parquet",
+        )
+
+    output_feature_select_file = feature_selected_files[plate]
 
 
 # In[5]:
@@ -5,27 +5,41 @@
 
 # ## Import libraries
 
-# In[1]:
+# In[ ]:
 
 
-import gc
 import pathlib
 import pprint
 
 import pandas as pd
+import pyarrow.parquet as pq
 
-from pycytominer import annotate, normalize, feature_select
-from pycytominer.cyto_utils import output
+import sys
+
+sys.path.append("../utils")
+from dataset_utils import write_partitioned_profiles
+from feature_select_utils import (
+    compute_feature_select_stats,
+    select_round_features,
+    write_selected_features,
+)
+from pipeline_utils import process_single_cell_plate
+from plate_executor import estimate_plate_memory, run_plates_parallel
+from plate_registry import get_plate_info_dictionary, index_plate_files
 
 
 # ## Set paths and variables
 
-# In[2]:
+# In[ ]:
 
 
-# Set round of plates to process
+# Set parameter for papermill to use for processing (round of data to be processed)
 round_id = "Round_3_data"
 
+
+# In[ ]:
+
+
 # Path to dir with cleaned data from single-cell QC
 cleaned_dir = pathlib.Path(f"./data/cleaned_profiles/{round_id}")
 
@@ -33,17 +47,13 @@ cleaned_dir = pathlib.Path(f"./data/cleaned_profiles/{round_id}")
 output_dir = pathlib.Path(f"./data/single_cell_profiles/{round_id}")
 output_dir.mkdir(parents=True, exist_ok=True)
 
-# extract the plate names from the file name
-plate_names = [file.stem.split("_")[0] for file in cleaned_dir.glob("*.parquet")]
+# index the cleaned files by plate name (scans the directory once)
+cleaned_files = index_plate_files(cleaned_dir, "_cleaned.parquet")
+plate_names = list(cleaned_files)
 
 # path for platemap directory
 platemap_dir = pathlib.Path("../0.download_data/metadata/platemaps")
 
-# load in barcode platemap
-barcode_platemap = pd.read_csv(
-    pathlib.Path(f"{platemap_dir}/Barcode_platemap_pilot_data.csv")
-)
-
 # operations to perform for feature selection
 feature_select_ops = [
     "variance_threshold",
@@ -52,51 +62,56 @@ feature_select_ops = [
     "drop_na_columns",
 ]
 
+# only the feature-selected profiles are saved by default, set to True to also save the
+# annotated and normalized profiles
+save_intermediate_profiles = False
+
+# set to True for plates larger than memory, which annotates and standardizes the profiles in two
+# streaming passes over batches of rows and selects features from statistics accumulated in one
+# more pass (the normalized profiles are always saved in this mode)
+out_of_core_normalization = False
+
+# number of rows read at a time for out-of-core normalization and feature selection
+normalization_batch_size = 100000
+
+# fraction of single-cells randomly sampled for the feature correlations in out-of-core mode
+# (None uses all single-cells and selects the same features as pycytominer)
+correlation_sample_fraction = None
+
+# set to True to select one set of features for the round from statistics pooled across plates
+# (saved to a manifest) instead of selecting features separately for each plate
+round_level_feature_selection = False
+feature_manifest_path = pathlib.Path(f"{output_dir}/{round_id}_feature_manifest.json")
+
+# plates are processed in separate processes, with up to max_plate_workers plates at once as long as
+# their estimated memory (from the Parquet metadata of the cleaned files) fits in the memory budget
+max_plate_workers = 1
+memory_budget_gb = 64
+
+# set to True to save the profiles with compact data types (categorical metadata, downcast integers,
+# and float32 features), which is kept automatically for plates converted with compact_dtypes in
+# 0.convert_cytotable (float32 features stay float32 through normalization)
+compact_dtypes = False
+
+# set to True to also add the feature-selected profiles to a dataset partitioned by round, plate, and
+# well, so later reads can be filtered (e.g., by plate or cell line) without opening every plate file
+write_round_dataset = False
+round_dataset_dir = pathlib.Path("./data/single_cell_profiles_dataset")
+
 plate_names
 
 
 # ## Set dictionary with plates to process
 
-# In[3]:
-
-
-# create plate info dictionary
-plate_info_dictionary = {
-    name: {
-        "profile_path": (
-            str(
-                pathlib.Path(
-                    list(cleaned_dir.rglob(f"{name}_cleaned.parquet"))[0]
-                ).resolve(strict=True)
-            )
-            if list(cleaned_dir.rglob(f"{name}_cleaned.parquet"))
-            else None
-        ),
-        # Find the platemap file based on barcode match and append .csv
-        "platemap_path": (
-            str(
-                pathlib.Path(
-                    list(
-                        platemap_dir.rglob(
-                            f"{barcode_platemap.loc[barcode_platemap['barcode'] == name, 'platemap_file'].values[0]}.csv"
-                        )
-                    )[0]
-                ).resolve(strict=True)
-            )
-            if name in barcode_platemap["barcode"].values
-            else None
-        ),
-        # Get the time_point based on the barcode match
-        "time_point": (
-            barcode_platemap.loc[
-                barcode_platemap["barcode"] == name, "time_point"
-            ].values[0]
-            if name in barcode_platemap["barcode"].values
-            else None
-        ),
-    }
-    for name in plate_names
-}
+# In[ ]:
+
+
+# create plate info dictionary (platemap path and time point are looked up from the cached plate registry)
+plate_info_dictionary = get_plate_info_dictionary(
+    platemap_dir=platemap_dir,
+    plate_files={"profile_path": cleaned_files},
+    plate_names=plate_names,
+)
 
 # Display the dictionary to verify the entries
 pprint.pprint(plate_info_dictionary, indent=4)
@@ -104,7 +119,7 @@ pprint.pprint(plate_info_dictionary, indent=4)
 
 # ## Process data with pycytominer
 
-# In[4]:
+# In[ ]:
 
 
 # Set up map for renaming metadata column(s)
@@ -112,76 +127,111 @@ column_name_mapping = {
     "Image_Metadata_Site": "Metadata_Site",
 }
 
-for plate, info in plate_info_dictionary.items():
-    print(f"Performing pycytominer pipeline for {plate}")
-
-    # Set output paths
-    output_annotated_file = str(
-        pathlib.Path(f"{output_dir}/{plate}_sc_annotated.parquet")
-    )
-    output_normalized_file = str(
-        pathlib.Path(f"{output_dir}/{plate}_sc_normalized.parquet")
-    )
-    output_feature_select_file = str(
-        pathlib.Path(f"{output_dir}/{plate}_sc_feature_selected.parquet")
+# Estimate the memory needed for each plate (only a batch of rows is in memory when out-of-core)
+memory_estimates = {
+    plate: estimate_plate_memory(
+        info["profile_path"],
+        max_rows=normalization_batch_size if out_of_core_normalization else None,
     )
+    for plate, info in plate_info_dictionary.items()
+}
 
-    # Load in profile and platemap
-    profile_df = pd.read_parquet(info["profile_path"])
-    platemap_df = pd.read_csv(info["platemap_path"])
+# Annotate, normalize, and feature select each plate (an error in one plate does not stop the others)
+processing_summary_df = run_plates_parallel(
+    plate_info_dictionary=plate_info_dictionary,
+    process_plate=process_single_cell_plate,
+    memory_estimates=memory_estimates,
+    memory_budget_gb=memory_budget_gb,
+    max_workers=max_plate_workers,
+    output_dir=output_dir,
+    feature_select_ops=feature_select_ops,
+    rename_columns=column_name_mapping,
+    save_intermediate_profiles=save_intermediate_profiles,
+    out_of_core_normalization=out_of_core_normalization,
+    select_features=not round_level_feature_selection,
+    batch_size=normalization_batch_size,
+    correlation_sample_fraction=correlation_sample_fraction,
+    compact_dtypes=compact_dtypes,
+)
 
-    print("Performing annotation for", plate, "...")
-    # Step 1: Annotation
-    annotated_df = annotate(
-        profiles=profile_df,
-        platemap=platemap_df,
-        join_on=["Metadata_well", "Image_Metadata_Well"],
+# plates that completed processing
+completed_plates = processing_summary_df.loc[
+    processing_summary_df["status"] == "completed", "plate"
+].tolist()
+# report the plates that failed (e.g., an error or a worker killed for running out of memory)
+failed_df = processing_summary_df.loc[
+    processing_summary_df["status"] == "failed", ["plate", "error"]
+]
+if not failed_df.empty:
+    print(f"{failed_df.shape[0]} plate(s) failed:\n{failed_df.to_string(index=False)}")
+if not completed_plates:
+    raise RuntimeError(
+        "None of the plates completed processing, see the failures above."
     )
+output_feature_select_file = pathlib.Path(
+    f"{output_dir}/{completed_plates[-1]}_sc_feature_selected.parquet"
+)
 
-    # Add 'Metadata_time_point' column based on the plate's time_point from dict
-    annotated_df["Metadata_time_point"] = info["time_point"]
+# Display the status and stage timings of each plate
+processing_summary_df
 
-    # Rename Metadata column(s) using the rename() function
-    annotated_df.rename(columns=column_name_mapping, inplace=True)
 
-    # Save the modified annotated DataFrame
-    output(
-        df=annotated_df,
-        output_filename=output_annotated_file,
-        output_type="parquet",
-    )
+# ## Select features for the round (optional)
 
-    # Clear memory
-    del profile_df, platemap_df, annotated_df
-    gc.collect()
-
-    print("Performing normalization for", plate, "...")
-    # Step 2: Normalization
-    normalized_df = normalize(
-        profiles=output_annotated_file,
-        method="standardize",
-        output_file=output_normalized_file,
-        output_type="parquet",
-    )
+# In[ ]:
 
-    # Clear memory
-    del normalized_df
-    gc.collect()
 
-    print("Performing feature selection for", plate, "...")
-    # Step 3: Feature selection
-    feature_select(
-        profiles=output_normalized_file,
+if round_level_feature_selection:
+    normalized_files = [
+        pathlib.Path(f"{output_dir}/{plate}_sc_normalized.parquet")
+        for plate in completed_plates
+    ]
+
+    # Pool the feature selection statistics across the normalized profiles of all plates
+    round_stats = compute_feature_select_stats(
+        profile_paths=normalized_files,
+        batch_size=normalization_batch_size,
+        sample_fraction=correlation_sample_fraction,
+    )
+
+    # Select one set of features and save it to the manifest
+    manifest = select_round_features(
+        stats=round_stats,
+        manifest_path=feature_manifest_path,
+        plates=completed_plates,
         operation=feature_select_ops,
         na_cutoff=0,
-        output_file=output_feature_select_file,
-        output_type="parquet",
+        columns=pq.read_schema(normalized_files[0]).names,
+    )
+    print(
+        f"Selected {len(manifest['selected_features'])} of {len(manifest['features'])} features"
     )
 
-    # Clear memory
-    gc.collect()
+    # Project every plate onto the selected features (excluded features are never read)
+    for plate, normalized_file in zip(completed_plates, normalized_files):
+        write_selected_features(
+            profile_path=normalized_file,
+            output_path=pathlib.Path(f"{output_dir}/{plate}_sc_feature_selected.parquet"),
+            excluded_features=manifest["excluded_features"],
+            batch_size=normalization_batch_size,
+        )
+        print(f"Projected {plate} onto the round feature set!")
+
+
+# ## Add profiles to the partitioned dataset (optional)
+
+# In[ ]:
+
 
-    print(f"Preprocessing features completed for {plate}!")
+if write_round_dataset:
+    for plate in completed_plates:
+        write_partitioned_profiles(
+            profile_path=pathlib.Path(f"{output_dir}/{plate}_sc_feature_selected.parquet"),
+            dataset_dir=round_dataset_dir,
+            round_id=round_id,
+            batch_size=normalization_batch_size,
+        )
+        print(f"Added {plate} to the partitioned dataset!")
 
 
 # In[5]:
@@ -5,30 +5,34 @@
 # 
 # The QC report consists of a table with the cell line, seeding density, and percentage failed single-cells
 
-# In[1]:
+# In[ ]:
 
 
 import pathlib
-import pandas as pd
-from pycytominer import annotate
 import pprint
 
+import sys
 
-# In[2]:
+sys.path.append("../utils")
+from plate_registry import get_plate_info_dictionary, index_plate_files
+from qc_report_utils import generate_qc_report
+from query_utils import connect, query_qc_report, register_profile_views
 
 
-# Set round of data to be processed
+# In[ ]:
+
+
+# Set parameter for papermill to use for processing (round of data to be processed)
 round_id = "Round_4_data"
 
+
+# In[ ]:
+
+
 # path for platemap directory
 platemap_dir = pathlib.Path("../0.download_data/metadata/platemaps")
 
-# load in barcode platemap
-barcode_platemap = pd.read_csv(
-    pathlib.Path(f"{platemap_dir}/Barcode_platemap_pilot_data.csv")
-)
-
-# path for qc results (indices)
+# path for qc results (boolean flags per QC condition)
 qc_results_dir = pathlib.Path("./qc_results")
 
 # Path to dir with converted data from single-cell QC
@@ -38,141 +42,42 @@ converted_dir = pathlib.Path(f"./data/converted_profiles/{round_id}")
 output_dir = pathlib.Path("./qc_report")
 output_dir.mkdir(parents=True, exist_ok=True)
 
-# extract the plate names from the file name
-plate_names = [file.stem.split("_")[0] for file in converted_dir.glob("*.parquet")]
-
-
-# In[3]:
-
-
-# create plate info dictionary
-plate_info_dictionary = {
-    name: {
-        "converted_path": (
-            str(
-                pathlib.Path(
-                    list(converted_dir.rglob(f"{name}_converted.parquet"))[0]
-                ).resolve(strict=True)
-            )
-            if list(converted_dir.rglob(f"{name}_converted.parquet"))
-            else None
-        ),
-        "qc_results_path": (
-            str(
-                pathlib.Path(
-                    list(qc_results_dir.rglob(f"{name}_failed_qc_indices.csv.gz"))[0]
-                ).resolve(strict=True)
-            )
-            if list(qc_results_dir.rglob(f"{name}_failed_qc_indices.csv.gz"))
-            else None
-        ),
-        # Find the platemap file based on barcode match and append .csv
-        "platemap_path": (
-            str(
-                pathlib.Path(
-                    list(
-                        platemap_dir.rglob(
-                            f"{barcode_platemap.loc[barcode_platemap['barcode'] == name, 'platemap_file'].values[0]}.csv"
-                        )
-                    )[0]
-                ).resolve(strict=True)
-            )
-            if name in barcode_platemap["barcode"].values
-            else None
-        ),
-        # Get the time_point based on the barcode match
-        "time_point": (
-            barcode_platemap.loc[
-                barcode_platemap["barcode"] == name, "time_point"
-            ].values[0]
-            if name in barcode_platemap["barcode"].values
-            else None
-        ),
-    }
-    for name in plate_names
-}
-
-# Display the dictionary to verify the entries
-pprint.pprint(plate_info_dictionary, indent=4)
-
-
-# In[4]:
-
-
-# Set metadata columns to load in for the converted df
-metadata_cols = [
-    "Metadata_ImageNumber",
-    "Image_Metadata_Plate",
-    "Image_Metadata_Well",
-    "Image_Metadata_Site",
-    "Metadata_Nuclei_Location_Center_X",
-    "Metadata_Nuclei_Location_Center_Y",
-]
-
-qc_report_list = []  # Initialize an empty list to store per-plate QC reports
-
-# Generate QC report across plates
-for plate, info in plate_info_dictionary.items():
-    print(f"Generating QC report for {plate}")
+# set to True to also generate the QC report for every round with one DuckDB query over the QC results
+# of all rounds (requires duckdb to be installed)
+query_all_rounds = False
 
-    # Load in only the metadata columns from the converted dataframe and create a column called failed_qc
-    converted_df = pd.read_parquet(info["converted_path"], columns=metadata_cols)
-    converted_df["failed_qc"] = False  # Initialize all rows as False
+# index the converted files and QC results by plate name (scans each directory once)
+converted_files = index_plate_files(converted_dir, "_converted.parquet")
+qc_results_files = index_plate_files(qc_results_dir, "_qc_results.parquet")
+# plates processed before the QC results were saved as Parquet only have the failing single-cells as a CSV
+failed_qc_indices_files = index_plate_files(qc_results_dir, "_failed_qc_indices.csv.gz")
+plate_names = list(converted_files)
 
-    # Load in the qc_results_path and use the indices to change the rows that match to failing QC
-    qc_failed_indices = pd.read_csv(info["qc_results_path"], compression="gzip")
 
-    # Update failed_qc for rows matching the indices in qc_failed_indices
-    converted_df.loc[qc_failed_indices["original_indices"], "failed_qc"] = True
+# In[ ]:
 
-    # Make sure that this worked by asserting that the number of True failed rows matches the number of failed indices
-    num_failed_qc = converted_df["failed_qc"].sum()
-    num_qc_failed_indices = len(qc_failed_indices)
 
-    assert (
-        num_failed_qc == num_qc_failed_indices
-    ), f"Mismatch: {num_failed_qc} != {num_qc_failed_indices}"
-
-    # Load platemap
-    platemap_df = pd.read_csv(info["platemap_path"])
+# create plate info dictionary (platemap path and time point are looked up from the cached plate registry)
+plate_info_dictionary = get_plate_info_dictionary(
+    platemap_dir=platemap_dir,
+    plate_files={
+        "converted_path": converted_files,
+        "qc_results_path": qc_results_files,
+        "failed_qc_indices_path": failed_qc_indices_files,
+    },
+    plate_names=plate_names,
+)
 
-    # Add cell line and seeding density metadata
-    annotated_df = annotate(
-        profiles=converted_df,
-        platemap=platemap_df,
-        join_on=["Metadata_well", "Image_Metadata_Well"],
-    )
+# Display the dictionary to verify the entries
+pprint.pprint(plate_info_dictionary, indent=4)
 
-    # Add 'Metadata_time_point' column based on the plate's time_point from dict
-    annotated_df["Metadata_time_point"] = info["time_point"]
-
-    # Group by cell line and seeding density, and calculate total nuclei segmented and failed QC
-    failure_stats = (
-        annotated_df.groupby(
-            [
-                "Metadata_cell_line",
-                "Metadata_seeding_density",
-                "Metadata_time_point",
-                "Metadata_condition",
-                "Metadata_Plate",
-            ]
-        )
-        .agg(
-            total_nuclei_segmented=("failed_qc", "count"),
-            total_failed_qc=("failed_qc", "sum"),
-            percentage_failing_cells=("failed_qc", "mean"),
-        )
-        .reset_index()
-    )
 
-    # Convert to percentage
-    failure_stats["percentage_failing_cells"] *= 100
+# In[ ]:
 
-    # Append to list
-    qc_report_list.append(failure_stats)
 
-# Concatenate all reports into a single DataFrame
-qc_report_df = pd.concat(qc_report_list, ignore_index=True)
+# Generate the QC report across plates in parallel, counting the single-cells segmented and failing QC
+# per well from the QC results and only joining the per-well counts to the platemap
+qc_report_df = generate_qc_report(plate_info_dictionary)
 
 # Save QC report as parquet file
 qc_report_df.to_parquet(pathlib.Path(f"{output_dir}/{round_id}_qc_report.parquet"))
@@ -184,3 +89,25 @@ filter_qc_report_df = qc_report_df[qc_report_df["Metadata_cell_line"] == "U2-OS"
 print(filter_qc_report_df.shape)
 filter_qc_report_df
 
+
+# ## Generate the QC report for all rounds with DuckDB (optional)
+
+# In[ ]:
+
+
+if query_all_rounds:
+    # Register the outputs of every round as views and generate the report with a single query
+    connection = connect()
+    registered_files = register_profile_views(
+        connection, preprocessing_dir=pathlib.Path("."), platemap_dir=platemap_dir
+    )
+    pprint.pprint(registered_files)
+
+    all_rounds_qc_report_df = query_qc_report(connection)
+    all_rounds_qc_report_df.to_parquet(
+        pathlib.Path(f"{output_dir}/all_rounds_qc_report.parquet")
+    )
+
+    print(all_rounds_qc_report_df.shape)
+    all_rounds_qc_report_df.head()
+
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Tune single-cell QC thresholds across plates
+# 
+# In this notebook, we precompute the z-scores of the QC features for every plate in a round once, and then count how many single-cells would fail each QC condition at any threshold.
+# The z-scores are sorted per plate and feature, so each count is a binary search instead of rerunning `1.sc_quality_control.ipynb` per plate with papermill.
+# The QC conditions and current thresholds are read from the metadata of the QC results files.
+
+# In[ ]:
+
+
+import pathlib
+import time
+
+import numpy as np
+import pandas as pd
+
+import sys
+
+sys.path.append("../../utils")
+from qc_threshold_utils import QCThresholdTuner
+
+
+# ## Set paths and variables
+
+# In[ ]:
+
+
+# Set the round of data to tune thresholds for
+round_id = "Round_4_data"
+
+# Directory containing the converted profiles
+converted_dir = pathlib.Path(f"../data/converted_profiles/{round_id}")
+
+# Directory containing the qc results (thresholds are stored in the file metadata)
+qc_results_dir = pathlib.Path(f"../qc_results/{round_id}")
+
+# Create dictionary of plate names to converted profiles paths
+converted_paths = {
+    file.stem.split("_")[0]: file for file in sorted(converted_dir.glob("*.parquet"))
+}
+
+print(f"There are {len(converted_paths)} plates to tune QC thresholds for.")
+
+
+# ## Precompute the z-score distributions of the QC features
+
+# In[ ]:
+
+
+# The current thresholds are read from the metadata of a QC results file, which the legacy failed QC indices
+# files do not have
+qc_results_path = next(qc_results_dir.glob("*_qc_results.parquet"), None)
+if qc_results_path is None:
+    raise FileNotFoundError(
+        f"There are no QC results files in {qc_results_dir}, re-run 1.sc_quality_control for {round_id} to "
+        "create them with the current thresholds."
+    )
+
+start_time = time.time()
+
+# Load only the QC features per plate and precompute the sorted z-scores
+tuner = QCThresholdTuner.from_qc_results(
+    converted_paths=converted_paths,
+    qc_results_path=qc_results_path,
+)
+
+print(f"Precomputed z-scores in {time.time() - start_time:.2f} seconds")
+tuner.qc_rules
+
+
+# ## Count failing single-cells at the current thresholds
+
+# In[ ]:
+
+
+# Count failing single-cells for every QC condition across all plates
+current_counts_df = pd.concat(
+    [tuner.count_failing(condition) for condition in tuner.qc_rules],
+    ignore_index=True,
+)
+
+current_counts_df.pivot(index="plate", columns="condition", values="percentage_failed")
+
+
+# ## Sweep thresholds for a QC feature
+# 
+# Example for the nuclei solidity threshold, where each threshold is counted for all plates together.
+
+# In[ ]:
+
+
+# Count failing single-cells for a range of solidity thresholds across all plates
+solidity_sweep_df = tuner.sweep(
+    condition="Failed_SolidityNuclei",
+    feature="Nuclei_AreaShape_Solidity",
+    thresholds=np.round(np.arange(-3.0, -0.9, 0.1), 2),
+)
+
+solidity_sweep_df.pivot(
+    index="Nuclei_AreaShape_Solidity_threshold",
+    columns="plate",
+    values="percentage_failed",
+)
+
@@ -31,7 +31,8 @@ for plate in "${plates[@]}"; do
     papermill \
     0.convert_cytotable.ipynb \
     0.convert_cytotable.ipynb \
-    -p plate_id $plate
+    -p plate_id $plate \
+    -p round_id $ROUND
 done
 
 # Using papermill, run single cell quality control on all plates
@@ -39,10 +40,14 @@ for plate in "${plates[@]}"; do
     papermill \
     1.sc_quality_control.ipynb \
     1.sc_quality_control.ipynb \
-    -p plate_id $plate
+    -p plate_id $plate \
+    -p round_id $ROUND
 done
 
-# Run the rest of the preprocessing and reporting
-python nbconverted/2.bulk_processing.py
-python nbconverted/3.single_cell_processing.py
-python nbconverted/4.sc_qc_report.py
+# Using papermill, run the rest of the preprocessing and reporting for the round
+for notebook in 2.bulk_processing.ipynb 3.single_cell_processing.ipynb 4.sc_qc_report.ipynb; do
+    papermill \
+    $notebook \
+    $notebook \
+    -p round_id $ROUND
+done
@@ -1,92 +1,85 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-# In[1]:
+# In[ ]:
 
 
 import pathlib
-import numpy as np
 import pandas as pd
 
+import sys
 
-# In[2]:
+sys.path.append("../utils")
+from control_comparison_utils import cached_compare_to_control
+from permutation_utils import permutation_test
+from plate_registry import index_plate_files
+from results_store import PlateResultsStore
+from shuffle_utils import shuffle_profiles_within_groups
+from similarity_utils import SIMILARITY_METRICS, PairwiseSimilarity, mean_average_precision
 
 
-from comparators.PearsonsCorrelation import PearsonsCorrelation
-from comparison_tools.PairwiseCompareManager import PairwiseCompareManager
-
-
-# In[3]:
+# In[ ]:
 
 
 # output path for bulk profiles
 output_dir = pathlib.Path("../3.preprocessing_features/data/bulk_profiles")
-output_dir.mkdir(parents=True, exist_ok=True)
 
-# extract the plate names from the file name
-plate_names = set([file.stem.split("_")[0] for file in output_dir.glob("*.parquet")])
+# index the feature-selected bulk profiles of every round by plate name
+bulk_files = index_plate_files(output_dir, "_bulk_feature_selected.parquet")
+plate_names = list(bulk_files)
 
-for plate in plate_names:
-    output_feature_select_file = str(
-            pathlib.Path(f"{output_dir}/{plate}_bulk_feature_selected.parquet")
-        )
+for plate, output_feature_select_file in bulk_files.items():
     print(output_feature_select_file)
 
 
-# In[4]:
+# In[ ]:
 
 
-combined_results = []
-
-for plate in plate_names:
-    output_feature_select_file = str(
-        pathlib.Path(f"{output_dir}/{plate}_bulk_feature_selected.parquet")
-    )
+def compare_plate_replicates(plate: str, output_feature_select_file: pathlib.Path) -> pd.DataFrame:
     plate_df = pd.read_parquet(output_feature_select_file)
     feat_cols = plate_df.columns[~plate_df.columns.str.contains("Metadata")].tolist()
     
-    # Create a shuffled copy of the data
-    shuffled_plate_df = plate_df.copy()
-    unique_time_points = plate_df["Metadata_time_point"].unique()
-
-    # Shuffle feature columns within each time point
-    for time_point in unique_time_points:
-        mask = plate_df["Metadata_time_point"] == time_point
-        for col in feat_cols:
-            shuffled_plate_df.loc[mask, col] = (
-                plate_df.loc[mask, col]
-                .sample(frac=1, random_state=42)  # Add `random_state` for reproducibility
-                .values
-            )
+    # Create a shuffled copy of the data, where every feature column is permuted independently
+    # within each time point in one operation (seeded for reproducibility)
+    shuffled_plate_df = shuffle_profiles_within_groups(
+        plate_df,
+        feature_columns=feat_cols,
+        group_columns=["Metadata_time_point"],
+        seed=42,
+    )
 
     # Add a column to indicate shuffled/unshuffled
     plate_df["Shuffled"] = "False"
     shuffled_plate_df["Shuffled"] = "True"
 
-    # Include Metadata_seeding_density in both datasets
-    plate_df["Metadata_seeding_density"] = plate_df["Metadata_seeding_density"]
-    shuffled_plate_df["Metadata_seeding_density"] = shuffled_plate_df["Metadata_seeding_density"]
-
     # Combine original and shuffled data
     combined_plate_df = pd.concat([plate_df, shuffled_plate_df], ignore_index=True)
     
-    # Perform pairwise comparison on the combined data
-    pearsons_comparator = PearsonsCorrelation()
-
-    comparer = PairwiseCompareManager(
-        _df=combined_plate_df.copy(),
-        _comparator=pearsons_comparator,
-        _same_columns=["Metadata_cell_line", "Metadata_seeding_density", "Metadata_time_point", "Shuffled"],
-        _different_columns=["Metadata_Well"],
-        _feat_cols=feat_cols,
-        _drop_cols=["Metadata_Concentration", "Metadata_Well"],
+    # Compute the Pearson and Spearman correlations and cosine similarities between wells in the same group
+    # from one normalized matrix per metric (same output columns as PairwiseCompareManager with
+    # PearsonsCorrelation, with a column per metric)
+    comparer = PairwiseSimilarity(
+        profiles=combined_plate_df,
+        feature_columns=feat_cols,
+        same_columns=["Metadata_cell_line", "Metadata_seeding_density", "Metadata_time_point", "Shuffled"],
+        different_columns=["Metadata_Well"],
+        drop_columns=["Metadata_Concentration", "Metadata_Well"],
+        metrics=SIMILARITY_METRICS,
     )
 
-    micdf = comparer()
-    combined_results.append(micdf)
+    return comparer()
 
-# Combine all results into a single dataframe
-final_combined_df = pd.concat(combined_results, axis=0)
+
+# Results are saved per plate with the hash of the plate's profiles, so only new or changed plates
+# (e.g., a new round) are recomputed
+results_store = PlateResultsStore(
+    pathlib.Path("./results/pairwise_compare"), parameters={"shuffle_seed": 42, "metrics": SIMILARITY_METRICS}
+)
+recomputed_plates = results_store.update(bulk_files, compare_plate_replicates)
+print(f"Recomputed {len(recomputed_plates)} of {len(bulk_files)} plates")
+
+# Combine the results of all plates into a single dataframe
+final_combined_df = results_store.read(plate_names)
 
 
 # In[5]:
@@ -97,7 +90,7 @@ save_dir = pathlib.Path("./results/pairwise_compare.parquet")
 final_combined_df.to_parquet(save_dir)
 
 
-# In[6]:
+# In[ ]:
 
 
 avg_results = (
@@ -107,7 +100,7 @@ avg_results = (
          "Metadata_time_point__antehoc_group0",
          "Shuffled__antehoc_group0"
          ]
-    )["pearsons_correlation"]
+    )[SIMILARITY_METRICS]
     .mean()
     .reset_index()
 )
@@ -168,46 +161,126 @@ top_difference_results = top_difference_results[
 top_difference_results.head(18)
 
 
-# In[7]:
+# ## Mean average precision of replicate wells
+# 
+# For each condition, every well is used as a query that ranks all other wells on the plate (shuffled and unshuffled profiles separately) by Pearson correlation, and the average precision of retrieving the replicate wells is averaged per condition.
 
+# In[ ]:
 
-controlled_results = []
 
-for plate in plate_names:
-    output_feature_select_file = str(
-        pathlib.Path(f"{output_dir}/{plate}_bulk_feature_selected.parquet")
-    )
+def plate_mean_average_precision(plate: str, output_feature_select_file: pathlib.Path) -> pd.DataFrame:
     plate_df = pd.read_parquet(output_feature_select_file)
     feat_cols = plate_df.columns[~plate_df.columns.str.contains("Metadata")].tolist()
 
-    # Include Metadata_seeding_density in both datasets
-    plate_df["Metadata_seeding_density"] = plate_df["Metadata_seeding_density"]
+    shuffled_plate_df = shuffle_profiles_within_groups(
+        plate_df,
+        feature_columns=feat_cols,
+        group_columns=["Metadata_time_point"],
+        seed=42,
+    )
+    plate_df["Shuffled"] = "False"
+    shuffled_plate_df["Shuffled"] = "True"
+    combined_plate_df = pd.concat([plate_df, shuffled_plate_df], ignore_index=True)
+
+    map_df = mean_average_precision(
+        combined_plate_df,
+        feature_columns=feat_cols,
+        condition_columns=["Metadata_cell_line", "Metadata_seeding_density", "Metadata_time_point"],
+        reference_columns=["Shuffled"],
+    )
+    map_df.insert(0, "Metadata_Plate", plate)
+
+    return map_df
+
+
+map_store = PlateResultsStore(
+    pathlib.Path("./results/mean_average_precision"), parameters={"shuffle_seed": 42}
+)
+map_store.update(bulk_files, plate_mean_average_precision)
+
+map_df = map_store.read(plate_names)
+map_df.to_parquet(pathlib.Path("./results/mean_average_precision.parquet"))
+
+map_df[map_df["Shuffled"] == "False"].sort_values(
+    by="mean_average_precision", ascending=False
+).head(18)
+
+
+# ## Permutation testing of replicate reproducibility
+# 
+# For each condition (cell line, seeding density, and time point), the mean Pearson correlation between replicate wells is compared to a null distribution from shuffling the features within each time point many times.
+
+# In[ ]:
+
+
+# number of shuffles in the null distribution of each condition and the number of parallel processes
+# (None uses the number of CPUs)
+num_permutations = 1000
+permutation_workers = None
+
+# the permutations of a plate are only recomputed if its bulk profiles or the permutation parameters changed
+permutation_parameters = {
+    "num_permutations": num_permutations,
+    "seed": 42,
+    "condition_columns": ["Metadata_cell_line", "Metadata_seeding_density", "Metadata_time_point"],
+    "shuffle_columns": ["Metadata_time_point"],
+}
+summary_store = PlateResultsStore(
+    pathlib.Path("./results/permutation_summary"), parameters=permutation_parameters
+)
+null_store = PlateResultsStore(
+    pathlib.Path("./results/permutation_null"), parameters=permutation_parameters
+)
+
+for plate in plate_names:
+    if summary_store.is_current(plate, bulk_files[plate]) and null_store.is_current(
+        plate, bulk_files[plate]
+    ):
+        continue
+    print(f"Computing permutations for {plate}")
+
+    plate_df = pd.read_parquet(bulk_files[plate])
+    feat_cols = plate_df.columns[~plate_df.columns.str.contains("Metadata")].tolist()
+
+    summary_df, null_df = permutation_test(
+        profiles=plate_df,
+        feature_columns=feat_cols,
+        max_workers=permutation_workers,
+        **permutation_parameters,
+    )
+    summary_df.insert(0, "Metadata_Plate", plate)
+    null_df.insert(0, "Metadata_Plate", plate)
+
+    summary_store.write(plate, bulk_files[plate], summary_df)
+    null_store.write(plate, bulk_files[plate], null_df)
 
-    # Define the control cell line
-    control_cell_line = "U2OS"
+permutation_summary_df = summary_store.read(plate_names).reset_index(drop=True)
+permutation_null_df = null_store.read(plate_names).reset_index(drop=True)
 
-    # Get unique cell lines excluding the control
-    cell_lines = plate_df["Metadata_cell_line"].unique()
-    cell_lines = [cl for cl in cell_lines if cl != control_cell_line]
+# Save the p-values and null distributions of every condition
+permutation_summary_df.to_parquet(pathlib.Path("./results/permutation_test_summary.parquet"))
+permutation_null_df.to_parquet(pathlib.Path("./results/permutation_null_distributions.parquet"))
 
-    for cell_line in cell_lines:
+permutation_summary_df.sort_values(by="p_value").head(18)
 
-        # Subset data for the target cell line and U2OS
-        subset_df = plate_df[plate_df["Metadata_cell_line"].isin([cell_line, control_cell_line])]
-        # Perform pairwise comparison on the combined data
-        pearsons_comparator = PearsonsCorrelation()
 
-        comparer = PairwiseCompareManager(
-            _df=subset_df.copy(),
-            _comparator=pearsons_comparator,
-            _same_columns=[],
-            _different_columns=["Metadata_cell_line", "Metadata_seeding_density", "Metadata_time_point", "Metadata_Well"],
-            _feat_cols=feat_cols,
-            _drop_cols=["Metadata_Concentration", "Metadata_Well"],
-        )
+# In[ ]:
 
-        micdf = comparer()
-        controlled_results.append(micdf)
+
+# Define the control cell line (as written in the platemaps)
+control_cell_line = "U2-OS"
+
+controlled_results = []
+
+# Compare the wells of every cell line on each plate to the control wells with one matrix product per plate
+# (the results are cached per plate and recomputed when the profiles or comparison parameters change)
+for plate in plate_names:
+    micdf = cached_compare_to_control(
+        profile_path=bulk_files[plate],
+        cache_dir=pathlib.Path("./results/control_comparisons"),
+        control_cell_line=control_cell_line,
+    )
+    controlled_results.append(micdf)
 
 # Combine all results into a single dataframe
 final_control_df = pd.concat(controlled_results, axis=0)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Single-cell reproducibility of seeding densities and time points
+# 
+# A fixed number of cells is sampled from every well of each plate (streaming the single-cell profiles so the full plate is never loaded), and the similarities between cells of the same cell line in different wells (within condition) are compared to the similarities with cells of other cell lines at the same seeding density and time point (across condition).
+
+# In[ ]:
+
+
+import pathlib
+import pandas as pd
+import pyarrow.parquet as pq
+
+import sys
+
+sys.path.append("../utils")
+from plate_registry import index_plate_files
+from results_store import PlateResultsStore
+from sc_reproducibility_utils import sample_cells_per_well, similarity_histograms, summarize_similarity_histograms
+
+
+# In[ ]:
+
+
+# number of cells sampled from each well, seed of the sampling, and number of cells compared to all cells at a time
+cells_per_well = 50
+sampling_seed = 0
+chunk_size = 1000
+
+condition_columns = ["Metadata_cell_line", "Metadata_seeding_density", "Metadata_time_point"]
+reference_columns = ["Metadata_seeding_density", "Metadata_time_point"]
+
+# index the feature-selected single-cell profiles of every round by plate name
+sc_dir = pathlib.Path("../3.preprocessing_features/data/single_cell_profiles")
+sc_files = index_plate_files(sc_dir, "_sc_feature_selected.parquet")
+plate_names = list(sc_files)
+
+print(f"Found {len(sc_files)} plates with single-cell profiles")
+
+
+# In[ ]:
+
+
+def plate_similarity_histograms(plate: str, sc_file: pathlib.Path) -> pd.DataFrame:
+    # only the metadata used for grouping and the features are read
+    columns = pq.read_schema(sc_file).names
+    feat_cols = [column for column in columns if "Metadata" not in column]
+
+    sampled_df = sample_cells_per_well(
+        sc_file,
+        cells_per_well=cells_per_well,
+        columns=["Metadata_Well"] + condition_columns + feat_cols,
+        seed=sampling_seed,
+    )
+
+    histogram_df = similarity_histograms(
+        sampled_df,
+        feature_columns=feat_cols,
+        condition_columns=condition_columns,
+        reference_columns=reference_columns,
+        chunk_size=chunk_size,
+    )
+    histogram_df.insert(0, "Metadata_Plate", plate)
+
+    return histogram_df
+
+
+# Histograms are saved per plate with the hash of the plate's profiles, so only new or changed plates are computed
+results_store = PlateResultsStore(
+    pathlib.Path("./results/sc_similarity_histograms"),
+    parameters={"cells_per_well": cells_per_well, "sampling_seed": sampling_seed},
+)
+recomputed_plates = results_store.update(sc_files, plate_similarity_histograms)
+print(f"Recomputed {len(recomputed_plates)} of {len(sc_files)} plates")
+
+sc_histogram_df = results_store.read(plate_names)
+sc_histogram_df.to_parquet(pathlib.Path("./results/sc_similarity_histograms.parquet"))
+
+
+# In[ ]:
+
+
+# Summarize the similarities of each condition across plates
+sc_summary_df = summarize_similarity_histograms(sc_histogram_df, group_columns=condition_columns)
+
+# Difference between the mean similarity within a condition (different wells) and across conditions
+sc_difference_df = sc_summary_df.pivot_table(
+    index=condition_columns, columns="pair_type", values="mean_similarity"
+).rename_axis(columns=None).reset_index()
+sc_difference_df["similarity_difference"] = (
+    sc_difference_df["within_condition"] - sc_difference_df["across_condition"]
+)
+sc_difference_df.to_parquet(pathlib.Path("./results/sc_reproducibility_summary.parquet"))
+
+# Top seeding density and time point of each cell line
+sc_difference_df.loc[
+    sc_difference_df.groupby("Metadata_cell_line")["similarity_difference"].idxmax()
+]
+
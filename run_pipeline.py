@@ -0,0 +1,79 @@
+"""
+Run the pipeline for one or more rounds of data, only running the tasks (per plate or per round) whose inputs or
+outputs changed since they last completed.
+
+Example (from the root of the repository):
+
+    python run_pipeline.py --rounds Round_4_data --max_workers 4
+    python run_pipeline.py --rounds Round_4_data --dry_run
+"""
+
+import argparse
+import pathlib
+import sys
+
+sys.path.append(str(pathlib.Path(__file__).parent / "utils"))
+from pipeline_runner import PipelineRunner, build_optimization_task, build_round_tasks
+from plate_registry import index_plate_files
+
+repo_dir = pathlib.Path(__file__).parent.resolve()
+
+parser = argparse.ArgumentParser(
+    description="Run the stale tasks of the pipeline for rounds of data"
+)
+parser.add_argument(
+    "--rounds", nargs="+", required=True, help="Rounds of data (e.g., Round_4_data)"
+)
+parser.add_argument(
+    "--plates",
+    nargs="+",
+    default=None,
+    help="Plate barcodes (only with one round), found from the LoadData CSVs of the round if not given",
+)
+parser.add_argument(
+    "--max_workers", type=int, default=4, help="Maximum number of tasks run at a time"
+)
+parser.add_argument(
+    "--dry_run", action="store_true", help="Print the stale tasks without running them"
+)
+parser.add_argument(
+    "--state_path",
+    type=pathlib.Path,
+    default=repo_dir / "pipeline_state" / "state.json",
+    help="JSON file with the hashes of the completed tasks",
+)
+args = parser.parse_args()
+
+if args.plates is not None and len(args.rounds) > 1:
+    parser.error("--plates can only be used with one round")
+
+tasks = []
+for round_id in args.rounds:
+    plates = args.plates or list(
+        index_plate_files(
+            repo_dir / "1.illumination_correction" / "loaddata_csvs" / round_id,
+            "_concatenated.csv",
+        )
+    )
+    if not plates:
+        parser.error(
+            f"No plates found for {round_id}, so create the LoadData CSVs or use --plates"
+        )
+    print(f"{round_id}: {len(plates)} plates")
+    tasks += build_round_tasks(repo_dir, round_id, plates)
+tasks.append(build_optimization_task(repo_dir, args.rounds))
+
+runner = PipelineRunner(tasks, state_path=args.state_path)
+
+if args.dry_run:
+    stale_tasks = runner.stale_tasks()
+    print(f"{len(stale_tasks)} of {len(runner.tasks)} tasks are stale:")
+    for name in stale_tasks:
+        print(f"- {name}")
+else:
+    summary_df = runner.run(max_workers=args.max_workers)
+    print(summary_df["status"].value_counts())
+    failed_df = summary_df[summary_df["status"] == "failed"]
+    if not failed_df.empty:
+        print(failed_df[["task", "error"]].to_string(index=False))
+        sys.exit(1)
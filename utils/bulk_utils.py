@@ -0,0 +1,77 @@
+"""
+This collection of functions creates bulk (well-level) profiles from single-cell Parquet files without loading
+the full single-cell matrix into memory.
+"""
+
+import pathlib
+from typing import List, Union
+
+import pandas as pd
+import pyarrow.parquet as pq
+from pycytominer.cyto_utils import infer_cp_features
+
+
+def infer_parquet_features(profile_path: pathlib.Path) -> List[str]:
+    """Infer the CellProfiler feature columns of a Parquet file from its schema without reading the data.
+
+    Args:
+        profile_path (pathlib.Path): Path to the Parquet file with single-cell profiles.
+
+    Returns:
+        List[str]: List of feature column names (Cells, Cytoplasm, and Nuclei compartments).
+    """
+    empty_df = pq.read_schema(profile_path).empty_table().to_pandas()
+
+    return infer_cp_features(empty_df)
+
+
+def aggregate_median_from_parquet(
+    profile_path: pathlib.Path,
+    strata: List[str] = ["Image_Metadata_Plate", "Image_Metadata_Well"],
+    features: Union[str, List[str]] = "infer",
+    columns_per_batch: int = 250,
+) -> pd.DataFrame:
+    """Compute the exact median of each feature per strata (e.g., well) by reading the Parquet file in batches
+    of columns, so only the strata and one batch of features are in memory at once.
+
+    The output matches pycytominer `aggregate(operation="median")`, since medians are computed independently per
+    feature with the same pandas group-by.
+
+    Args:
+        profile_path (pathlib.Path): Path to the Parquet file with single-cell profiles.
+        strata (List[str], optional): Columns to group by. Defaults to ["Image_Metadata_Plate", "Image_Metadata_Well"].
+        features (Union[str, List[str]], optional): Features to aggregate. Defaults to "infer", which infers the
+            CellProfiler features from the file schema.
+        columns_per_batch (int, optional): Number of feature columns to read at a time. Defaults to 250.
+
+    Returns:
+        pd.DataFrame: Dataframe with one row per strata group and the median of each feature, in the dtype of
+            the feature for float features.
+    """
+    if features == "infer":
+        features = infer_parquet_features(profile_path)
+
+    strata_df = pd.read_parquet(profile_path, columns=strata)
+
+    aggregated_batches = []
+    for batch_start in range(0, len(features), columns_per_batch):
+        batch_features = features[batch_start : batch_start + columns_per_batch]
+
+        # read only this batch of features (Parquet stores each column separately)
+        batch_df = pd.read_parquet(profile_path, columns=batch_features)
+
+        # compute the medians in float64 and cast them back so float32 features stay float32 (integer features
+        # stay float, since their medians can be halfway between values)
+        float_dtypes = {
+            feature: dtype
+            for feature, dtype in batch_df.dtypes.items()
+            if pd.api.types.is_float_dtype(dtype)
+        }
+        aggregated_batches.append(
+            pd.concat([strata_df, batch_df.astype(float)], axis="columns")
+            .groupby(strata, dropna=False, observed=True)
+            .median()
+            .astype(float_dtypes)
+        )
+
+    return pd.concat(aggregated_batches, axis="columns").reset_index()
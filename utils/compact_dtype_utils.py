@@ -0,0 +1,133 @@
+"""
+This collection of functions converts single-cell profiles to compact data types for storage and processing.
+Features are downcast from float64 to float32 when the precision loss is negligible compared to the spread of the
+feature, string metadata is stored as categoricals (dictionary-encoded in Parquet), and integer columns are
+downcast to the smallest type that holds their values. A validation report records the maximum absolute error of
+every downcast feature.
+"""
+
+import pathlib
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+from pycytominer.cyto_utils import infer_cp_features
+
+
+def compact_profiles(
+    profiles: pd.DataFrame,
+    features: Union[str, List[str]] = "infer",
+    max_relative_error: float = 1e-6,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Convert profiles to compact data types and report the precision lost for each feature.
+
+    A float64 feature is downcast to float32 if the maximum absolute error from the conversion is at most
+    `max_relative_error` times the standard deviation of the feature, otherwise it is kept as float64.
+
+    Args:
+        profiles (pd.DataFrame): Bulk or single-cell profiles.
+        features (Union[str, List[str]], optional): Features that can be downcast to float32.
+            Defaults to "infer", which infers the CellProfiler features.
+        max_relative_error (float, optional): Maximum absolute error allowed from downcasting a feature,
+            relative to its standard deviation. Defaults to 1e-6.
+
+    Returns:
+        Tuple[pd.DataFrame, pd.DataFrame]: Profiles with compact data types and the validation report with one
+            row per feature (original and compact data type, maximum absolute error of the float32 values,
+            standard deviation, and whether the feature was downcast).
+    """
+    if features == "infer":
+        features = infer_cp_features(profiles)
+    feature_set = set(features)
+
+    compact_columns = {}
+    report_rows = []
+    for column in profiles.columns:
+        values = profiles[column]
+
+        if column in feature_set and values.dtype == np.float64:
+            float64_values = values.to_numpy()
+            float32_values = float64_values.astype(np.float32)
+            with np.errstate(invalid="ignore"):
+                errors = np.abs(float32_values.astype(np.float64) - float64_values)
+            # NaN and infinite values are kept exactly, so they do not add to the error
+            max_abs_error = (
+                float(np.nanmax(errors[np.isfinite(float64_values)]))
+                if np.isfinite(float64_values).any()
+                else 0.0
+            )
+            std = float(np.nanstd(float64_values))
+            downcast = max_abs_error <= max_relative_error * std
+
+            compact_columns[column] = (
+                pd.Series(float32_values, index=values.index, name=column)
+                if downcast
+                else values
+            )
+            report_rows.append(
+                {
+                    "feature": column,
+                    "original_dtype": str(values.dtype),
+                    "compact_dtype": "float32" if downcast else "float64",
+                    "max_abs_error": max_abs_error,
+                    "std": std,
+                    "downcast": downcast,
+                }
+            )
+        elif column not in feature_set and pd.api.types.is_string_dtype(values.dtype):
+            # strings repeat for every single-cell of a well or plate, so store each value once
+            compact_columns[column] = values.astype("category")
+        elif values.dtype.kind in "iu" or (
+            column not in feature_set
+            and values.dtype.kind == "f"
+            and values.notna().all()
+            and (values % 1 == 0).all()
+        ):
+            # integer metadata (e.g., Metadata_ImageNumber) is often stored as float64 after missing rows are dropped
+            compact_columns[column] = pd.to_numeric(
+                values,
+                downcast="unsigned" if values.size and values.min() >= 0 else "integer",
+            )
+        else:
+            compact_columns[column] = values
+
+    compact_df = pd.DataFrame(compact_columns, index=profiles.index)
+    report_df = pd.DataFrame(
+        report_rows,
+        columns=[
+            "feature",
+            "original_dtype",
+            "compact_dtype",
+            "max_abs_error",
+            "std",
+            "downcast",
+        ],
+    )
+
+    return compact_df, report_df
+
+
+def write_compact_report(
+    report_df: pd.DataFrame,
+    output_path: pathlib.Path,
+    plate_id: Optional[str] = None,
+) -> None:
+    """Save the validation report of a compact conversion to CSV and print a summary.
+
+    Args:
+        report_df (pd.DataFrame): Validation report from `compact_profiles`.
+        output_path (pathlib.Path): Path to save the report CSV file.
+        plate_id (Optional[str], optional): Plate ID added as a column to the report. Defaults to None.
+    """
+    if plate_id is not None:
+        report_df = report_df.assign(Metadata_Plate=plate_id)
+
+    pathlib.Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    report_df.to_csv(output_path, index=False)
+
+    downcast_df = report_df.loc[report_df["downcast"]]
+    max_abs_error = downcast_df["max_abs_error"].max() if downcast_df.shape[0] else 0.0
+    print(
+        f"Downcast {downcast_df.shape[0]} of {report_df.shape[0]} features to float32 "
+        f"(max absolute error {max_abs_error:.3g})"
+    )
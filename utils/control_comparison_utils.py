@@ -0,0 +1,140 @@
+"""
+This collection of functions compares the profiles of every cell line on a plate to the control cell line (U2-OS).
+The profiles are centered and scaled once per plate, and every cell line well is compared to all control wells
+with one matrix product. Results are cached per plate and only recomputed when the plate's profiles or the
+comparison parameters change.
+"""
+
+import inspect
+import json
+import pathlib
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+from correlation_utils import standardize_rows
+from results_store import PlateResultsStore
+
+# metadata columns saved for both profiles of each comparison
+CONTROL_COMPARISON_COLUMNS = [
+    "Metadata_cell_line",
+    "Metadata_seeding_density",
+    "Metadata_time_point",
+]
+
+
+def compare_to_control(
+    profiles: pd.DataFrame,
+    feature_columns: List[str],
+    control_cell_line: str = "U2-OS",
+    metadata_columns: List[str] = CONTROL_COMPARISON_COLUMNS,
+    match_columns: Optional[List[str]] = None,
+    comparison_name: str = "pearsons_correlation",
+) -> pd.DataFrame:
+    """Compute the Pearson correlation of every well of each cell line with every control well on a plate.
+
+    Args:
+        profiles (pd.DataFrame): Profiles of one plate with the Metadata_cell_line column.
+        feature_columns (List[str]): Feature columns used for the correlations.
+        control_cell_line (str, optional): Name of the control cell line as written in the platemaps.
+            Defaults to "U2-OS".
+        metadata_columns (List[str], optional): Metadata columns saved for both profiles of each comparison.
+            Defaults to CONTROL_COMPARISON_COLUMNS.
+        match_columns (Optional[List[str]], optional): Columns whose values must be the same for a cell line
+            well and a control well to be compared (e.g., ["Metadata_seeding_density"]). Defaults to None, which
+            compares every pair.
+        comparison_name (str, optional): Name of the correlation column. Defaults to "pearsons_correlation".
+
+    Returns:
+        pd.DataFrame: Dataframe with the correlation column and the `{column}__posthoc_group0` (cell line) and
+            `{column}__posthoc_group1` (control) columns, with one row per pair of wells. Empty if the plate does
+            not have the control cell line.
+    """
+    output_columns = [comparison_name] + [
+        f"{column}__posthoc_group{group_index}"
+        for column in metadata_columns
+        for group_index in range(2)
+    ]
+
+    is_control = (profiles["Metadata_cell_line"] == control_cell_line).to_numpy()
+    if not is_control.any():
+        return pd.DataFrame(columns=output_columns)
+
+    # the profiles are only standardized once for all cell lines
+    standardized = standardize_rows(profiles[feature_columns].to_numpy())
+    control_rows = np.flatnonzero(is_control)
+
+    # rows of the other cell lines, grouped by cell line in sorted order
+    cell_lines = profiles["Metadata_cell_line"].to_numpy()
+    rows = np.flatnonzero(
+        ~is_control & profiles["Metadata_cell_line"].notna().to_numpy()
+    )
+    rows = rows[np.argsort(cell_lines[rows].astype(str), kind="stable")]
+
+    # Pearson correlations of every cell line well (rows) with every control well (columns)
+    correlations = standardized[rows] @ standardized[control_rows].T
+
+    keep = np.ones(correlations.shape, dtype=bool)
+    for column in match_columns or []:
+        values = profiles[column].to_numpy()
+        keep &= values[rows][:, np.newaxis] == values[control_rows][np.newaxis, :]
+    row0, row1 = np.nonzero(keep)
+
+    comparisons_df = pd.DataFrame({comparison_name: correlations[row0, row1]})
+    for column in metadata_columns:
+        for group_index, pair_rows in enumerate([rows[row0], control_rows[row1]]):
+            comparisons_df[f"{column}__posthoc_group{group_index}"] = (
+                profiles[column].iloc[pair_rows].to_numpy()
+            )
+
+    return comparisons_df[output_columns]
+
+
+def cached_compare_to_control(
+    profile_path: pathlib.Path,
+    cache_dir: pathlib.Path,
+    overwrite: bool = False,
+    **compare_kwargs,
+) -> pd.DataFrame:
+    """Compare a plate's cell lines to the control, reusing the cached results if the profiles and the comparison
+    parameters did not change.
+
+    Args:
+        profile_path (pathlib.Path): Path to the plate's profiles (e.g., `{plate}_bulk_feature_selected.parquet`).
+        cache_dir (pathlib.Path): Directory of the cached results (a `PlateResultsStore` keyed by the profile file
+            name, with the hash of the profiles and the comparison parameters).
+        overwrite (bool, optional): Whether to recompute the results even if they are cached. Defaults to False.
+        **compare_kwargs: Keyword arguments passed to `compare_to_control` (feature_columns is inferred from the
+            columns without "Metadata" if not given).
+
+    Returns:
+        pd.DataFrame: Comparisons to the control (see `compare_to_control`).
+    """
+    profile_path = pathlib.Path(profile_path)
+
+    # the cache is keyed on every comparison parameter, including the defaults, so changing any of them (e.g.,
+    # match_columns) recomputes the results (JSON round trip so the parameters compare equal to the manifest)
+    parameters = {
+        name: parameter.default
+        for name, parameter in inspect.signature(compare_to_control).parameters.items()
+        if parameter.default is not inspect.Parameter.empty
+    }
+    parameters.update(compare_kwargs)
+    results_store = PlateResultsStore(
+        cache_dir, parameters=json.loads(json.dumps(parameters, default=str))
+    )
+
+    if not overwrite and results_store.is_current(profile_path.stem, profile_path):
+        return results_store.read([profile_path.stem])
+
+    profiles = pd.read_parquet(profile_path)
+    if "feature_columns" not in compare_kwargs:
+        compare_kwargs["feature_columns"] = profiles.columns[
+            ~profiles.columns.str.contains("Metadata")
+        ].tolist()
+
+    comparisons_df = compare_to_control(profiles=profiles, **compare_kwargs)
+    results_store.write(profile_path.stem, profile_path, comparisons_df)
+
+    return comparisons_df
@@ -0,0 +1,193 @@
+"""
+This collection of functions computes pairwise Pearson correlations between profiles with matrix products instead of
+comparing every pair of groups separately. Each profile is centered and scaled to unit norm once, so the Pearson
+correlations of all profiles in a group are one matrix product, and the pairs to keep are selected with integer
+group codes. The output has the same rows and columns as pairwise_compare `PairwiseCompareManager` with
+`PearsonsCorrelation` (e.g., `Metadata_cell_line__antehoc_group0`), so downstream code does not change.
+"""
+
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+
+def standardize_rows(features: np.ndarray) -> np.ndarray:
+    """Center each profile (row) by its mean across features and scale it to unit norm.
+
+    The Pearson correlation of two profiles is the dot product of their standardized rows.
+
+    Args:
+        features (np.ndarray): Matrix of profiles (rows) by features (columns).
+
+    Returns:
+        np.ndarray: Standardized matrix (float64).
+    """
+    centered = np.asarray(features, dtype=np.float64)
+    centered = centered - centered.mean(axis=1, keepdims=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return centered / np.linalg.norm(centered, axis=1, keepdims=True)
+
+
+def _group_codes(profiles: pd.DataFrame, columns: List[str]) -> np.ndarray:
+    """Integer code of each row's combination of column values, in sorted order (-1 for missing values)."""
+    return profiles.groupby(columns, sort=True).ngroup().to_numpy()
+
+
+class PairwisePearson:
+    """
+    Pearson correlations between profiles in the same groups (e.g., cell line, seeding density, and time point)
+    and different groups of other columns (e.g., well), computed with one matrix product per group.
+
+    The pairs and their metadata are found once, so the correlations can be recomputed cheaply for other feature
+    matrices with the same rows (e.g., shuffled profiles).
+
+    Attributes:
+        same_columns (List[str]): Sorted columns whose values are the same for both profiles of a pair.
+        different_columns (List[str]): Sorted columns whose values are all different for both profiles of a pair.
+        comparison_name (str): Name of the correlation column in the output.
+        features (np.ndarray): Matrix of profiles by features used by default.
+        pair_metadata (pd.DataFrame): Group columns of every pair, in the output order.
+        pair_group_codes (np.ndarray): Index of the same group (row of `group_metadata`) of every pair.
+        group_metadata (pd.DataFrame): Same columns of each group, in sorted order.
+    """
+
+    def __init__(
+        self,
+        profiles: pd.DataFrame,
+        feature_columns: List[str],
+        same_columns: List[str],
+        different_columns: List[str],
+        drop_columns: Optional[List[str]] = None,
+        comparison_name: str = "pearsons_correlation",
+    ):
+        """
+        Args:
+            profiles (pd.DataFrame): Profiles with the feature and group columns.
+            feature_columns (List[str]): Feature columns used for the correlations.
+            same_columns (List[str]): Columns whose values must be the same for both profiles of a pair.
+            different_columns (List[str]): Columns whose values must all be different for both profiles of a pair.
+            drop_columns (Optional[List[str]], optional): Group columns not saved in the output.
+                Defaults to None.
+            comparison_name (str, optional): Name of the correlation column in the output.
+                Defaults to "pearsons_correlation".
+
+        Raises:
+            ValueError: If no same or different columns are given, or a column is in both.
+        """
+        # same sorted order of the group columns as PairwiseCompareManager
+        self.same_columns = sorted(set(same_columns))
+        self.different_columns = sorted(set(different_columns))
+        self.comparison_name = comparison_name
+
+        if not self.same_columns or not self.different_columns:
+            raise ValueError(
+                "At least one same column and one different column are required."
+            )
+        if set(self.same_columns) & set(self.different_columns):
+            raise ValueError(
+                "same_columns and different_columns cannot have any columns in common."
+            )
+
+        self.features = profiles[feature_columns].to_numpy()
+
+        same_codes = _group_codes(profiles, self.same_columns)
+        different_codes = _group_codes(profiles, self.different_columns)
+        # each different column is also compared separately, since all of its values must differ in a pair
+        column_codes = [
+            _group_codes(profiles, [column]) for column in self.different_columns
+        ]
+
+        # rows of each same group, and the positions of the pairs within each group
+        self._group_rows: List[np.ndarray] = []
+        self._group_pairs: List[np.ndarray] = []
+        for same_code in np.unique(same_codes[same_codes >= 0]):
+            rows = np.flatnonzero((same_codes == same_code) & (different_codes >= 0))
+            if rows.size == 0:
+                continue
+            # sort the rows by different group, keeping the row order within each group
+            rows = rows[np.argsort(different_codes[rows], kind="stable")]
+            codes = different_codes[rows]
+
+            keep = codes[:, np.newaxis] < codes[np.newaxis, :]
+            for column_code in column_codes:
+                keep &= (
+                    column_code[rows][:, np.newaxis] != column_code[rows][np.newaxis, :]
+                )
+            row0, row1 = np.nonzero(keep)
+
+            # order the pairs by both groups first, then by the rows in each group
+            order = np.lexsort((row1, row0, codes[row1], codes[row0]))
+            self._group_rows.append(rows)
+            self._group_pairs.append(np.stack([row0[order], row1[order]]))
+
+        self.pair_group_codes = np.repeat(
+            np.arange(len(self._group_pairs)),
+            [pairs.shape[1] for pairs in self._group_pairs],
+        )
+        self.group_metadata = (
+            profiles[self.same_columns]
+            .iloc[[rows[0] for rows in self._group_rows]]
+            .reset_index(drop=True)
+        )
+
+        pair_rows0 = np.concatenate(
+            [rows[pairs[0]] for rows, pairs in zip(self._group_rows, self._group_pairs)]
+            or [np.array([], dtype=np.int64)]
+        )
+        pair_rows1 = np.concatenate(
+            [rows[pairs[1]] for rows, pairs in zip(self._group_rows, self._group_pairs)]
+            or [np.array([], dtype=np.int64)]
+        )
+
+        drop_columns = set(drop_columns or [])
+        pair_metadata: Dict[str, pd.Series] = {}
+        for group_type, columns in [
+            ("antehoc", self.same_columns),
+            ("posthoc", self.different_columns),
+        ]:
+            for column in columns:
+                if column in drop_columns:
+                    continue
+                for group_index, pair_rows in enumerate([pair_rows0, pair_rows1]):
+                    pair_metadata[f"{column}__{group_type}_group{group_index}"] = (
+                        profiles[column].iloc[pair_rows].reset_index(drop=True)
+                    )
+        self.pair_metadata = pd.DataFrame(pair_metadata)
+
+    def correlations(self, features: Optional[np.ndarray] = None) -> np.ndarray:
+        """Compute the Pearson correlation of every pair.
+
+        Args:
+            features (Optional[np.ndarray], optional): Matrix of profiles by features with the same rows as the
+                profiles (e.g., shuffled features). Defaults to None, which uses the features of the profiles.
+
+        Returns:
+            np.ndarray: Pearson correlation of each pair, in the order of `pair_metadata`.
+        """
+        standardized = standardize_rows(self.features if features is None else features)
+
+        correlations = [
+            (standardized[rows] @ standardized[rows].T)[pairs[0], pairs[1]]
+            for rows, pairs in zip(self._group_rows, self._group_pairs)
+        ]
+
+        return np.concatenate(correlations) if correlations else np.array([])
+
+    def __call__(self, features: Optional[np.ndarray] = None) -> pd.DataFrame:
+        """Compute the Pearson correlation of every pair with the group columns of each profile.
+
+        Args:
+            features (Optional[np.ndarray], optional): Matrix of profiles by features with the same rows as the
+                profiles. Defaults to None, which uses the features of the profiles.
+
+        Returns:
+            pd.DataFrame: Dataframe with the correlation column and the `{column}__antehoc_group0`,
+                `{column}__antehoc_group1` (same columns) and `{column}__posthoc_group0`,
+                `{column}__posthoc_group1` (different columns) columns that are not dropped.
+        """
+        comparisons_df = pd.DataFrame(
+            {self.comparison_name: self.correlations(features)}
+        )
+
+        return pd.concat([comparisons_df, self.pair_metadata], axis="columns")
@@ -0,0 +1,306 @@
+"""
+This collection of functions builds and reads a cache of single-cell image crops for reviewing QC outliers.
+The crops are extracted from the full-field images (and outline images) using the bounding box columns, in a
+thread pool, and saved into one NumPy memmap so review and reporting only read small crops.
+"""
+
+import json
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import tifffile
+
+# key in the Parquet file metadata of the crop index that holds the cache layout
+CROP_CACHE_METADATA_KEY = b"crop_cache"
+
+
+def _get_crop_window(
+    center: float, crop_size: int, image_length: int
+) -> Tuple[int, int, int]:
+    """Get the start and stop of a crop window along one axis and the offset into the padded crop.
+
+    Args:
+        center (float): Center of the crop along the axis.
+        crop_size (int): Length of the crop along the axis.
+        image_length (int): Length of the image along the axis.
+
+    Returns:
+        Tuple[int, int, int]: Start and stop positions in the image and the offset in the crop.
+    """
+    start = int(round(center)) - crop_size // 2
+    stop = start + crop_size
+
+    return max(start, 0), min(stop, image_length), max(-start, 0)
+
+
+def _is_color_image(shape: Tuple[int, ...]) -> bool:
+    """Check if an image shape is an RGB or RGBA image (e.g., CellProfiler outlines saved in color).
+
+    Args:
+        shape (Tuple[int, ...]): Shape of the image.
+
+    Returns:
+        bool: Whether the shape is (height, width, 3) or (height, width, 4).
+    """
+    return len(shape) == 3 and shape[-1] in (3, 4)
+
+
+def _get_crop_dtype(field_of_view_paths: List[List[pathlib.Path]]) -> np.dtype:
+    """Get the dtype of the crops from the first image read, only reading the TIFF header.
+
+    Args:
+        field_of_view_paths (List[List[pathlib.Path]]): Paths to the image for each channel of each field of view.
+
+    Raises:
+        ValueError: If the first image is not 2D or RGB (e.g., a stack).
+
+    Returns:
+        np.dtype: Dtype of the first existing image, or uint16 (the dtype of the CellProfiler input images) if none
+            of the images exist.
+    """
+    for image_paths in field_of_view_paths:
+        for image_path in image_paths:
+            if not pathlib.Path(image_path).exists():
+                continue
+            with tifffile.TiffFile(image_path) as tiff:
+                image_series = tiff.series[0]
+                if len(image_series.shape) != 2 and not _is_color_image(
+                    image_series.shape
+                ):
+                    raise ValueError(
+                        f"Expected a 2D image but {image_path} has shape {image_series.shape}."
+                    )
+                return np.dtype(image_series.dtype)
+
+    return np.dtype(np.uint16)
+
+
+def _extract_image_crops(
+    image_paths: List[pathlib.Path],
+    centers: np.ndarray,
+    crop_size: int,
+    crops: np.ndarray,
+    crop_positions: np.ndarray,
+) -> None:
+    """Read the images for one field of view once and write the crops for every single-cell in it.
+
+    Args:
+        image_paths (List[pathlib.Path]): Paths to the image for each channel of the field of view.
+        centers (np.ndarray): Array of (x, y) bounding box centers for the single-cells in the field of view.
+        crop_size (int): Height and width of the crops.
+        crops (np.ndarray): Memmap of all crops with shape (cells, channels, crop_size, crop_size).
+        crop_positions (np.ndarray): Positions in the memmap for the single-cells in the field of view.
+
+    Raises:
+        ValueError: If an image is not 2D or RGB or its values do not fit in the dtype of the crops.
+    """
+    for channel_index, image_path in enumerate(image_paths):
+        # leave the channel empty if the image does not exist (e.g., outlines not saved for a site)
+        if not pathlib.Path(image_path).exists():
+            continue
+
+        image = tifffile.imread(image_path)
+        # reduce color outlines to one channel that is nonzero where any color is set
+        if _is_color_image(image.shape):
+            image = image.max(axis=-1)
+        if image.ndim != 2:
+            raise ValueError(
+                f"Expected a 2D image but {image_path} has shape {image.shape}."
+            )
+        # do not silently cast images (e.g., float images into integer crops)
+        if not np.can_cast(image.dtype, crops.dtype, casting="safe"):
+            raise ValueError(
+                f"{image_path} has dtype {image.dtype}, which does not fit in the crop dtype {crops.dtype}."
+            )
+        for (center_x, center_y), crop_position in zip(centers, crop_positions):
+            y_start, y_stop, y_offset = _get_crop_window(
+                center_y, crop_size, image.shape[0]
+            )
+            x_start, x_stop, x_offset = _get_crop_window(
+                center_x, crop_size, image.shape[1]
+            )
+            crops[
+                crop_position,
+                channel_index,
+                y_offset : y_offset + (y_stop - y_start),
+                x_offset : x_offset + (x_stop - x_start),
+            ] = image[y_start:y_stop, x_start:x_stop]
+
+
+def build_crop_cache(
+    outliers_df: pd.DataFrame,
+    compartment: str,
+    cache_dir: pathlib.Path,
+    channels: List[str] = ["OrigDNA", "OrigAGP"],
+    outline_dir: Optional[pathlib.Path] = None,
+    crop_size: Optional[int] = None,
+    max_workers: int = 8,
+) -> pathlib.Path:
+    """Extract image crops around each single-cell into a NumPy memmap with an index of the single-cells.
+
+    Args:
+        outliers_df (pd.DataFrame): Dataframe of the single-cells to cache, with the image metadata, image
+            FileName/PathName columns, and bounding box columns for the compartment.
+        compartment (str): Compartment of the bounding box columns to use (e.g., Nuclei).
+        cache_dir (pathlib.Path): Directory to save the crops and crop index.
+        channels (List[str], optional): Image channels to crop. Defaults to ["OrigDNA", "OrigAGP"].
+        outline_dir (Optional[pathlib.Path], optional): Directory with the CellProfiler outline images for the
+            plate. If provided, the outlines for the compartment are added as the last channel. Defaults to None.
+        crop_size (Optional[int], optional): Height and width of the crops. Defaults to None, which uses the
+            largest bounding box of the single-cells.
+        max_workers (int, optional): Number of threads reading images. Defaults to 8.
+
+    Raises:
+        ValueError: If an image is not 2D or RGB or its values do not fit in the dtype of the first image.
+
+    Returns:
+        pathlib.Path: Path to the directory with the crop cache.
+    """
+    cache_dir = pathlib.Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    outliers_df = outliers_df.reset_index().rename(
+        columns={"index": "original_indices"}
+    )
+
+    # set the centers and crop size from the bounding box of each single-cell
+    bbox_min_x = outliers_df[f"{compartment}_AreaShape_BoundingBoxMinimum_X"]
+    bbox_max_x = outliers_df[f"{compartment}_AreaShape_BoundingBoxMaximum_X"]
+    bbox_min_y = outliers_df[f"{compartment}_AreaShape_BoundingBoxMinimum_Y"]
+    bbox_max_y = outliers_df[f"{compartment}_AreaShape_BoundingBoxMaximum_Y"]
+    centers = np.column_stack(
+        [(bbox_min_x + bbox_max_x) / 2, (bbox_min_y + bbox_max_y) / 2]
+    )
+    if crop_size is None:
+        crop_size = int(
+            np.ceil(
+                max((bbox_max_x - bbox_min_x).max(), (bbox_max_y - bbox_min_y).max())
+            )
+        )
+
+    channel_names = channels + ([f"{compartment}Outlines"] if outline_dir else [])
+
+    # group the single-cells by field of view so each full-field image is only read once
+    field_of_view_columns = [
+        "Image_Metadata_Plate",
+        "Image_Metadata_Well",
+        "Image_Metadata_Site",
+    ]
+    field_of_view_images = []
+    for (plate, well, site), site_df in outliers_df.groupby(
+        field_of_view_columns, sort=False, observed=True
+    ):
+        first_row = site_df.iloc[0]
+        image_paths = [
+            pathlib.Path(first_row[f"Image_PathName_{channel}"])
+            / first_row[f"Image_FileName_{channel}"]
+            for channel in channels
+        ]
+        if outline_dir:
+            image_paths.append(
+                pathlib.Path(outline_dir)
+                / f"{compartment}Outlines_{plate}_{well}_{site}.tiff"
+            )
+        field_of_view_images.append((image_paths, site_df.index.to_numpy()))
+
+    # the crops use the dtype of the first image (e.g., uint16 for CellProfiler inputs)
+    crop_dtype = _get_crop_dtype(
+        [image_paths for image_paths, _ in field_of_view_images]
+    )
+    crops = np.lib.format.open_memmap(
+        cache_dir / "crops.npy",
+        mode="w+",
+        dtype=crop_dtype,
+        shape=(outliers_df.shape[0], len(channel_names), crop_size, crop_size),
+    )
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        for image_paths, crop_positions in field_of_view_images:
+            futures.append(
+                executor.submit(
+                    _extract_image_crops,
+                    image_paths=image_paths,
+                    centers=centers[crop_positions],
+                    crop_size=crop_size,
+                    crops=crops,
+                    crop_positions=crop_positions,
+                )
+            )
+
+        # raise any errors from reading the images
+        for future in futures:
+            future.result()
+
+    crops.flush()
+
+    # save the index of the single-cells in the same order as the crops with the cache layout
+    index_table = pa.Table.from_pandas(outliers_df, preserve_index=False)
+    index_table = index_table.replace_schema_metadata(
+        {
+            **(index_table.schema.metadata or {}),
+            CROP_CACHE_METADATA_KEY: json.dumps(
+                {
+                    "compartment": compartment,
+                    "channels": channel_names,
+                    "crop_size": crop_size,
+                    "dtype": crop_dtype.name,
+                }
+            ).encode("utf-8"),
+        }
+    )
+    pq.write_table(index_table, cache_dir / "crop_index.parquet")
+
+    return cache_dir
+
+
+class CropCache:
+    """
+    Read-only access to the single-cell crops saved with `build_crop_cache`.
+
+    Attributes:
+        index (pd.DataFrame): Metadata of the cached single-cells in the same order as the crops.
+        channels (List[str]): Names of the channels of each crop.
+        crop_size (int): Height and width of the crops.
+        crops (np.ndarray): Memory-mapped array of crops with shape (cells, channels, crop_size, crop_size).
+    """
+
+    def __init__(self, cache_dir: pathlib.Path):
+        cache_dir = pathlib.Path(cache_dir)
+        index_path = cache_dir / "crop_index.parquet"
+
+        cache_metadata = json.loads(
+            pq.read_schema(index_path).metadata[CROP_CACHE_METADATA_KEY].decode("utf-8")
+        )
+        self.index = pd.read_parquet(index_path)
+        self.channels = cache_metadata["channels"]
+        self.crop_size = cache_metadata["crop_size"]
+        self.crops = np.load(cache_dir / "crops.npy", mmap_mode="r")
+
+    def __len__(self) -> int:
+        return self.crops.shape[0]
+
+    def get_crop(
+        self, original_index: int, channel: Optional[str] = None
+    ) -> np.ndarray:
+        """Get the crop of one single-cell by its row index in the converted profiles.
+
+        Args:
+            original_index (int): Row index of the single-cell in the converted profiles.
+            channel (Optional[str], optional): Channel to return. Defaults to None, which returns all channels.
+
+        Returns:
+            np.ndarray: Crop with shape (channels, crop_size, crop_size), or (crop_size, crop_size) for one channel.
+        """
+        crop_position = np.flatnonzero(
+            self.index["original_indices"].to_numpy() == original_index
+        )[0]
+        if channel is None:
+            return np.asarray(self.crops[crop_position])
+
+        return np.asarray(self.crops[crop_position, self.channels.index(channel)])
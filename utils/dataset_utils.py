@@ -0,0 +1,193 @@
+"""
+This collection of functions writes and reads profiles as a hive-partitioned Parquet dataset by round, plate, and
+well (e.g., `Metadata_round=Round_4_data/Metadata_Plate=BR00145816/Metadata_Well=B02/part-0.parquet`).
+Each well is a separate file with column statistics, so reads with filters on the partition columns only open the
+matching files and filters on other metadata (e.g., cell line) skip row groups using the statistics.
+"""
+
+import pathlib
+import shutil
+from typing import Dict, Iterator, List, Optional, Union
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# name of the partition column with the round of data
+ROUND_COLUMN = "Metadata_round"
+
+
+def _profile_partitioning(
+    plate_column: str = "Metadata_Plate", well_column: str = "Metadata_Well"
+) -> ds.Partitioning:
+    """Create the hive partitioning by round, plate, and well, with all partition values read as strings.
+
+    Args:
+        plate_column (str, optional): Name of the plate column. Defaults to "Metadata_Plate".
+        well_column (str, optional): Name of the well column. Defaults to "Metadata_Well".
+
+    Returns:
+        ds.Partitioning: Hive partitioning of the dataset.
+    """
+    return ds.partitioning(
+        pa.schema(
+            [
+                (ROUND_COLUMN, pa.string()),
+                (plate_column, pa.string()),
+                (well_column, pa.string()),
+            ]
+        ),
+        flavor="hive",
+    )
+
+
+def write_partitioned_profiles(
+    profile_path: pathlib.Path,
+    dataset_dir: pathlib.Path,
+    round_id: str,
+    plate_column: str = "Metadata_Plate",
+    well_column: str = "Metadata_Well",
+    batch_size: int = 100000,
+    max_rows_per_group: int = 50000,
+) -> None:
+    """Add the profiles of one plate to a dataset partitioned by round, plate, and well.
+
+    The plate file is read in batches of rows, so the plate does not need to fit in memory. Partitions already in
+    the dataset for the same round and plate are replaced (including wells no longer in the plate file), and other
+    plates and rounds are kept.
+
+    Args:
+        profile_path (pathlib.Path): Path to the Parquet file with the profiles of one plate
+            (e.g., `{plate}_sc_feature_selected.parquet`).
+        dataset_dir (pathlib.Path): Directory of the partitioned dataset.
+        round_id (str): Round of data (e.g., Round_4_data), saved as the Metadata_round partition.
+        plate_column (str, optional): Name of the plate column. Defaults to "Metadata_Plate".
+        well_column (str, optional): Name of the well column. Defaults to "Metadata_Well".
+        batch_size (int, optional): Maximum number of rows read from the plate file at a time.
+            Defaults to 100000.
+        max_rows_per_group (int, optional): Maximum number of rows in each row group of the dataset files.
+            Defaults to 50000.
+    """
+    parquet_file = pq.ParquetFile(profile_path)
+    schema = parquet_file.schema_arrow
+    # the partition columns are stored in the directory names as strings
+    for column in [plate_column, well_column]:
+        schema = schema.set(
+            schema.get_field_index(column), pa.field(column, pa.string())
+        )
+    # the pandas metadata of the plate file no longer matches the types of the partition columns
+    schema = schema.append(pa.field(ROUND_COLUMN, pa.string())).remove_metadata()
+
+    # delete the plate's partitions first, since writing only replaces the wells in the new plate file
+    plates = pq.read_table(profile_path, columns=[plate_column])[plate_column]
+    for plate in pc.unique(pc.cast(plates, pa.string())).to_pylist():
+        shutil.rmtree(
+            pathlib.Path(dataset_dir)
+            / f"{ROUND_COLUMN}={round_id}"
+            / f"{plate_column}={plate}",
+            ignore_errors=True,
+        )
+
+    def _iter_batches() -> Iterator[pa.RecordBatch]:
+        for record_batch in parquet_file.iter_batches(batch_size=batch_size):
+            columns = [
+                (
+                    pc.cast(record_batch.column(name), pa.string())
+                    if name in (plate_column, well_column)
+                    else record_batch.column(name)
+                )
+                for name in record_batch.schema.names
+            ]
+            columns.append(pa.array([round_id] * record_batch.num_rows, pa.string()))
+            yield pa.RecordBatch.from_arrays(columns, schema=schema)
+
+    ds.write_dataset(
+        _iter_batches(),
+        base_dir=str(dataset_dir),
+        schema=schema,
+        format="parquet",
+        partitioning=_profile_partitioning(plate_column, well_column),
+        basename_template="part-{i}.parquet",
+        existing_data_behavior="delete_matching",
+        max_rows_per_group=max_rows_per_group,
+        min_rows_per_group=min(max_rows_per_group, batch_size),
+        file_options=ds.ParquetFileFormat().make_write_options(write_statistics=True),
+    )
+
+
+def open_profile_dataset(
+    dataset_dir: pathlib.Path,
+    plate_column: str = "Metadata_Plate",
+    well_column: str = "Metadata_Well",
+) -> ds.Dataset:
+    """Open a dataset partitioned by round, plate, and well without reading any data.
+
+    Args:
+        dataset_dir (pathlib.Path): Directory of the partitioned dataset.
+        plate_column (str, optional): Name of the plate column. Defaults to "Metadata_Plate".
+        well_column (str, optional): Name of the well column. Defaults to "Metadata_Well".
+
+    Returns:
+        ds.Dataset: Dataset with the partition columns added to the schema.
+    """
+    return ds.dataset(
+        str(dataset_dir),
+        format="parquet",
+        partitioning=_profile_partitioning(plate_column, well_column),
+    )
+
+
+def filters_to_expression(
+    filters: Dict[str, Union[object, List[object]]],
+) -> Optional[ds.Expression]:
+    """Convert a dictionary of column filters to a dataset expression.
+
+    Args:
+        filters (Dict[str, Union[object, List[object]]]): Dictionary of column name to a value or a list of
+            values to keep (e.g., {"Metadata_cell_line": "U2-OS", "Metadata_Plate": ["BR00145816"]}).
+
+    Returns:
+        Optional[ds.Expression]: Expression keeping the rows that match every filter, or None if there are no
+            filters.
+    """
+    expression = None
+    for column, values in filters.items():
+        if isinstance(values, (list, tuple, set)):
+            column_expression = ds.field(column).isin(list(values))
+        else:
+            column_expression = ds.field(column) == values
+        expression = (
+            column_expression if expression is None else expression & column_expression
+        )
+
+    return expression
+
+
+def read_partitioned_profiles(
+    dataset_dir: pathlib.Path,
+    columns: Optional[List[str]] = None,
+    filters: Optional[Dict[str, Union[object, List[object]]]] = None,
+    plate_column: str = "Metadata_Plate",
+    well_column: str = "Metadata_Well",
+) -> pd.DataFrame:
+    """Read profiles from a partitioned dataset, only opening the files that match the filters.
+
+    Args:
+        dataset_dir (pathlib.Path): Directory of the partitioned dataset.
+        columns (Optional[List[str]], optional): Columns to read. Defaults to None, which reads all columns.
+        filters (Optional[Dict[str, Union[object, List[object]]]], optional): Dictionary of column name to a
+            value or a list of values to keep (see `filters_to_expression`). Defaults to None.
+        plate_column (str, optional): Name of the plate column. Defaults to "Metadata_Plate".
+        well_column (str, optional): Name of the well column. Defaults to "Metadata_Well".
+
+    Returns:
+        pd.DataFrame: Profiles matching the filters.
+    """
+    dataset = open_profile_dataset(dataset_dir, plate_column, well_column)
+
+    return dataset.to_table(
+        columns=columns,
+        filter=filters_to_expression(filters) if filters else None,
+    ).to_pandas()
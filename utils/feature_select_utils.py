@@ -0,0 +1,568 @@
+"""
+This collection of functions performs feature selection from statistics accumulated in one streaming pass over
+the row groups of normalized profiles, instead of loading the full single-cell matrix. The selected features are
+the same as pycytominer `feature_select` with the variance_threshold, correlation_threshold, blocklist, and
+drop_na_columns operations.
+Statistics can be merged across plates to select one set of features for a round, which is saved to a manifest
+that every plate is projected onto.
+"""
+
+import json
+import pathlib
+from typing import List, Optional, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pycytominer.cyto_utils import get_blocklist_features, infer_cp_features
+
+# feature selection operations that can be computed from the accumulated statistics
+STREAMING_FEATURE_SELECT_OPS = [
+    "variance_threshold",
+    "correlation_threshold",
+    "blocklist",
+    "drop_na_columns",
+]
+
+
+class FeatureSelectStats:
+    """
+    Sufficient statistics of a set of features for streaming feature selection.
+
+    Missing values, means, and variances are accumulated from all rows (variances are merged with the parallel
+    algorithm of Chan et al.). Cross-products for correlations are accumulated as a Gram matrix in blocks of
+    features, optionally from a random subsample of rows. Once a missing value is seen, the Gram statistics are
+    kept per pair of features (pairwise-complete rows) to match pandas correlations.
+    Cross-products are not centered, so the statistics are meant for normalized profiles.
+
+    Attributes:
+        features (List[str]): Names of the features.
+        num_rows (int): Number of rows accumulated.
+        na_count (np.ndarray): Number of missing values per feature.
+        count (np.ndarray): Number of non-missing values per feature.
+        mean (np.ndarray): Mean of each feature.
+        m2 (np.ndarray): Sum of squared differences from the mean of each feature.
+        gram_rows (int): Number of rows accumulated into the Gram statistics.
+        has_missing (bool): Whether a missing value was accumulated into the Gram statistics.
+    """
+
+    def __init__(self, features: List[str], block_size: int = 512):
+        """Create empty statistics for a list of features.
+
+        Args:
+            features (List[str]): Names of the features.
+            block_size (int, optional): Number of features per block when computing cross-products.
+                Defaults to 512.
+        """
+        num_features = len(features)
+        self.features = list(features)
+        self.block_size = block_size
+
+        self.num_rows = 0
+        self.na_count = np.zeros(num_features, dtype=np.int64)
+        self.count = np.zeros(num_features, dtype=np.int64)
+        self.mean = np.zeros(num_features)
+        self.m2 = np.zeros(num_features)
+
+        # Gram statistics (sums per feature if there are no missing values, otherwise per pair of features)
+        self.gram_rows = 0
+        self.has_missing = False
+        self._sum = np.zeros(num_features)
+        self._cross_products = np.zeros((num_features, num_features))
+        self._pair_count = None
+        self._pair_sum = None
+        self._pair_sum_squares = None
+
+    def _blocked_gram(self, left: np.ndarray, right: np.ndarray) -> np.ndarray:
+        """Compute left.T @ right in blocks of features to limit the size of temporary arrays.
+
+        Args:
+            left (np.ndarray): Array with shape (rows, features).
+            right (np.ndarray): Array with shape (rows, features).
+
+        Returns:
+            np.ndarray: Array with shape (features, features).
+        """
+        gram = np.empty((left.shape[1], right.shape[1]))
+        for block_start in range(0, left.shape[1], self.block_size):
+            block = slice(block_start, block_start + self.block_size)
+            gram[block] = left[:, block].T @ right
+
+        return gram
+
+    def _to_pairwise(self) -> None:
+        """Convert the Gram statistics from sums per feature to sums per pair of features."""
+        num_features = len(self.features)
+        self._pair_count = np.full((num_features, num_features), float(self.gram_rows))
+        # sum of feature i over the rows where feature j is present (all rows when nothing is missing)
+        self._pair_sum = np.repeat(self._sum[:, np.newaxis], num_features, axis=1)
+        self._pair_sum_squares = np.repeat(
+            np.diag(self._cross_products)[:, np.newaxis], num_features, axis=1
+        )
+        self.has_missing = True
+
+    def update(self, values: np.ndarray, gram_mask: Optional[np.ndarray] = None):
+        """Accumulate a batch of rows.
+
+        Args:
+            values (np.ndarray): Array of feature values with shape (rows, features).
+            gram_mask (Optional[np.ndarray], optional): Boolean array of the rows to accumulate into the Gram
+                statistics (e.g., a random subsample). Defaults to None, which uses all rows.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        is_present = ~np.isnan(values)
+
+        # missing values, means, and variances from all rows
+        batch_count = is_present.sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            batch_mean = np.where(
+                batch_count > 0, np.nansum(values, axis=0) / batch_count, 0.0
+            )
+        batch_m2 = np.nansum((values - batch_mean) ** 2, axis=0)
+        self._merge_moments(batch_count, batch_mean, batch_m2)
+        self.num_rows += values.shape[0]
+        self.na_count += values.shape[0] - batch_count
+
+        # cross-products from the rows in the Gram mask
+        if gram_mask is not None:
+            values, is_present = values[gram_mask], is_present[gram_mask]
+        if not is_present.all() and not self.has_missing:
+            self._to_pairwise()
+
+        filled = np.where(is_present, values, 0.0)
+        self._cross_products += self._blocked_gram(filled, filled)
+        if self.has_missing:
+            present = is_present.astype(np.float64)
+            self._pair_count += self._blocked_gram(present, present)
+            self._pair_sum += self._blocked_gram(filled, present)
+            self._pair_sum_squares += self._blocked_gram(filled**2, present)
+        else:
+            self._sum += filled.sum(axis=0)
+        self.gram_rows += values.shape[0]
+
+    def _merge_moments(
+        self, other_count: np.ndarray, other_mean: np.ndarray, other_m2: np.ndarray
+    ) -> None:
+        """Merge counts, means, and sums of squared differences into the running statistics.
+
+        Args:
+            other_count (np.ndarray): Number of non-missing values per feature.
+            other_mean (np.ndarray): Mean of each feature (0 where the count is 0).
+            other_m2 (np.ndarray): Sum of squared differences from the mean of each feature.
+        """
+        total_count = self.count + other_count
+        with np.errstate(invalid="ignore", divide="ignore"):
+            delta = other_mean - self.mean
+            self.mean = np.where(
+                total_count > 0, self.mean + delta * other_count / total_count, 0.0
+            )
+            self.m2 = np.where(
+                total_count > 0,
+                self.m2 + other_m2 + delta**2 * self.count * other_count / total_count,
+                0.0,
+            )
+        self.count = total_count
+
+    def merge(self, other: "FeatureSelectStats") -> "FeatureSelectStats":
+        """Merge the statistics of another set of rows with the same features (e.g., another plate).
+
+        Args:
+            other (FeatureSelectStats): Statistics to merge.
+
+        Returns:
+            FeatureSelectStats: This object with the merged statistics.
+        """
+        if other.features != self.features:
+            raise ValueError("Statistics can only be merged for the same features")
+
+        self._merge_moments(other.count, other.mean, other.m2)
+        self.num_rows += other.num_rows
+        self.na_count += other.na_count
+
+        if other.has_missing and not self.has_missing:
+            self._to_pairwise()
+        if self.has_missing:
+            if not other.has_missing:
+                # copy so the other statistics are not converted in place
+                other = other.copy()
+                other._to_pairwise()
+            self._pair_count += other._pair_count
+            self._pair_sum += other._pair_sum
+            self._pair_sum_squares += other._pair_sum_squares
+        else:
+            self._sum += other._sum
+        self._cross_products += other._cross_products
+        self.gram_rows += other.gram_rows
+
+        return self
+
+    def copy(self) -> "FeatureSelectStats":
+        """Copy the statistics.
+
+        Returns:
+            FeatureSelectStats: Copy of the statistics.
+        """
+        copied = FeatureSelectStats(self.features, block_size=self.block_size)
+        for name, value in vars(self).items():
+            setattr(copied, name, value.copy() if hasattr(value, "copy") else value)
+
+        return copied
+
+    def variance(self) -> pd.Series:
+        """Get the population variance of each feature, ignoring missing values (NaN if all are missing).
+
+        Returns:
+            pd.Series: Variance of each feature.
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            variance = np.where(self.count > 0, self.m2 / self.count, np.nan)
+
+        return pd.Series(variance, index=self.features)
+
+    def na_proportion(self) -> pd.Series:
+        """Get the proportion of missing values of each feature.
+
+        Returns:
+            pd.Series: Proportion of missing values of each feature.
+        """
+        return pd.Series(self.na_count / self.num_rows, index=self.features)
+
+    def correlation(self, features: Optional[List[str]] = None) -> pd.DataFrame:
+        """Get the Pearson correlation matrix of the features from the Gram statistics.
+
+        Args:
+            features (Optional[List[str]], optional): Subset of features. Defaults to None, which uses all features.
+
+        Returns:
+            pd.DataFrame: Correlation matrix, NaN for pairs of features without variance.
+        """
+        features = self.features if features is None else list(features)
+        positions = pd.Index(self.features).get_indexer(features)
+        subset = np.ix_(positions, positions)
+
+        cross_products = self._cross_products[subset]
+        if self.has_missing:
+            pair_count = self._pair_count[subset]
+            pair_sum = self._pair_sum[subset]
+            pair_sum_squares = self._pair_sum_squares[subset]
+            # sums of feature j over the rows where feature i is present are the transposed entries
+            covariance = pair_count * cross_products - pair_sum * pair_sum.T
+            variance_product = (pair_count * pair_sum_squares - pair_sum**2) * (
+                pair_count * pair_sum_squares.T - pair_sum.T**2
+            )
+        else:
+            feature_sum = self._sum[positions]
+            squares = np.diag(cross_products)
+            covariance = self.gram_rows * cross_products - np.outer(
+                feature_sum, feature_sum
+            )
+            variance = self.gram_rows * squares - feature_sum**2
+            variance_product = np.outer(variance, variance)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            correlation = covariance / np.sqrt(variance_product)
+        correlation[~(variance_product > 0)] = np.nan
+
+        return pd.DataFrame(
+            np.clip(correlation, -1, 1), index=features, columns=features
+        )
+
+
+def compute_feature_select_stats(
+    profile_paths: Union[pathlib.Path, List[pathlib.Path]],
+    features: Union[str, List[str]] = "infer",
+    batch_size: int = 100000,
+    sample_fraction: Optional[float] = None,
+    seed: int = 0,
+    block_size: int = 512,
+) -> FeatureSelectStats:
+    """Accumulate the feature selection statistics in one streaming pass over the row groups of Parquet files.
+
+    Only the feature columns are read.
+
+    Args:
+        profile_paths (Union[pathlib.Path, List[pathlib.Path]]): Path or list of paths to Parquet files with
+            normalized profiles. Statistics of multiple files are pooled.
+        features (Union[str, List[str]], optional): Features to select from. Defaults to "infer", which infers the
+            CellProfiler features from the schema of the first file.
+        batch_size (int, optional): Maximum number of rows read at a time. Defaults to 100000.
+        sample_fraction (Optional[float], optional): Fraction of rows randomly sampled for the correlations.
+            Defaults to None, which uses all rows. Missing values and variances always use all rows.
+        seed (int, optional): Seed for the random row sample. Defaults to 0.
+        block_size (int, optional): Number of features per block when computing cross-products. Defaults to 512.
+
+    Returns:
+        FeatureSelectStats: Accumulated statistics.
+    """
+    if isinstance(profile_paths, (str, pathlib.Path)):
+        profile_paths = [profile_paths]
+    if features == "infer":
+        features = infer_cp_features(
+            pq.read_schema(profile_paths[0]).empty_table().to_pandas()
+        )
+
+    rng = np.random.default_rng(seed)
+    stats = FeatureSelectStats(features, block_size=block_size)
+    for profile_path in profile_paths:
+        for record_batch in pq.ParquetFile(profile_path).iter_batches(
+            batch_size=batch_size, columns=features
+        ):
+            values = np.column_stack(
+                [
+                    column.to_numpy(zero_copy_only=False).astype(np.float64)
+                    for column in record_batch.columns
+                ]
+            )
+            gram_mask = (
+                rng.random(values.shape[0]) < sample_fraction
+                if sample_fraction is not None
+                else None
+            )
+            stats.update(values, gram_mask=gram_mask)
+
+    return stats
+
+
+def compute_feature_select_stats_from_dataframe(
+    profiles_df: pd.DataFrame,
+    features: Union[str, List[str]] = "infer",
+    sample_fraction: Optional[float] = None,
+    seed: int = 0,
+    block_size: int = 512,
+) -> FeatureSelectStats:
+    """Accumulate the feature selection statistics of profiles already in memory (e.g., bulk profiles).
+
+    Args:
+        profiles_df (pd.DataFrame): Normalized profiles.
+        features (Union[str, List[str]], optional): Features to select from. Defaults to "infer".
+        sample_fraction (Optional[float], optional): Fraction of rows randomly sampled for the correlations.
+            Defaults to None, which uses all rows.
+        seed (int, optional): Seed for the random row sample. Defaults to 0.
+        block_size (int, optional): Number of features per block when computing cross-products. Defaults to 512.
+
+    Returns:
+        FeatureSelectStats: Accumulated statistics.
+    """
+    if features == "infer":
+        features = infer_cp_features(profiles_df)
+
+    gram_mask = (
+        np.random.default_rng(seed).random(profiles_df.shape[0]) < sample_fraction
+        if sample_fraction is not None
+        else None
+    )
+    stats = FeatureSelectStats(features, block_size=block_size)
+    stats.update(profiles_df[features].to_numpy(dtype=np.float64), gram_mask=gram_mask)
+
+    return stats
+
+
+def select_features_from_stats(
+    stats: FeatureSelectStats,
+    operation: List[str] = STREAMING_FEATURE_SELECT_OPS,
+    na_cutoff: float = 0.05,
+    corr_threshold: float = 0.9,
+    min_variance: float = 1e-06,
+    columns: Optional[List[str]] = None,
+) -> List[str]:
+    """Apply feature selection operations in order, each on the features kept by the previous operations,
+    the same as pycytominer `feature_select`.
+
+    Args:
+        stats (FeatureSelectStats): Accumulated statistics.
+        operation (List[str], optional): Operations to perform. Defaults to STREAMING_FEATURE_SELECT_OPS.
+        na_cutoff (float, optional): Maximum proportion of missing values for `drop_na_columns`. Defaults to 0.05.
+        corr_threshold (float, optional): Correlation threshold for `correlation_threshold`. Defaults to 0.9.
+        min_variance (float, optional): Minimum variance for `variance_threshold`. Defaults to 1e-06.
+        columns (Optional[List[str]], optional): All columns of the profiles, used to find the blocklist features.
+            Defaults to None, which uses the features of the statistics.
+
+    Raises:
+        ValueError: If an operation can not be computed from the statistics.
+
+    Returns:
+        List[str]: Features excluded by the operations.
+    """
+    unsupported = [op for op in operation if op not in STREAMING_FEATURE_SELECT_OPS]
+    if unsupported:
+        raise ValueError(
+            f"Operation(s) {unsupported} not supported. Choose {STREAMING_FEATURE_SELECT_OPS}"
+        )
+
+    features = list(stats.features)
+    excluded_features = []
+    for op in operation:
+        if op == "variance_threshold":
+            # features with missing variance (all values missing) are also excluded, as with VarianceThreshold
+            variance = stats.variance()[features]
+            exclude = variance.index[~(variance > min_variance)].tolist()
+        elif op == "drop_na_columns":
+            na_proportion = stats.na_proportion()[features]
+            exclude = na_proportion.index[na_proportion > na_cutoff].tolist()
+        elif op == "correlation_threshold":
+            exclude = _correlation_threshold(stats, features, corr_threshold)
+        elif op == "blocklist":
+            exclude = get_blocklist_features(
+                population_df=pd.DataFrame(
+                    columns=stats.features if columns is None else columns
+                )
+            )
+        excluded_features += exclude
+        features = [feat for feat in features if feat not in excluded_features]
+
+    return list(set(excluded_features))
+
+
+def _correlation_threshold(
+    stats: FeatureSelectStats, features: List[str], threshold: float
+) -> List[str]:
+    """Find the features to exclude for being correlated above a threshold, the same as pycytominer
+    `correlation_threshold`. For each pair above the threshold, the feature with the larger sum of absolute
+    correlations to all features is excluded.
+
+    Args:
+        stats (FeatureSelectStats): Accumulated statistics.
+        features (List[str]): Features to compare.
+        threshold (float): Correlation threshold.
+
+    Returns:
+        List[str]: Features excluded.
+    """
+    correlation_df = stats.correlation(features)
+
+    # order of the features by total absolute correlation (lower index means less correlated)
+    sorted_positions = correlation_df.columns.get_indexer(
+        correlation_df.abs().sum().sort_values().index
+    )
+    rank = np.empty(len(features), dtype=np.int64)
+    rank[sorted_positions] = np.arange(len(features))
+
+    # pairs from the lower triangle (pair_a is the row and pair_b the column)
+    pair_a, pair_b = np.tril_indices(len(features), k=-1)
+    above_threshold = correlation_df.to_numpy()[pair_a, pair_b] > threshold
+    pair_a, pair_b = pair_a[above_threshold], pair_b[above_threshold]
+
+    excluded_positions = np.where(rank[pair_a] > rank[pair_b], pair_a, pair_b)
+
+    return list({features[position] for position in excluded_positions})
+
+
+def write_selected_features(
+    profile_path: pathlib.Path,
+    output_path: pathlib.Path,
+    excluded_features: List[str],
+    batch_size: int = 100000,
+) -> List[str]:
+    """Write the profiles without the excluded features, streaming only the kept columns.
+
+    Args:
+        profile_path (pathlib.Path): Path to the Parquet file with normalized profiles.
+        output_path (pathlib.Path): Path to save the feature-selected profiles.
+        excluded_features (List[str]): Features to drop.
+        batch_size (int, optional): Maximum number of rows read at a time. Defaults to 100000.
+
+    Returns:
+        List[str]: Columns written.
+    """
+    parquet_file = pq.ParquetFile(profile_path)
+    excluded = set(excluded_features)
+    columns = [name for name in parquet_file.schema_arrow.names if name not in excluded]
+
+    schema = pa.schema([parquet_file.schema_arrow.field(name) for name in columns])
+    with pq.ParquetWriter(output_path, schema) as writer:
+        for record_batch in parquet_file.iter_batches(
+            batch_size=batch_size, columns=columns
+        ):
+            writer.write_batch(record_batch)
+
+    return columns
+
+
+def select_round_features(
+    stats: FeatureSelectStats,
+    manifest_path: pathlib.Path,
+    plates: List[str],
+    operation: List[str] = STREAMING_FEATURE_SELECT_OPS,
+    na_cutoff: float = 0.05,
+    corr_threshold: float = 0.9,
+    min_variance: float = 1e-06,
+    columns: Optional[List[str]] = None,
+) -> dict:
+    """Select one set of features from the statistics pooled across the plates of a round and save it to a
+    manifest.
+
+    Args:
+        stats (FeatureSelectStats): Statistics merged across all plates.
+        manifest_path (pathlib.Path): Path to save the manifest JSON file.
+        plates (List[str]): Names of the plates the statistics were pooled from.
+        operation (List[str], optional): Operations to perform. Defaults to STREAMING_FEATURE_SELECT_OPS.
+        na_cutoff (float, optional): Maximum proportion of missing values for `drop_na_columns`. Defaults to 0.05.
+        corr_threshold (float, optional): Correlation threshold for `correlation_threshold`. Defaults to 0.9.
+        min_variance (float, optional): Minimum variance for `variance_threshold`. Defaults to 1e-06.
+        columns (Optional[List[str]], optional): All columns of the profiles, used to find the blocklist features.
+            Defaults to None, which uses the features of the statistics.
+
+    Returns:
+        dict: Manifest with the plates, feature selection parameters, and selected and excluded features.
+    """
+    excluded_features = select_features_from_stats(
+        stats=stats,
+        operation=operation,
+        na_cutoff=na_cutoff,
+        corr_threshold=corr_threshold,
+        min_variance=min_variance,
+        columns=columns,
+    )
+    manifest = {
+        "plates": list(plates),
+        "num_rows": stats.num_rows,
+        "operation": list(operation),
+        "na_cutoff": na_cutoff,
+        "corr_threshold": corr_threshold,
+        "min_variance": min_variance,
+        "features": stats.features,
+        "selected_features": [
+            feature for feature in stats.features if feature not in excluded_features
+        ],
+        # blocklist features might not be part of the features of the statistics
+        "excluded_features": sorted(excluded_features),
+    }
+
+    manifest_path = pathlib.Path(manifest_path)
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(manifest_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+
+    return manifest
+
+
+def read_feature_manifest(manifest_path: pathlib.Path) -> dict:
+    """Read a manifest of selected features saved with `select_round_features`.
+
+    Args:
+        manifest_path (pathlib.Path): Path to the manifest JSON file.
+
+    Returns:
+        dict: Manifest with the plates, feature selection parameters, and selected and excluded features.
+    """
+    with open(manifest_path, "r") as manifest_file:
+        return json.load(manifest_file)
+
+
+def read_projected_profiles(profile_path: pathlib.Path, manifest: dict) -> pd.DataFrame:
+    """Read profiles projected onto the selected features of a manifest, without reading the excluded features.
+
+    Args:
+        profile_path (pathlib.Path): Path to the Parquet file with normalized profiles.
+        manifest (dict): Manifest from `select_round_features` or `read_feature_manifest`.
+
+    Returns:
+        pd.DataFrame: Profiles with the metadata and selected features.
+    """
+    excluded = set(manifest["excluded_features"])
+    columns = [
+        name for name in pq.read_schema(profile_path).names if name not in excluded
+    ]
+
+    return pd.read_parquet(profile_path, columns=columns)
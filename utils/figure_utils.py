@@ -0,0 +1,200 @@
+"""
+This collection of functions builds multi-page figures (e.g., one page per cell line) by rendering each page to a
+separate PDF in parallel processes and merging the pages. The hash of the data of each page and of the source code
+of the renderer is saved, so only pages whose data or renderer changed (or new pages) are rendered again.
+"""
+
+import hashlib
+import inspect
+import json
+import multiprocessing
+import pathlib
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List, Optional
+
+import pandas as pd
+from pypdf import PdfWriter
+
+from errors.exceptions import MaxWorkerError
+
+
+def hash_dataframe(df: pd.DataFrame) -> str:
+    """Compute a hash of the values, column names, and dtypes of a dataframe (ignoring the index).
+
+    Args:
+        df (pd.DataFrame): Dataframe to hash.
+
+    Returns:
+        str: Hexadecimal SHA-256 hash.
+    """
+    df_hasher = hashlib.sha256()
+    df_hasher.update(json.dumps([str(column) for column in df.columns]).encode())
+    df_hasher.update(json.dumps([str(dtype) for dtype in df.dtypes]).encode())
+    df_hasher.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+
+    return df_hasher.hexdigest()
+
+
+def render_pearson_vs_failing_cells(
+    cell_line_df: pd.DataFrame, cell_line: str, output_path: pathlib.Path
+) -> None:
+    """Render the scatterplot of the Pearson correlation and percentage of failing cells of one cell line to a PDF.
+
+    Args:
+        cell_line_df (pd.DataFrame): Merged Pearson correlations and QC results of one cell line.
+        cell_line (str): Name of the cell line.
+        output_path (pathlib.Path): Path to the PDF.
+    """
+    # import in the function so worker processes use a non-interactive backend
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    custom_palette = sns.color_palette("Set1", n_colors=5)
+
+    plt.figure(figsize=(8, 6))
+    sns.scatterplot(
+        data=cell_line_df,
+        x="pearsons_correlation",
+        y="percentage_failing_cells",
+        hue="Metadata_seeding_density",
+        palette=custom_palette,  # Choose a color palette for seeding density
+        style="Metadata_time_point",  # Different styles for each time point
+        markers=["o", "X", "s"],  # Customize markers
+        s=100,
+    )
+
+    plt.title(
+        f"Pearson Correlation vs Percentage Failing Cells\nCell Line: {cell_line}",
+        fontsize=16,
+    )
+    plt.xlabel("Pearson Correlation")
+    plt.ylabel("Percentage Failing Cells")
+
+    # Reverse the y-axis (since higher failing percentage is bad)
+    plt.gca().invert_yaxis()
+
+    # Move the legend outside of the plot
+    plt.legend(title="Seeding Density", bbox_to_anchor=(1.05, 1), loc="upper left")
+
+    plt.savefig(output_path, bbox_inches="tight", transparent=True)
+    plt.close()
+
+
+def merge_pdf_pages(page_paths: List[pathlib.Path], output_path: pathlib.Path) -> None:
+    """Merge single-page PDFs into one PDF in the given order.
+
+    Args:
+        page_paths (List[pathlib.Path]): Paths to the PDFs of the pages.
+        output_path (pathlib.Path): Path to the merged PDF.
+    """
+    writer = PdfWriter()
+    for page_path in page_paths:
+        writer.append(str(page_path))
+
+    with open(output_path, "wb") as output_file:
+        writer.write(output_file)
+
+
+def build_figure_pages(
+    data: pd.DataFrame,
+    page_column: str,
+    render_page: Callable[[pd.DataFrame, str, pathlib.Path], None],
+    page_dir: pathlib.Path,
+    output_path: pathlib.Path,
+    max_workers: Optional[int] = None,
+) -> pd.DataFrame:
+    """Render one page per value of a column in parallel, skipping pages whose data did not change, and merge them.
+
+    Args:
+        data (pd.DataFrame): Data of all pages.
+        page_column (str): Column with the value of each page (e.g., Metadata_cell_line). Pages are in the order
+            the values first appear.
+        render_page (Callable[[pd.DataFrame, str, pathlib.Path], None]): Function defined in a module (so it can
+            be sent to worker processes) called as `render_page(page_df, page, output_path)`.
+        page_dir (pathlib.Path): Directory of the page PDFs and the manifest of their data hashes. PDFs of pages
+            that are no longer in the data are deleted.
+        output_path (pathlib.Path): Path to the merged PDF.
+        max_workers (Optional[int], optional): Number of processes rendering pages. Defaults to None, which uses
+            the number of CPUs.
+
+    Raises:
+        MaxWorkerError: If max_workers exceeds the number of CPUs.
+
+    Returns:
+        pd.DataFrame: Dataframe with the page, page file, data hash, and whether the page was rendered or skipped.
+    """
+    if max_workers is None:
+        max_workers = multiprocessing.cpu_count()
+    if max_workers > multiprocessing.cpu_count():
+        raise MaxWorkerError(
+            "Exception occurred: The number of workers exceeds the number of CPUs/workers. Please reduce the number of workers."
+        )
+
+    page_dir = pathlib.Path(page_dir)
+    page_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = page_dir / "manifest.json"
+    manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+
+    # the source code of the renderer is part of the hash, so editing the figure function renders the pages again
+    renderer_hash = hashlib.sha256(inspect.getsource(render_page).encode()).hexdigest()
+
+    page_records = []
+    for page, page_df in data.groupby(page_column, sort=False, observed=True):
+        page_file = page_dir / f"{re.sub(r'[^A-Za-z0-9_.-]+', '_', str(page))}.pdf"
+        data_hash = hashlib.sha256(
+            (renderer_hash + hash_dataframe(page_df.reset_index(drop=True))).encode()
+        ).hexdigest()
+        is_current = (
+            manifest.get(str(page), {}).get("data_hash") == data_hash
+            and page_file.exists()
+        )
+        page_records.append(
+            {
+                "page": str(page),
+                "page_file": page_file,
+                "data_hash": data_hash,
+                "status": "skipped" if is_current else "rendered",
+                "page_df": page_df,
+            }
+        )
+
+    to_render = [record for record in page_records if record["status"] == "rendered"]
+    if to_render:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            # list() raises any error from the worker processes
+            list(
+                executor.map(
+                    render_page,
+                    [record["page_df"] for record in to_render],
+                    [record["page"] for record in to_render],
+                    [record["page_file"] for record in to_render],
+                )
+            )
+
+    # delete the PDFs of pages that are no longer in the data
+    current_page_files = {record["page_file"].name for record in page_records}
+    for page_info in manifest.values():
+        if page_info["page_file"] not in current_page_files:
+            (page_dir / page_info["page_file"]).unlink(missing_ok=True)
+
+    manifest = {
+        record["page"]: {
+            "data_hash": record["data_hash"],
+            "page_file": record["page_file"].name,
+        }
+        for record in page_records
+    }
+    manifest_path.write_text(json.dumps(manifest, indent=4))
+
+    merge_pdf_pages([record["page_file"] for record in page_records], output_path)
+
+    return pd.DataFrame(
+        [
+            {key: value for key, value in record.items() if key != "page_df"}
+            for record in page_records
+        ]
+    )
@@ -0,0 +1,211 @@
+"""
+This collection of functions standardizes single-cell profiles out-of-core, for plates that do not fit in memory.
+The first pass streams the Parquet file in batches of rows to compute the mean and standard deviation of each
+feature (merging the statistics of each batch), and the second pass streams the file again to write the
+standardized batches. Results match pycytominer `normalize(method="standardize")` (scikit-learn StandardScaler).
+"""
+
+import pathlib
+from typing import Callable, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pycytominer.cyto_utils import infer_cp_features
+
+
+def _iter_profile_batches(
+    profile_path: pathlib.Path,
+    batch_size: int,
+    transform: Optional[Callable[[pd.DataFrame], pd.DataFrame]] = None,
+):
+    """Yield batches of rows from a Parquet file as dataframes, with an optional transform applied.
+
+    Args:
+        profile_path (pathlib.Path): Path to the Parquet file with profiles.
+        batch_size (int): Maximum number of rows in each batch.
+        transform (Optional[Callable[[pd.DataFrame], pd.DataFrame]], optional): Function applied to each batch
+            (e.g., annotation). Defaults to None.
+
+    Yields:
+        pd.DataFrame: Batch of profiles.
+    """
+    for record_batch in pq.ParquetFile(profile_path).iter_batches(
+        batch_size=batch_size
+    ):
+        batch_df = record_batch.to_pandas()
+        yield transform(batch_df) if transform is not None else batch_df
+
+
+def compute_standardize_stats(
+    profile_path: pathlib.Path,
+    features: Union[str, List[str]] = "infer",
+    samples: str = "all",
+    transform: Optional[Callable[[pd.DataFrame], pd.DataFrame]] = None,
+    batch_size: int = 100000,
+) -> Tuple[List[str], pd.DataFrame]:
+    """Compute the count, mean, and standard deviation of each feature in one streaming pass.
+
+    The statistics of each batch are merged with the parallel algorithm of Chan et al., so the result is the
+    same as computing them over all rows at once. Missing values are ignored, as with StandardScaler.
+
+    Args:
+        profile_path (pathlib.Path): Path to the Parquet file with profiles.
+        features (Union[str, List[str]], optional): Features to standardize. Defaults to "infer", which infers
+            the CellProfiler features from the first batch.
+        samples (str, optional): Query of the rows used to compute the statistics. Defaults to "all".
+        transform (Optional[Callable[[pd.DataFrame], pd.DataFrame]], optional): Function applied to each batch
+            before computing statistics (e.g., annotation). Defaults to None.
+        batch_size (int, optional): Maximum number of rows read at a time. Defaults to 100000.
+
+    Raises:
+        ValueError: If the file has no rows or no rows match the samples query.
+
+    Returns:
+        Tuple[List[str], pd.DataFrame]: List of features and dataframe indexed by feature with the columns
+            count, mean, std, and scale (the standard deviation, set to 1 for constant features).
+    """
+    count = mean = m2 = None
+    num_rows = 0
+    for batch_df in _iter_profile_batches(profile_path, batch_size, transform):
+        if features == "infer":
+            features = infer_cp_features(batch_df)
+        if samples != "all":
+            batch_df = batch_df.query(samples)
+        num_rows += batch_df.shape[0]
+
+        values = batch_df[features].to_numpy(dtype=np.float64)
+        batch_count = np.sum(~np.isnan(values), axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            batch_mean = np.nansum(values, axis=0) / batch_count
+        batch_m2 = np.nansum((values - batch_mean) ** 2, axis=0)
+
+        if count is None:
+            count, mean, m2 = batch_count, np.nan_to_num(batch_mean), batch_m2
+            continue
+
+        # merge the batch statistics with the running statistics
+        total_count = count + batch_count
+        with np.errstate(invalid="ignore", divide="ignore"):
+            delta = np.nan_to_num(batch_mean) - mean
+            mean = np.where(
+                total_count > 0, mean + delta * batch_count / total_count, 0.0
+            )
+            m2 = np.where(
+                total_count > 0,
+                m2 + batch_m2 + delta**2 * count * batch_count / total_count,
+                0.0,
+            )
+        count = total_count
+
+    if num_rows == 0:
+        raise ValueError(
+            f"Can not compute the standardization statistics of {profile_path}, which has no rows"
+            + (f" matching the samples query '{samples}'." if samples != "all" else ".")
+        )
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(count > 0, mean, np.nan)
+        variance = np.where(count > 0, m2 / count, np.nan)
+    std = np.sqrt(variance)
+
+    # constant features are scaled by 1 (same bound as StandardScaler for features indistinguishable from constant)
+    eps = np.finfo(np.float64).eps
+    is_constant = variance <= count * eps * variance + (count * mean * eps) ** 2
+    scale = np.where(is_constant | np.isnan(std), 1.0, std)
+
+    stats_df = pd.DataFrame(
+        {"count": count, "mean": mean, "std": std, "scale": scale},
+        index=pd.Index(features, name="feature"),
+    )
+
+    return features, stats_df
+
+
+def standardize_parquet(
+    profile_path: pathlib.Path,
+    output_path: pathlib.Path,
+    features: Union[str, List[str]] = "infer",
+    meta_features: Union[str, List[str]] = "infer",
+    samples: str = "all",
+    transform: Optional[Callable[[pd.DataFrame], pd.DataFrame]] = None,
+    batch_size: int = 100000,
+) -> pd.DataFrame:
+    """Standardize the features of a Parquet file in two streaming passes and write the result to Parquet.
+
+    Memory use depends on the batch size and not on the number of rows in the file. The output has the
+    metadata columns, other Image columns, and standardized features in the same order as pycytominer, and the
+    features are float32 if all input features are float32.
+
+    Args:
+        profile_path (pathlib.Path): Path to the Parquet file with profiles.
+        output_path (pathlib.Path): Path to save the standardized profiles.
+        features (Union[str, List[str]], optional): Features to standardize. Defaults to "infer".
+        meta_features (Union[str, List[str]], optional): Metadata columns to keep. Defaults to "infer", which
+            uses the columns starting with "Metadata_".
+        samples (str, optional): Query of the rows used to compute the statistics. Defaults to "all".
+        transform (Optional[Callable[[pd.DataFrame], pd.DataFrame]], optional): Function applied to each batch
+            before standardizing (e.g., annotation). Defaults to None.
+        batch_size (int, optional): Maximum number of rows read at a time. Defaults to 100000.
+
+    Returns:
+        pd.DataFrame: Statistics used for standardization (from `compute_standardize_stats`).
+    """
+    features, stats_df = compute_standardize_stats(
+        profile_path=profile_path,
+        features=features,
+        samples=samples,
+        transform=transform,
+        batch_size=batch_size,
+    )
+    mean = stats_df["mean"].to_numpy()
+    scale = stats_df["scale"].to_numpy()
+
+    writer = None
+    try:
+        for batch_df in _iter_profile_batches(profile_path, batch_size, transform):
+            if writer is None:
+                if meta_features == "infer":
+                    meta_features = infer_cp_features(batch_df, metadata=True)
+                # other Image columns are kept without being standardized
+                passthrough_columns = [
+                    column
+                    for column in batch_df.columns
+                    if column not in set(features).union(meta_features)
+                    and column.startswith("Image_")
+                ]
+                # float32 features (e.g., compact profiles) stay float32, as with StandardScaler
+                output_dtype = (
+                    np.float32
+                    if (batch_df[features].dtypes == np.float32).all()
+                    else np.float64
+                )
+
+            standardized = (
+                (batch_df[features].to_numpy(dtype=np.float64) - mean) / scale
+            ).astype(output_dtype, copy=False)
+            normalized_df = pd.concat(
+                [
+                    batch_df[meta_features + passthrough_columns].reset_index(
+                        drop=True
+                    ),
+                    pd.DataFrame(standardized, columns=features),
+                ],
+                axis="columns",
+            )
+
+            if writer is None:
+                table = pa.Table.from_pandas(normalized_df, preserve_index=False)
+                writer = pq.ParquetWriter(output_path, table.schema)
+            else:
+                # use the schema of the first batch so every batch is written with the same types
+                table = pa.Table.from_pandas(
+                    normalized_df, schema=writer.schema, preserve_index=False
+                )
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return stats_df
@@ -0,0 +1,175 @@
+"""
+This collection of functions tests whether replicate wells are more correlated than expected by chance with
+permutation testing. The mean Pearson correlation between replicate wells of each condition (e.g., cell line,
+seeding density, and time point) is compared to its null distribution from many shuffles of the features within
+groups. The well pairs and feature matrix are found once and reused by every permutation, and the permutations
+are run in chunks in parallel processes.
+"""
+
+import multiprocessing
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from correlation_utils import PairwisePearson
+from errors.exceptions import MaxWorkerError
+from shuffle_utils import encode_groups, iter_shuffled_replicates
+
+
+def _mean_by_group(
+    values: np.ndarray, group_codes: np.ndarray, num_groups: int
+) -> np.ndarray:
+    """Mean of the values in each group, ignoring missing values."""
+    is_valid = ~np.isnan(values)
+    sums = np.bincount(
+        group_codes[is_valid], weights=values[is_valid], minlength=num_groups
+    )
+    counts = np.bincount(group_codes[is_valid], minlength=num_groups)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return sums / counts
+
+
+def _permutation_chunk(
+    comparer: PairwisePearson,
+    shuffle_group_codes: np.ndarray,
+    start: int,
+    num_permutations: int,
+    seed: int,
+) -> np.ndarray:
+    """Compute the mean correlation of each condition for a chunk of permutations.
+
+    Args:
+        comparer (PairwisePearson): Pairs of replicate wells and the feature matrix.
+        shuffle_group_codes (np.ndarray): Group code of each row that features are shuffled within.
+        start (int): Index of the first permutation of the chunk.
+        num_permutations (int): Number of permutations in the chunk.
+        seed (int): Base seed of the permutations.
+
+    Returns:
+        np.ndarray: Matrix of permutations by conditions with the mean correlation.
+    """
+    num_groups = comparer.group_metadata.shape[0]
+
+    return np.stack(
+        [
+            _mean_by_group(
+                comparer.correlations(shuffled_features),
+                comparer.pair_group_codes,
+                num_groups,
+            )
+            for shuffled_features in iter_shuffled_replicates(
+                comparer.features,
+                shuffle_group_codes,
+                n_replicates=num_permutations,
+                seed=seed,
+                start=start,
+            )
+        ]
+    )
+
+
+def permutation_test(
+    profiles: pd.DataFrame,
+    feature_columns: List[str],
+    condition_columns: List[str] = [
+        "Metadata_cell_line",
+        "Metadata_seeding_density",
+        "Metadata_time_point",
+    ],
+    shuffle_columns: List[str] = ["Metadata_time_point"],
+    well_column: str = "Metadata_Well",
+    num_permutations: int = 1000,
+    seed: int = 0,
+    chunk_size: int = 100,
+    max_workers: Optional[int] = None,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Test if the replicate wells of each condition are more correlated than profiles with shuffled features.
+
+    The p-value of a condition is the proportion of permutations with a mean correlation at least as high as
+    the observed mean correlation, counting the observed value as one permutation.
+
+    Args:
+        profiles (pd.DataFrame): Profiles of one plate (e.g., feature-selected bulk profiles).
+        feature_columns (List[str]): Feature columns used for the correlations.
+        condition_columns (List[str], optional): Columns defining the replicate wells of a condition.
+            Defaults to ["Metadata_cell_line", "Metadata_seeding_density", "Metadata_time_point"].
+        shuffle_columns (List[str], optional): Columns defining the groups the features are shuffled within.
+            Defaults to ["Metadata_time_point"].
+        well_column (str, optional): Column with the well of each profile. Defaults to "Metadata_Well".
+        num_permutations (int, optional): Number of permutations. Defaults to 1000.
+        seed (int, optional): Base seed of the permutations. Defaults to 0.
+        chunk_size (int, optional): Number of permutations computed by a process at a time. Defaults to 100.
+        max_workers (Optional[int], optional): Number of processes. Defaults to None, which uses the number of
+            CPUs.
+
+    Raises:
+        MaxWorkerError: If max_workers exceeds the number of CPUs.
+
+    Returns:
+        Tuple[pd.DataFrame, pd.DataFrame]: Summary with one row per condition (observed mean correlation, mean
+            and standard deviation of the null distribution, 95% interval of the null distribution, and empirical
+            p-value) and the null distributions with one row per condition and permutation.
+    """
+    if max_workers is None:
+        max_workers = multiprocessing.cpu_count()
+    if max_workers > multiprocessing.cpu_count():
+        raise MaxWorkerError(
+            "Exception occurred: The number of workers exceeds the number of CPUs/workers. Please reduce the number of workers."
+        )
+
+    comparer = PairwisePearson(
+        profiles=profiles,
+        feature_columns=feature_columns,
+        same_columns=condition_columns,
+        different_columns=[well_column],
+        drop_columns=[well_column],
+    )
+    num_groups = comparer.group_metadata.shape[0]
+    shuffle_group_codes = encode_groups(profiles, shuffle_columns)
+
+    observed = _mean_by_group(
+        comparer.correlations(), comparer.pair_group_codes, num_groups
+    )
+
+    # each chunk generates its own permutations from the base seed, so results do not depend on the chunks
+    chunk_starts = range(0, num_permutations, chunk_size)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        chunks = executor.map(
+            _permutation_chunk,
+            [comparer] * len(chunk_starts),
+            [shuffle_group_codes] * len(chunk_starts),
+            chunk_starts,
+            [min(chunk_size, num_permutations - start) for start in chunk_starts],
+            [seed] * len(chunk_starts),
+        )
+        null_means = np.concatenate(list(chunks), axis=0)
+
+    # conditions with a single well have no pairs, so their statistics are missing
+    summary_df = comparer.group_metadata.copy()
+    summary_df["observed_mean_correlation"] = observed
+    summary_df["num_pairs"] = np.bincount(
+        comparer.pair_group_codes, minlength=num_groups
+    )
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        summary_df["null_mean_correlation"] = np.nanmean(null_means, axis=0)
+        summary_df["null_std_correlation"] = np.nanstd(null_means, axis=0)
+        summary_df["null_ci_lower"] = np.nanpercentile(null_means, 2.5, axis=0)
+        summary_df["null_ci_upper"] = np.nanpercentile(null_means, 97.5, axis=0)
+    summary_df["num_permutations"] = num_permutations
+    summary_df["p_value"] = np.where(
+        np.isnan(observed),
+        np.nan,
+        (1 + np.sum(null_means >= observed, axis=0)) / (1 + num_permutations),
+    )
+
+    null_df = comparer.group_metadata.iloc[
+        np.tile(np.arange(num_groups), num_permutations)
+    ].reset_index(drop=True)
+    null_df["permutation"] = np.repeat(np.arange(num_permutations), num_groups)
+    null_df["mean_correlation"] = null_means.ravel()
+
+    return summary_df, null_df
@@ -0,0 +1,623 @@
+"""
+This collection of functions runs the pipeline (LoadData, illumination correction, CellProfiler analysis,
+conversion, single-cell QC, bulk and single-cell processing, QC report, and optimization) as a graph of tasks.
+Stages that process one plate at a time are separate tasks per plate, so independent plates run concurrently and a
+plate can move to the next stage without waiting for the other plates. The hashes of the inputs and outputs of each
+task are saved, and a task is only run again when it is stale (its command or inputs changed, or its outputs are
+missing or were modified).
+"""
+
+import hashlib
+import json
+import os
+import pathlib
+import subprocess
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+from results_store import file_hash
+
+# conda environment of each part of the pipeline
+PIPELINE_ENVIRONMENTS = {
+    "cellprofiler": "alsf_cp_env",
+    "preprocessing": "alsf_preprocessing_env",
+    "optimization": "optimization_env",
+}
+
+
+class PipelineTask:
+    """
+    A command with the paths it reads and writes and the tasks that must finish before it.
+
+    Attributes:
+        name (str): Unique name of the task (e.g., convert/Round_4_data/BR00148746).
+        command (List[str]): Command and its arguments.
+        cwd (pathlib.Path): Directory the command is run from.
+        inputs (List[pathlib.Path]): Files or directories read by the task (including the script it runs).
+        outputs (List[pathlib.Path]): Files or directories written by the task (their parent directories are
+            created when the task runs).
+        depends_on (List[str]): Names of the tasks that must finish before this task.
+        environment (Optional[str]): Conda environment the command is run in, or None to run it directly.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        command: List[str],
+        cwd: pathlib.Path,
+        inputs: List[pathlib.Path],
+        outputs: List[pathlib.Path],
+        depends_on: Optional[List[str]] = None,
+        environment: Optional[str] = None,
+    ):
+        self.name = name
+        self.command = list(command)
+        self.cwd = pathlib.Path(cwd)
+        self.inputs = [pathlib.Path(path) for path in inputs]
+        self.outputs = [pathlib.Path(path) for path in outputs]
+        self.depends_on = list(depends_on or [])
+        self.environment = environment
+
+    def full_command(self) -> List[str]:
+        """Get the command, run with `conda run` in the task's environment if it has one."""
+        if self.environment is None:
+            return self.command
+
+        return [
+            "conda",
+            "run",
+            "--no-capture-output",
+            "-n",
+            self.environment,
+        ] + self.command
+
+
+class PipelineRunner:
+    """
+    Run the stale tasks of a pipeline in dependency order, with independent tasks running concurrently.
+
+    Attributes:
+        tasks (Dict[str, PipelineTask]): Dictionary of task name to task, in topological order.
+        state_path (pathlib.Path): JSON file with the signature and output hashes of every completed task.
+        log_dir (pathlib.Path): Directory with the output (stdout and stderr) of every task that was run.
+        state (Dict[str, dict]): Saved state of the completed tasks.
+    """
+
+    def __init__(
+        self,
+        tasks: List[PipelineTask],
+        state_path: pathlib.Path,
+        log_dir: Optional[pathlib.Path] = None,
+    ):
+        """
+        Args:
+            tasks (List[PipelineTask]): Tasks of the pipeline.
+            state_path (pathlib.Path): JSON file with the state of the completed tasks.
+            log_dir (Optional[pathlib.Path], optional): Directory of the task logs. Defaults to None, which uses
+                a `logs` directory next to the state file.
+
+        Raises:
+            ValueError: If task names are not unique, a dependency does not exist, or the dependencies have a
+                cycle.
+        """
+        names = [task.name for task in tasks]
+        duplicate_names = sorted({name for name in names if names.count(name) > 1})
+        if duplicate_names:
+            raise ValueError(f"Task names must be unique: {duplicate_names}.")
+        tasks_by_name = {task.name: task for task in tasks}
+        for task in tasks:
+            missing_dependencies = [
+                name for name in task.depends_on if name not in tasks_by_name
+            ]
+            if missing_dependencies:
+                raise ValueError(
+                    f"Task {task.name} depends on tasks that do not exist: {missing_dependencies}."
+                )
+
+        # topological order (depth-first), which also finds cycles
+        ordered_names: List[str] = []
+        visiting = set()
+
+        def _visit(name: str) -> None:
+            if name in ordered_names:
+                return
+            if name in visiting:
+                raise ValueError(f"The task dependencies have a cycle through {name}.")
+            visiting.add(name)
+            for dependency in tasks_by_name[name].depends_on:
+                _visit(dependency)
+            visiting.discard(name)
+            ordered_names.append(name)
+
+        for name in names:
+            _visit(name)
+
+        self.tasks = {name: tasks_by_name[name] for name in ordered_names}
+        self.state_path = pathlib.Path(state_path)
+        self.log_dir = pathlib.Path(log_dir or self.state_path.parent / "logs")
+        self.state: Dict[str, dict] = (
+            json.loads(self.state_path.read_text()) if self.state_path.exists() else {}
+        )
+        # file hashes are cached by path, size, and modification time, so unchanged files are not read again
+        self._hash_cache: Dict[str, dict] = self.state.pop("__file_hashes__", {})
+        self._lock = threading.Lock()
+
+    def _file_hash(self, path: pathlib.Path) -> str:
+        stat = path.stat()
+        key = str(path.resolve())
+        with self._lock:
+            cached = self._hash_cache.get(key)
+        if (
+            cached is not None
+            and cached["size"] == stat.st_size
+            and cached["mtime_ns"] == stat.st_mtime_ns
+        ):
+            return cached["hash"]
+
+        path_hash = file_hash(path)
+        with self._lock:
+            self._hash_cache[key] = {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "hash": path_hash,
+            }
+
+        return path_hash
+
+    def path_hash(self, path: pathlib.Path) -> Optional[str]:
+        """Compute the hash of a file, or of the relative paths and hashes of all files in a directory.
+
+        Args:
+            path (pathlib.Path): Path to a file or directory.
+
+        Returns:
+            Optional[str]: Hexadecimal hash, or None if the path does not exist.
+        """
+        path = pathlib.Path(path)
+        if not path.exists():
+            return None
+        if path.is_file():
+            return self._file_hash(path)
+
+        directory_hasher = hashlib.sha256()
+        for file_path in sorted(item for item in path.rglob("*") if item.is_file()):
+            directory_hasher.update(str(file_path.relative_to(path)).encode())
+            directory_hasher.update(self._file_hash(file_path).encode())
+
+        return directory_hasher.hexdigest()
+
+    def task_signature(self, task: PipelineTask) -> str:
+        """Compute the signature of a task from its command, environment, and the hashes of its inputs.
+
+        Args:
+            task (PipelineTask): Task of the pipeline.
+
+        Returns:
+            str: Hexadecimal hash of the task.
+        """
+        signature = {
+            "command": task.command,
+            "environment": task.environment,
+            "inputs": {str(path): self.path_hash(path) for path in task.inputs},
+        }
+
+        return hashlib.sha256(
+            json.dumps(signature, sort_keys=True).encode()
+        ).hexdigest()
+
+    def is_stale(self, task: PipelineTask) -> bool:
+        """Check if a task needs to run, because it never completed, its signature changed, or its outputs are
+        missing or changed since it ran.
+
+        Args:
+            task (PipelineTask): Task of the pipeline.
+
+        Returns:
+            bool: True if the task needs to run.
+        """
+        task_state = self.state.get(task.name)
+        if task_state is None or task_state["signature"] != self.task_signature(task):
+            return True
+
+        return any(
+            self.path_hash(path) is None
+            or task_state["outputs"].get(str(path)) != self.path_hash(path)
+            for path in task.outputs
+        )
+
+    def _save_state(self) -> None:
+        with self._lock:
+            state = {**self.state, "__file_hashes__": self._hash_cache}
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        self.state_path.write_text(json.dumps(state, indent=4))
+
+    def _run_task(self, task: PipelineTask) -> dict:
+        """Run a task if it is stale and save its state when it completes.
+
+        Args:
+            task (PipelineTask): Task of the pipeline.
+
+        Returns:
+            dict: Dictionary with the task name, status (skipped, completed, or failed), and run time.
+        """
+        start_time = time.perf_counter()
+        if not self.is_stale(task):
+            return {"task": task.name, "status": "skipped", "seconds": 0.0}
+
+        log_path = self.log_dir / f"{task.name.replace('/', '__')}.log"
+        log_path.parent.mkdir(parents=True, exist_ok=True)
+        # directories are only created when a task runs (e.g., not when listing the stale tasks)
+        for path in task.outputs:
+            path.parent.mkdir(parents=True, exist_ok=True)
+        with open(log_path, "w") as log_file:
+            returncode = subprocess.run(
+                task.full_command(),
+                cwd=task.cwd,
+                stdout=log_file,
+                stderr=subprocess.STDOUT,
+                env=os.environ.copy(),
+            ).returncode
+
+        missing_outputs = [path for path in task.outputs if not path.exists()]
+        if returncode != 0 or missing_outputs:
+            # a failed task always runs again, even if its outputs were not changed
+            with self._lock:
+                self.state.pop(task.name, None)
+            self._save_state()
+            return {
+                "task": task.name,
+                "status": "failed",
+                "seconds": time.perf_counter() - start_time,
+                "error": (
+                    f"exit code {returncode}, see {log_path}"
+                    if returncode != 0
+                    else f"missing outputs {[str(path) for path in missing_outputs]}"
+                ),
+            }
+
+        task_state = {
+            "signature": self.task_signature(task),
+            "outputs": {str(path): self.path_hash(path) for path in task.outputs},
+        }
+        with self._lock:
+            self.state[task.name] = task_state
+        self._save_state()
+
+        return {
+            "task": task.name,
+            "status": "completed",
+            "seconds": time.perf_counter() - start_time,
+        }
+
+    def stale_tasks(self) -> List[str]:
+        """Find the tasks that would run, without running anything.
+
+        A task whose dependency is stale is also stale, since its inputs may change.
+
+        Returns:
+            List[str]: Names of the stale tasks, in topological order.
+        """
+        stale_names: List[str] = []
+        for name, task in self.tasks.items():
+            if any(dependency in stale_names for dependency in task.depends_on) or (
+                self.is_stale(task)
+            ):
+                stale_names.append(name)
+
+        return stale_names
+
+    def run(self, max_workers: int = 4) -> pd.DataFrame:
+        """Run the stale tasks, starting each task as soon as all of its dependencies have finished.
+
+        Tasks that depend on a failed task are not run, and the other tasks continue.
+
+        Args:
+            max_workers (int, optional): Maximum number of tasks running at the same time. Defaults to 4.
+
+        Returns:
+            pd.DataFrame: Dataframe with the status (skipped, completed, failed, or blocked), run time, and error
+                of every task.
+        """
+        results: Dict[str, dict] = {}
+        remaining = dict(self.tasks)
+        running: Dict[Future, str] = {}
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while remaining or running:
+                for name, task in list(remaining.items()):
+                    dependency_status = [
+                        results[dependency]["status"]
+                        for dependency in task.depends_on
+                        if dependency in results
+                    ]
+                    if any(
+                        status in ("failed", "blocked") for status in dependency_status
+                    ):
+                        results[name] = {
+                            "task": name,
+                            "status": "blocked",
+                            "seconds": 0.0,
+                        }
+                        del remaining[name]
+                    elif len(dependency_status) == len(task.depends_on):
+                        running[executor.submit(self._run_task, task)] = name
+                        del remaining[name]
+
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as error:
+                        results[name] = {
+                            "task": name,
+                            "status": "failed",
+                            "seconds": 0.0,
+                            "error": repr(error),
+                        }
+                    print(f"{name}: {results[name]['status']}")
+
+        self._save_state()
+
+        return pd.DataFrame(
+            [results[name] for name in self.tasks],
+            columns=["task", "status", "seconds", "error"],
+        )
+
+
+def _papermill_command(
+    notebook: str, executed_notebook: pathlib.Path, parameters: Dict[str, str]
+) -> List[str]:
+    """Create the papermill command that runs a notebook with parameters (set in its `parameters` cell).
+
+    Args:
+        notebook (str): Name of the notebook.
+        executed_notebook (pathlib.Path): Path to save the executed notebook.
+        parameters (Dict[str, str]): Dictionary of parameter name to value (e.g., round_id and plate_id).
+
+    Returns:
+        List[str]: Command and its arguments.
+    """
+    command = ["papermill", notebook, str(executed_notebook)]
+    for name, value in parameters.items():
+        command += ["-p", name, value]
+
+    return command
+
+
+def build_round_tasks(
+    repo_dir: pathlib.Path,
+    round_id: str,
+    plates: List[str],
+    environments: Dict[str, str] = PIPELINE_ENVIRONMENTS,
+) -> List[PipelineTask]:
+    """Create the tasks of the pipeline for one round of data.
+
+    LoadData, illumination correction, and the LoadData CSVs for analysis are run once for the round, and the
+    CellProfiler analysis, conversion with CytoTable, and single-cell QC are run per plate. Bulk and single-cell
+    processing and the QC report start when every plate passed QC, and the optimization starts when the bulk
+    profiles are done. The round (and plate) is passed to every script, with `--round_id` for the CellProfiler
+    scripts and as papermill parameters for the preprocessing notebooks.
+
+    Args:
+        repo_dir (pathlib.Path): Root directory of the repository.
+        round_id (str): Round of data (e.g., Round_4_data).
+        plates (List[str]): Plate barcodes of the round.
+        environments (Dict[str, str], optional): Dictionary of pipeline part (cellprofiler, preprocessing, and
+            optimization) to its conda environment. Defaults to PIPELINE_ENVIRONMENTS.
+
+    Returns:
+        List[PipelineTask]: Tasks of the round.
+    """
+    repo_dir = pathlib.Path(repo_dir).resolve()
+    illum_dir = repo_dir / "1.illumination_correction"
+    analysis_dir = repo_dir / "2.feature_extraction"
+    preprocessing_dir = repo_dir / "3.preprocessing_features"
+    # papermill writes the executed notebooks here (per plate, so plates running at the same time do not write to
+    # the same notebook)
+    notebook_dir = repo_dir / "pipeline_state" / "notebooks" / round_id
+
+    # LoadData CSV of each plate for the analysis (re-imaged wells concatenated to the original plate)
+    analysis_loaddata_csvs = {
+        plate: analysis_dir
+        / f"loaddata_csvs/{round_id}/{plate}_concatenated_with_illum.csv"
+        for plate in plates
+    }
+
+    tasks = [
+        PipelineTask(
+            name=f"loaddata/{round_id}",
+            command=[
+                "python",
+                "nbconverted/0.create_loaddata_csvs.py",
+                "--round_id",
+                round_id,
+            ],
+            cwd=illum_dir,
+            inputs=[
+                illum_dir / "nbconverted/0.create_loaddata_csvs.py",
+                illum_dir / "config_files",
+            ],
+            outputs=[illum_dir / "loaddata_csvs" / round_id],
+            environment=environments["cellprofiler"],
+        ),
+        PipelineTask(
+            name=f"illum/{round_id}",
+            command=[
+                "python",
+                "nbconverted/1.cp_illum_correction.py",
+                "--round_id",
+                round_id,
+            ],
+            cwd=illum_dir,
+            inputs=[
+                illum_dir / "nbconverted/1.cp_illum_correction.py",
+                illum_dir / "pipelines",
+                illum_dir / "loaddata_csvs" / round_id,
+            ],
+            outputs=[illum_dir / "illum_directory" / round_id],
+            depends_on=[f"loaddata/{round_id}"],
+            environment=environments["cellprofiler"],
+        ),
+        PipelineTask(
+            name=f"analysis_loaddata/{round_id}",
+            command=[
+                "python",
+                "nbconverted/0.create_loaddata_csvs.py",
+                "--round_id",
+                round_id,
+            ],
+            cwd=analysis_dir,
+            inputs=[
+                analysis_dir / "nbconverted/0.create_loaddata_csvs.py",
+                illum_dir / "loaddata_csvs" / round_id,
+                illum_dir / "illum_directory" / round_id,
+            ],
+            outputs=list(analysis_loaddata_csvs.values()),
+            depends_on=[f"illum/{round_id}"],
+            environment=environments["cellprofiler"],
+        ),
+    ]
+
+    for plate in plates:
+        sqlite_dir = analysis_dir / "sqlite_outputs" / round_id / plate
+        converted_file = (
+            preprocessing_dir
+            / f"data/converted_profiles/{round_id}/{plate}_converted.parquet"
+        )
+        tasks += [
+            PipelineTask(
+                name=f"analysis/{round_id}/{plate}",
+                command=[
+                    "python",
+                    "nbconverted/1.cp_analysis_hpc.py",
+                    "--input_csv",
+                    str(analysis_loaddata_csvs[plate]),
+                    "--round_id",
+                    round_id,
+                ],
+                cwd=analysis_dir,
+                inputs=[
+                    analysis_dir / "nbconverted/1.cp_analysis_hpc.py",
+                    analysis_dir / "analysis.cppipe",
+                    analysis_loaddata_csvs[plate],
+                ],
+                outputs=[sqlite_dir],
+                depends_on=[f"analysis_loaddata/{round_id}"],
+                environment=environments["cellprofiler"],
+            ),
+            PipelineTask(
+                name=f"convert/{round_id}/{plate}",
+                command=_papermill_command(
+                    "0.convert_cytotable.ipynb",
+                    notebook_dir / f"{plate}_0.convert_cytotable.ipynb",
+                    {"plate_id": plate, "round_id": round_id},
+                ),
+                cwd=preprocessing_dir,
+                inputs=[preprocessing_dir / "0.convert_cytotable.ipynb", sqlite_dir],
+                outputs=[
+                    converted_file,
+                    notebook_dir / f"{plate}_0.convert_cytotable.ipynb",
+                ],
+                depends_on=[f"analysis/{round_id}/{plate}"],
+                environment=environments["preprocessing"],
+            ),
+            PipelineTask(
+                name=f"qc/{round_id}/{plate}",
+                command=_papermill_command(
+                    "1.sc_quality_control.ipynb",
+                    notebook_dir / f"{plate}_1.sc_quality_control.ipynb",
+                    {"plate_id": plate, "round_id": round_id},
+                ),
+                cwd=preprocessing_dir,
+                inputs=[
+                    preprocessing_dir / "1.sc_quality_control.ipynb",
+                    converted_file,
+                ],
+                outputs=[
+                    preprocessing_dir
+                    / f"qc_results/{round_id}/{plate}_qc_results.parquet",
+                    preprocessing_dir
+                    / f"data/cleaned_profiles/{round_id}/{plate}_cleaned.parquet",
+                    notebook_dir / f"{plate}_1.sc_quality_control.ipynb",
+                ],
+                depends_on=[f"convert/{round_id}/{plate}"],
+                environment=environments["preprocessing"],
+            ),
+        ]
+
+    qc_tasks = [f"qc/{round_id}/{plate}" for plate in plates]
+    qc_inputs = [
+        preprocessing_dir / f"data/cleaned_profiles/{round_id}",
+        preprocessing_dir / f"qc_results/{round_id}",
+    ]
+    round_notebooks = [
+        ("bulk", "2.bulk_processing.ipynb", f"data/bulk_profiles/{round_id}"),
+        (
+            "single_cell",
+            "3.single_cell_processing.ipynb",
+            f"data/single_cell_profiles/{round_id}",
+        ),
+        (
+            "qc_report",
+            "4.sc_qc_report.ipynb",
+            f"qc_report/{round_id}_qc_report.parquet",
+        ),
+    ]
+    for name, notebook, output in round_notebooks:
+        tasks.append(
+            PipelineTask(
+                name=f"{name}/{round_id}",
+                command=_papermill_command(
+                    notebook, notebook_dir / notebook, {"round_id": round_id}
+                ),
+                cwd=preprocessing_dir,
+                inputs=[preprocessing_dir / notebook] + qc_inputs,
+                outputs=[preprocessing_dir / output, notebook_dir / notebook],
+                depends_on=qc_tasks,
+                environment=environments["preprocessing"],
+            )
+        )
+
+    return tasks
+
+
+def build_optimization_task(
+    repo_dir: pathlib.Path,
+    round_ids: List[str],
+    environments: Dict[str, str] = PIPELINE_ENVIRONMENTS,
+) -> PipelineTask:
+    """Create the optimization task, which compares the bulk profiles of every round.
+
+    Plates that did not change are not recomputed by the optimization (see `PlateResultsStore`).
+
+    Args:
+        repo_dir (pathlib.Path): Root directory of the repository.
+        round_ids (List[str]): Rounds whose bulk profiles must be done before the optimization.
+        environments (Dict[str, str], optional): Dictionary of pipeline part to its conda environment.
+            Defaults to PIPELINE_ENVIRONMENTS.
+
+    Returns:
+        PipelineTask: Optimization task.
+    """
+    repo_dir = pathlib.Path(repo_dir).resolve()
+    optimization_dir = repo_dir / "4.optimization"
+
+    return PipelineTask(
+        name="optimization",
+        command=["python", "scripts/0.pairwise-compare.py"],
+        cwd=optimization_dir,
+        inputs=[
+            optimization_dir / "scripts/0.pairwise-compare.py",
+            repo_dir / "3.preprocessing_features/data/bulk_profiles",
+        ],
+        outputs=[optimization_dir / "results/pairwise_compare.parquet"],
+        depends_on=[f"bulk/{round_id}" for round_id in round_ids],
+        environment=environments["optimization"],
+    )
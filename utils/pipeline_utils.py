@@ -0,0 +1,365 @@
+"""
+This collection of functions chains the pycytominer annotate, normalize, and feature_select steps in memory,
+so profiles are not written to Parquet and read back between steps. Intermediate profiles are only saved when
+requested, using a background writer thread so saving does not block the next step.
+"""
+
+import pathlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from typing import Dict, List, Optional
+
+import pandas as pd
+import pyarrow.parquet as pq
+from pycytominer import annotate, feature_select, normalize
+from pycytominer.cyto_utils import output
+
+from compact_dtype_utils import compact_profiles, write_compact_report
+from feature_select_utils import (
+    compute_feature_select_stats,
+    select_features_from_stats,
+    write_selected_features,
+)
+from normalize_utils import standardize_parquet
+from plate_executor import StageTimer
+
+
+def annotate_profiles(
+    profiles: pd.DataFrame,
+    platemap: pd.DataFrame,
+    join_on: List[str] = ["Metadata_well", "Image_Metadata_Well"],
+    added_metadata: Optional[Dict[str, object]] = None,
+    rename_columns: Optional[Dict[str, str]] = None,
+) -> pd.DataFrame:
+    """Annotate profiles with the platemap, add constant metadata columns, and rename columns.
+
+    Args:
+        profiles (pd.DataFrame): Bulk or single-cell profiles of the plate.
+        platemap (pd.DataFrame): Platemap of the plate.
+        join_on (List[str], optional): Columns in the platemap and profiles to merge on.
+            Defaults to ["Metadata_well", "Image_Metadata_Well"].
+        added_metadata (Optional[Dict[str, object]], optional): Metadata columns with a constant value to add
+            after annotation (e.g., {"Metadata_time_point": "24H"}). Defaults to None.
+        rename_columns (Optional[Dict[str, str]], optional): Columns to rename after annotation.
+            Defaults to None.
+
+    Returns:
+        pd.DataFrame: Annotated profiles.
+    """
+    annotated_df = annotate(profiles=profiles, platemap=platemap, join_on=join_on)
+    for column, value in (added_metadata or {}).items():
+        annotated_df[column] = value
+    if rename_columns:
+        annotated_df = annotated_df.rename(columns=rename_columns)
+
+    return annotated_df
+
+
+class ProfilePipeline:
+    """
+    Run annotate → normalize → feature_select on dataframes in memory and save the outputs in the background.
+
+    Attributes:
+        feature_select_ops (List[str]): Feature selection operations to perform.
+        na_cutoff (float): Proportion of missing values allowed per feature for `drop_na_columns`.
+        normalize_samples (str): Samples used to fit the normalization (e.g., "all").
+        save_intermediate_profiles (bool): Whether to also save the annotated and normalized profiles.
+        compact_dtypes (bool): Whether to save profiles with compact data types (float32 features, categorical
+            metadata, and downcast integers).
+    """
+
+    def __init__(
+        self,
+        feature_select_ops: List[str],
+        na_cutoff: float = 0,
+        normalize_samples: str = "all",
+        save_intermediate_profiles: bool = False,
+        compact_dtypes: bool = False,
+    ):
+        self.feature_select_ops = feature_select_ops
+        self.na_cutoff = na_cutoff
+        self.normalize_samples = normalize_samples
+        self.save_intermediate_profiles = save_intermediate_profiles
+        self.compact_dtypes = compact_dtypes
+
+        # one writer thread so files are saved in the order they are submitted
+        self._writer = ThreadPoolExecutor(max_workers=1)
+        self._write_futures: List[Future] = []
+
+    def __enter__(self) -> "ProfilePipeline":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def _write(self, df: pd.DataFrame, output_file: pathlib.Path) -> None:
+        """Save a dataframe to Parquet, converting it to compact data types if requested.
+
+        Args:
+            df (pd.DataFrame): Dataframe to save.
+            output_file (pathlib.Path): Path to the output Parquet file.
+        """
+        if self.compact_dtypes:
+            df, report_df = compact_profiles(df)
+            # only features that were still float64 are in the report
+            if report_df.shape[0]:
+                write_compact_report(
+                    report_df,
+                    pathlib.Path(
+                        str(output_file).replace(".parquet", "_compact_report.csv")
+                    ),
+                )
+
+        output(df=df, output_filename=str(output_file), output_type="parquet")
+
+    def persist(self, df: pd.DataFrame, output_file: pathlib.Path) -> Future:
+        """Save a dataframe to Parquet in the background writer thread.
+
+        The dataframe must not be modified after it is submitted. With `compact_dtypes`, a validation report of
+        the features downcast to float32 is saved next to the Parquet file.
+
+        Args:
+            df (pd.DataFrame): Dataframe to save.
+            output_file (pathlib.Path): Path to the output Parquet file.
+
+        Returns:
+            Future: Future of the write.
+        """
+        future = self._writer.submit(self._write, df=df, output_file=output_file)
+        self._write_futures.append(future)
+
+        return future
+
+    def annotate_and_normalize(
+        self,
+        profiles: pd.DataFrame,
+        platemap: pd.DataFrame,
+        output_files: Dict[str, pathlib.Path],
+        join_on: List[str] = ["Metadata_well", "Image_Metadata_Well"],
+        added_metadata: Optional[Dict[str, object]] = None,
+        rename_columns: Optional[Dict[str, str]] = None,
+    ) -> pd.DataFrame:
+        """Annotate and normalize the profiles of one plate.
+
+        Args:
+            profiles (pd.DataFrame): Bulk or single-cell profiles of the plate.
+            platemap (pd.DataFrame): Platemap of the plate.
+            output_files (Dict[str, pathlib.Path]): Output paths with the keys "annotated" and "normalized",
+                only saved if `save_intermediate_profiles` is True.
+            join_on (List[str], optional): Columns in the platemap and profiles to merge on.
+                Defaults to ["Metadata_well", "Image_Metadata_Well"].
+            added_metadata (Optional[Dict[str, object]], optional): Metadata columns with a constant value to add
+                after annotation (e.g., {"Metadata_time_point": "24H"}). Defaults to None.
+            rename_columns (Optional[Dict[str, str]], optional): Columns to rename after annotation.
+                Defaults to None.
+
+        Returns:
+            pd.DataFrame: Normalized profiles.
+        """
+        annotated_df = annotate_profiles(
+            profiles=profiles,
+            platemap=platemap,
+            join_on=join_on,
+            added_metadata=added_metadata,
+            rename_columns=rename_columns,
+        )
+
+        if self.save_intermediate_profiles:
+            self.persist(annotated_df, output_files["annotated"])
+
+        normalized_df = normalize(
+            profiles=annotated_df,
+            method="standardize",
+            samples=self.normalize_samples,
+        )
+        # drop the reference so the annotated profiles are freed once saved
+        del annotated_df
+
+        if self.save_intermediate_profiles:
+            self.persist(normalized_df, output_files["normalized"])
+
+        return normalized_df
+
+    def run(
+        self,
+        profiles: pd.DataFrame,
+        platemap: pd.DataFrame,
+        output_files: Dict[str, pathlib.Path],
+        join_on: List[str] = ["Metadata_well", "Image_Metadata_Well"],
+        added_metadata: Optional[Dict[str, object]] = None,
+        rename_columns: Optional[Dict[str, str]] = None,
+    ) -> pd.DataFrame:
+        """Annotate, normalize, and feature select the profiles of one plate.
+
+        Args:
+            profiles (pd.DataFrame): Bulk or single-cell profiles of the plate.
+            platemap (pd.DataFrame): Platemap of the plate.
+            output_files (Dict[str, pathlib.Path]): Output paths with the keys "annotated", "normalized", and
+                "feature_selected". The feature-selected profiles are always saved, the other profiles only if
+                `save_intermediate_profiles` is True.
+            join_on (List[str], optional): Columns in the platemap and profiles to merge on.
+                Defaults to ["Metadata_well", "Image_Metadata_Well"].
+            added_metadata (Optional[Dict[str, object]], optional): Metadata columns with a constant value to add
+                after annotation (e.g., {"Metadata_time_point": "24H"}). Defaults to None.
+            rename_columns (Optional[Dict[str, str]], optional): Columns to rename after annotation.
+                Defaults to None.
+
+        Returns:
+            pd.DataFrame: Feature-selected profiles.
+        """
+        normalized_df = self.annotate_and_normalize(
+            profiles=profiles,
+            platemap=platemap,
+            output_files=output_files,
+            join_on=join_on,
+            added_metadata=added_metadata,
+            rename_columns=rename_columns,
+        )
+
+        feature_selected_df = feature_select(
+            profiles=normalized_df,
+            operation=self.feature_select_ops,
+            na_cutoff=self.na_cutoff,
+        )
+        del normalized_df
+
+        self.persist(feature_selected_df, output_files["feature_selected"])
+
+        return feature_selected_df
+
+    def wait(self) -> None:
+        """Wait for all submitted writes to finish and raise any errors from saving."""
+        write_futures, self._write_futures = self._write_futures, []
+        for future in write_futures:
+            future.result()
+
+    def close(self) -> None:
+        """Wait for all submitted writes and stop the writer thread."""
+        try:
+            self.wait()
+        finally:
+            self._writer.shutdown(wait=True)
+
+
+def process_single_cell_plate(
+    plate: str,
+    info: dict,
+    output_dir: pathlib.Path,
+    feature_select_ops: List[str],
+    rename_columns: Optional[Dict[str, str]] = None,
+    save_intermediate_profiles: bool = False,
+    out_of_core_normalization: bool = False,
+    select_features: bool = True,
+    batch_size: int = 100000,
+    correlation_sample_fraction: Optional[float] = None,
+    compact_dtypes: bool = False,
+) -> Dict[str, float]:
+    """Annotate, normalize, and feature select the single-cell profiles of one plate and save the outputs.
+
+    Args:
+        plate (str): Name of the plate.
+        info (dict): Plate information with the profile_path, platemap_path, and time_point.
+        output_dir (pathlib.Path): Directory to save the single-cell profiles.
+        feature_select_ops (List[str]): Feature selection operations to perform.
+        rename_columns (Optional[Dict[str, str]], optional): Columns to rename after annotation.
+            Defaults to None.
+        save_intermediate_profiles (bool, optional): Whether to also save the annotated and normalized profiles.
+            Defaults to False.
+        out_of_core_normalization (bool, optional): Whether to annotate and standardize in batches of rows and
+            select features from streaming statistics, for plates larger than memory. Defaults to False.
+        select_features (bool, optional): Whether to select features for the plate. If False, the normalized
+            profiles are saved for round-level feature selection. Defaults to True.
+        batch_size (int, optional): Number of rows read at a time for out-of-core normalization.
+            Defaults to 100000.
+        correlation_sample_fraction (Optional[float], optional): Fraction of single-cells sampled for the
+            feature correlations in out-of-core mode. Defaults to None, which uses all single-cells.
+        compact_dtypes (bool, optional): Whether to save the profiles with compact data types. Float32 features
+            stay float32 through normalization in both modes, and in-memory mode also stores the metadata as
+            categoricals. Defaults to False.
+
+    Returns:
+        Dict[str, float]: Number of seconds spent in each stage.
+    """
+    timer = StageTimer()
+    output_files = {
+        "annotated": pathlib.Path(f"{output_dir}/{plate}_sc_annotated.parquet"),
+        "normalized": pathlib.Path(f"{output_dir}/{plate}_sc_normalized.parquet"),
+        "feature_selected": pathlib.Path(
+            f"{output_dir}/{plate}_sc_feature_selected.parquet"
+        ),
+    }
+    annotate_kwargs = {
+        "join_on": ["Metadata_well", "Image_Metadata_Well"],
+        "added_metadata": {"Metadata_time_point": info["time_point"]},
+        "rename_columns": rename_columns,
+    }
+
+    with ProfilePipeline(
+        feature_select_ops=feature_select_ops,
+        na_cutoff=0,
+        save_intermediate_profiles=save_intermediate_profiles,
+        compact_dtypes=compact_dtypes,
+    ) as pipeline:
+        with timer.stage("load"):
+            platemap_df = pd.read_csv(info["platemap_path"])
+
+        if out_of_core_normalization:
+            with timer.stage("annotate_normalize"):
+                standardize_parquet(
+                    profile_path=info["profile_path"],
+                    output_path=output_files["normalized"],
+                    transform=partial(
+                        annotate_profiles, platemap=platemap_df, **annotate_kwargs
+                    ),
+                    batch_size=batch_size,
+                )
+
+            if select_features:
+                with timer.stage("feature_select"):
+                    feature_select_stats = compute_feature_select_stats(
+                        profile_paths=output_files["normalized"],
+                        batch_size=batch_size,
+                        sample_fraction=correlation_sample_fraction,
+                    )
+                    excluded_features = select_features_from_stats(
+                        stats=feature_select_stats,
+                        operation=feature_select_ops,
+                        na_cutoff=0,
+                        columns=pq.read_schema(output_files["normalized"]).names,
+                    )
+                with timer.stage("write"):
+                    write_selected_features(
+                        profile_path=output_files["normalized"],
+                        output_path=output_files["feature_selected"],
+                        excluded_features=excluded_features,
+                        batch_size=batch_size,
+                    )
+        else:
+            with timer.stage("load"):
+                profile_df = pd.read_parquet(info["profile_path"])
+
+            with timer.stage("annotate_normalize"):
+                normalized_df = pipeline.annotate_and_normalize(
+                    profiles=profile_df,
+                    platemap=platemap_df,
+                    output_files=output_files,
+                    **annotate_kwargs,
+                )
+            del profile_df
+
+            if select_features:
+                with timer.stage("feature_select"):
+                    feature_selected_df = feature_select(
+                        profiles=normalized_df,
+                        operation=feature_select_ops,
+                        na_cutoff=0,
+                    )
+                pipeline.persist(feature_selected_df, output_files["feature_selected"])
+            elif not save_intermediate_profiles:
+                # the normalized profiles are needed to select features for the round
+                pipeline.persist(normalized_df, output_files["normalized"])
+
+        with timer.stage("write"):
+            pipeline.wait()
+
+    return timer.timings
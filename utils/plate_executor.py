@@ -0,0 +1,234 @@
+"""
+This collection of functions processes plates in parallel processes under a memory budget. The memory needed for
+each plate is estimated from the Parquet metadata of its input file (rows × columns × bytes per value), so plates
+are only started when they fit in the remaining budget. Failures are isolated per plate and every plate reports
+the time spent in each processing stage.
+"""
+
+import multiprocessing
+import pathlib
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from errors.exceptions import MaxWorkerError
+
+
+class StageTimer:
+    """
+    Record the time spent in each stage of processing a plate.
+
+    Attributes:
+        timings (Dict[str, float]): Dictionary of stage name to the number of seconds spent in the stage.
+    """
+
+    def __init__(self):
+        self.timings = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time the code run in the context, adding to the time of the stage if it is run more than once.
+
+        Args:
+            name (str): Name of the stage (e.g., normalize).
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = (
+                self.timings.get(name, 0.0) + time.perf_counter() - start
+            )
+
+
+def estimate_plate_memory(
+    profile_path: pathlib.Path,
+    overhead_factor: float = 3.0,
+    max_rows: Optional[int] = None,
+) -> int:
+    """Estimate the memory needed to process a plate from the Parquet metadata, without reading the data.
+
+    Fixed-width columns use their number of bytes per value and other columns (e.g., strings) use their
+    uncompressed size per row.
+
+    Args:
+        profile_path (pathlib.Path): Path to the Parquet file with the plate's profiles.
+        overhead_factor (float, optional): Number of copies of the data in memory at once while processing
+            (e.g., profiles, annotated, and normalized profiles). Defaults to 3.0.
+        max_rows (Optional[int], optional): Maximum number of rows in memory at once (e.g., the batch size when
+            processing out-of-core). Defaults to None, which uses all rows.
+
+    Returns:
+        int: Estimated number of bytes.
+    """
+    parquet_file = pq.ParquetFile(profile_path)
+    metadata = parquet_file.metadata
+    num_rows = metadata.num_rows
+
+    # uncompressed size of each column across row groups (used for variable-width columns)
+    uncompressed_sizes = {}
+    for row_group in range(metadata.num_row_groups):
+        row_group_metadata = metadata.row_group(row_group)
+        for column in range(row_group_metadata.num_columns):
+            column_metadata = row_group_metadata.column(column)
+            uncompressed_sizes[column_metadata.path_in_schema] = (
+                uncompressed_sizes.get(column_metadata.path_in_schema, 0)
+                + column_metadata.total_uncompressed_size
+            )
+
+    bytes_per_row = 0.0
+    for field in parquet_file.schema_arrow:
+        try:
+            bytes_per_row += field.type.bit_width / 8
+        except ValueError:
+            bytes_per_row += uncompressed_sizes.get(field.name, 0) / max(num_rows, 1)
+
+    rows_in_memory = num_rows if max_rows is None else min(num_rows, max_rows)
+
+    return int(rows_in_memory * bytes_per_row * overhead_factor)
+
+
+def run_plates_parallel(
+    plate_info_dictionary: Dict[str, dict],
+    process_plate: Callable[..., Dict[str, float]],
+    memory_estimates: Dict[str, int],
+    memory_budget_gb: float,
+    max_workers: Optional[int] = None,
+    **process_kwargs,
+) -> pd.DataFrame:
+    """Process plates in parallel processes while the estimated memory of running plates fits in a budget.
+
+    Plates are started from the largest to the smallest estimate, and a plate larger than the budget runs alone.
+    An error in one plate is recorded in the summary and does not stop the other plates. If a worker process is
+    killed (e.g., out of memory), a new pool is started for the remaining plates, and the plates that were running
+    are retried one at a time so only the plate that killed its worker is recorded as failed.
+
+    Args:
+        plate_info_dictionary (Dict[str, dict]): Dictionary of plate name to its information.
+        process_plate (Callable[..., Dict[str, float]]): Module-level function called as
+            `process_plate(plate=plate, info=info, **process_kwargs)` that returns its stage timings in seconds.
+        memory_estimates (Dict[str, int]): Estimated number of bytes needed for each plate
+            (e.g., from `estimate_plate_memory`).
+        memory_budget_gb (float): Maximum total estimated memory of the plates running at once, in GB.
+        max_workers (Optional[int], optional): Maximum number of plates running at once. Defaults to None, which
+            uses the number of CPUs.
+        **process_kwargs: Keyword arguments passed to the processing function.
+
+    Raises:
+        MaxWorkerError: If max_workers exceeds the number of CPUs.
+
+    Returns:
+        pd.DataFrame: Summary with the status, estimated memory, error, and stage timings of each plate.
+    """
+    cpu_count = multiprocessing.cpu_count()
+    if max_workers is None:
+        max_workers = min(cpu_count, len(plate_info_dictionary))
+    if max_workers > cpu_count:
+        raise MaxWorkerError(
+            "Exception occurred: The number of workers exceeds the number of CPUs/workers. Please reduce the number of workers."
+        )
+
+    memory_budget = memory_budget_gb * 1024**3
+    pending = sorted(plate_info_dictionary, key=lambda plate: -memory_estimates[plate])
+    running: Dict[Future, str] = {}
+    # plates that were running when a worker process was killed, which are retried one at a time
+    run_alone = set()
+    memory_in_use = 0
+    summaries = []
+
+    executor = ProcessPoolExecutor(max_workers=max(max_workers, 1))
+    try:
+        while pending or running:
+            # start every pending plate that fits in the remaining memory budget
+            for plate in list(pending):
+                if len(running) >= max_workers:
+                    break
+                if running and (
+                    memory_in_use + memory_estimates[plate] > memory_budget
+                    or plate in run_alone
+                    or set(running.values()) & run_alone
+                ):
+                    continue
+                print(f"Starting {plate}")
+                future = executor.submit(
+                    process_plate,
+                    plate=plate,
+                    info=plate_info_dictionary[plate],
+                    **process_kwargs,
+                )
+                running[future] = plate
+                memory_in_use += memory_estimates[plate]
+                pending.remove(plate)
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            broken_plates = []
+            for future in done:
+                plate = running.pop(future)
+                memory_in_use -= memory_estimates[plate]
+                summary = {
+                    "plate": plate,
+                    "status": "completed",
+                    "estimated_memory_gb": memory_estimates[plate] / 1024**3,
+                    "error": None,
+                }
+                try:
+                    timings = future.result()
+                    summary.update(
+                        {f"{stage}_seconds": value for stage, value in timings.items()}
+                    )
+                    summary["total_seconds"] = sum(timings.values())
+                    print(
+                        f"Completed {plate} in {summary['total_seconds']:.1f} seconds"
+                    )
+                except BrokenProcessPool:
+                    broken_plates.append(plate)
+                    continue
+                except Exception as error:
+                    summary["status"] = "failed"
+                    summary["error"] = "".join(
+                        traceback.format_exception_only(type(error), error)
+                    ).strip()
+                    print(f"Failed {plate}: {summary['error']}")
+                summaries.append(summary)
+
+            if broken_plates:
+                # a worker was killed (e.g., out of memory), which breaks every plate in the pool, so the
+                # plates still marked as running are also broken
+                for plate in running.values():
+                    broken_plates.append(plate)
+                    memory_in_use -= memory_estimates[plate]
+                running = {}
+
+                if len(broken_plates) == 1:
+                    # the plate ran alone, so it killed the worker
+                    failed_plates, retry_plates = broken_plates, []
+                else:
+                    # the plate that killed the worker is unknown, so run each plate again on its own
+                    failed_plates, retry_plates = [], broken_plates
+                for plate in failed_plates:
+                    summaries.append(
+                        {
+                            "plate": plate,
+                            "status": "failed",
+                            "estimated_memory_gb": memory_estimates[plate] / 1024**3,
+                            "error": "The worker process was terminated abruptly "
+                            "(e.g., killed for running out of memory)",
+                        }
+                    )
+                    print(f"Failed {plate}: the worker process was terminated")
+                run_alone.update(retry_plates)
+                pending = retry_plates + pending
+
+                # start a new pool for the remaining plates
+                executor.shutdown(wait=False)
+                executor = ProcessPoolExecutor(max_workers=max(max_workers, 1))
+    finally:
+        executor.shutdown(wait=True)
+
+    return pd.DataFrame(summaries)
@@ -0,0 +1,149 @@
+"""
+This collection of functions resolves plate metadata (platemap path and time point) and data file paths for the
+processing notebooks. The platemap directory and each data directory are only scanned once, and the results are
+cached and indexed by plate barcode in dictionaries for fast lookups.
+"""
+
+import pathlib
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+
+class PlateRegistry:
+    """
+    Index of plate barcodes to their platemap file and time point from the barcode platemap.
+
+    Attributes:
+        platemap_dir (pathlib.Path): Directory with the platemap CSV files and the barcode platemap.
+        platemap_paths (Dict[str, str]): Dictionary of platemap name to the resolved path of its CSV file.
+        barcodes (Dict[str, dict]): Dictionary of plate barcode to its platemap path and time point.
+    """
+
+    def __init__(
+        self,
+        platemap_dir: pathlib.Path,
+        barcode_platemap_file: str = "Barcode_platemap_pilot_data.csv",
+    ):
+        self.platemap_dir = pathlib.Path(platemap_dir)
+
+        # scan the platemap directory once and index the platemaps by name (file name without .csv)
+        self.platemap_paths = {
+            path.stem: str(path.resolve(strict=True))
+            for path in self.platemap_dir.rglob("*.csv")
+        }
+
+        barcode_platemap = pd.read_csv(self.platemap_dir / barcode_platemap_file)
+        self.barcodes = {
+            barcode: {
+                "platemap_path": self.platemap_paths.get(platemap_file),
+                "time_point": time_point,
+            }
+            for barcode, platemap_file, time_point in zip(
+                barcode_platemap["barcode"],
+                barcode_platemap["platemap_file"],
+                barcode_platemap["time_point"],
+            )
+        }
+
+    def lookup(self, barcode: str) -> dict:
+        """Get the platemap path and time point of a plate.
+
+        Args:
+            barcode (str): Plate barcode (e.g., BR00143976).
+
+        Returns:
+            dict: Dictionary with the platemap path and time point, which are None if the barcode is not in the
+                barcode platemap.
+        """
+        return self.barcodes.get(barcode, {"platemap_path": None, "time_point": None})
+
+    def plate_info_dictionary(
+        self, plate_names: List[str], **plate_files: Dict[str, str]
+    ) -> Dict[str, dict]:
+        """Create the dictionary of plate information used by the processing notebooks.
+
+        Args:
+            plate_names (List[str]): Plate barcodes to include.
+            **plate_files (Dict[str, str]): Keyword arguments of an info key (e.g., profile_path) to a
+                dictionary of plate barcode to file path (e.g., from `index_plate_files`).
+
+        Returns:
+            Dict[str, dict]: Dictionary of plate barcode to its file paths, platemap path, and time point.
+                Missing files or barcodes are None.
+        """
+        return {
+            name: {
+                **{key: files.get(name) for key, files in plate_files.items()},
+                **self.lookup(name),
+            }
+            for name in plate_names
+        }
+
+
+@lru_cache(maxsize=None)
+def get_plate_registry(
+    platemap_dir: pathlib.Path,
+    barcode_platemap_file: str = "Barcode_platemap_pilot_data.csv",
+) -> PlateRegistry:
+    """Get the plate registry for a platemap directory, which is only created once per directory.
+
+    Args:
+        platemap_dir (pathlib.Path): Directory with the platemap CSV files and the barcode platemap.
+        barcode_platemap_file (str, optional): File name of the barcode platemap.
+            Defaults to "Barcode_platemap_pilot_data.csv".
+
+    Returns:
+        PlateRegistry: Plate registry.
+    """
+    return PlateRegistry(pathlib.Path(platemap_dir), barcode_platemap_file)
+
+
+@lru_cache(maxsize=None)
+def index_plate_files(
+    data_dir: pathlib.Path, suffix: str, recursive: bool = True
+) -> Dict[str, str]:
+    """Scan a data directory once and index the files ending with a suffix by plate barcode.
+    Results are cached, so call `index_plate_files.cache_clear()` to find files created after the first scan.
+
+    Args:
+        data_dir (pathlib.Path): Directory with the plate files.
+        suffix (str): Suffix after the plate barcode (e.g., "_cleaned.parquet").
+        recursive (bool, optional): Whether to also search subdirectories. Defaults to True.
+
+    Returns:
+        Dict[str, str]: Dictionary of plate barcode to the resolved file path, sorted by barcode.
+    """
+    data_dir = pathlib.Path(data_dir)
+    paths = data_dir.rglob(f"*{suffix}") if recursive else data_dir.glob(f"*{suffix}")
+
+    return {
+        path.name[: -len(suffix)]: str(path.resolve(strict=True))
+        for path in sorted(paths)
+    }
+
+
+def get_plate_info_dictionary(
+    platemap_dir: pathlib.Path,
+    plate_files: Dict[str, Dict[str, str]],
+    plate_names: Optional[List[str]] = None,
+) -> Dict[str, dict]:
+    """Create the dictionary of plate information from the cached registry and indexed plate files.
+
+    Args:
+        platemap_dir (pathlib.Path): Directory with the platemap CSV files and the barcode platemap.
+        plate_files (Dict[str, Dict[str, str]]): Dictionary of info key (e.g., profile_path) to a dictionary of
+            plate barcode to file path.
+        plate_names (Optional[List[str]], optional): Plate barcodes to include. Defaults to None, which uses the
+            plates of the first dictionary of files.
+
+    Returns:
+        Dict[str, dict]: Dictionary of plate barcode to its file paths, platemap path, and time point.
+    """
+    if plate_names is None:
+        plate_names = list(next(iter(plate_files.values())))
+
+    return get_plate_registry(platemap_dir).plate_info_dictionary(
+        plate_names, **plate_files
+    )
@@ -0,0 +1,257 @@
+"""
+This collection of functions plots the single-cell quality control figures from boolean outlier masks.
+The data for each figure (stratified sample of points or histogram counts) is computed with NumPy so the
+rendering can be submitted to a background process and not block the QC computation.
+"""
+
+import pathlib
+from typing import Dict
+
+import numpy as np
+
+# colors for single-cells that passed or failed QC
+QC_STATUS_PALETTE = {
+    "Single-cell passed QC": "#006400",
+    "Single-cell failed QC": "#990090",
+}
+
+
+def sample_stratified_indices(
+    failed_mask: np.ndarray, max_points_per_status: int = 50000, seed: int = 0
+) -> np.ndarray:
+    """Sample row positions separately from the passing and failing single-cells so both are represented.
+
+    Args:
+        failed_mask (np.ndarray): Boolean array where True means the single-cell failed QC.
+        max_points_per_status (int, optional): Maximum number of points to keep for each QC status.
+            Defaults to 50000.
+        seed (int, optional): Seed for the random number generator. Defaults to 0.
+
+    Returns:
+        np.ndarray: Sorted array of sampled row positions.
+    """
+    rng = np.random.default_rng(seed)
+    sampled_indices = []
+    for status_indices in (np.flatnonzero(~failed_mask), np.flatnonzero(failed_mask)):
+        if status_indices.shape[0] > max_points_per_status:
+            status_indices = rng.choice(
+                status_indices, size=max_points_per_status, replace=False
+            )
+        sampled_indices.append(status_indices)
+
+    return np.sort(np.concatenate(sampled_indices))
+
+
+def compute_cluster_nuclei_plot_data(
+    mass_displacement: np.ndarray,
+    integrated_intensity: np.ndarray,
+    failed_mask: np.ndarray,
+    max_points_per_status: int = 50000,
+    seed: int = 0,
+) -> Dict[str, np.ndarray]:
+    """Compute the stratified sample of points and threshold lines for the cluster nuclei scatterplot.
+
+    Args:
+        mass_displacement (np.ndarray): Nuclei mass displacement values for all single-cells.
+        integrated_intensity (np.ndarray): Nuclei integrated intensity values for all single-cells.
+        failed_mask (np.ndarray): Boolean array where True means the single-cell is a cluster nuclei outlier.
+        max_points_per_status (int, optional): Maximum number of points to plot for each QC status.
+            Defaults to 50000.
+        seed (int, optional): Seed for the random number generator. Defaults to 0.
+
+    Returns:
+        Dict[str, np.ndarray]: Dictionary with the sampled x, y, and failed values and the threshold lines.
+    """
+    sampled = sample_stratified_indices(failed_mask, max_points_per_status, seed)
+
+    return {
+        "x": mass_displacement[sampled],
+        "y": integrated_intensity[sampled],
+        "failed": failed_mask[sampled],
+        # thresholds are the minimum values of the outliers (same as from the outlier dataframe)
+        "x_threshold": (
+            np.nanmin(mass_displacement[failed_mask]) if failed_mask.any() else np.nan
+        ),
+        "y_threshold": (
+            np.nanmin(integrated_intensity[failed_mask])
+            if failed_mask.any()
+            else np.nan
+        ),
+    }
+
+
+def compute_solidity_histogram_data(
+    solidity: np.ndarray, failed_mask: np.ndarray, bins: int = 50
+) -> Dict[str, np.ndarray]:
+    """Compute the histogram counts of passing and failing single-cells on shared bins.
+
+    Args:
+        solidity (np.ndarray): Nuclei solidity values for all single-cells.
+        failed_mask (np.ndarray): Boolean array where True means the single-cell is a solidity outlier.
+        bins (int, optional): Number of bins for the histogram. Defaults to 50.
+
+    Returns:
+        Dict[str, np.ndarray]: Dictionary with the bin edges, counts per QC status, and the threshold line.
+    """
+    finite = np.isfinite(solidity)
+    bin_edges = np.histogram_bin_edges(solidity[finite], bins=bins)
+    passed_counts, _ = np.histogram(solidity[finite & ~failed_mask], bins=bin_edges)
+    failed_counts, _ = np.histogram(solidity[finite & failed_mask], bins=bin_edges)
+
+    return {
+        "bin_edges": bin_edges,
+        "passed_counts": passed_counts,
+        "failed_counts": failed_counts,
+        # threshold is the maximum value of the outliers (same as from the outlier dataframe)
+        "threshold": np.nanmax(solidity[failed_mask]) if failed_mask.any() else np.nan,
+    }
+
+
+def render_cluster_nuclei_outliers(
+    plot_data: Dict[str, np.ndarray],
+    plate_name: str,
+    qc_fig_dir: pathlib.Path,
+    dpi: int = 500,
+) -> pathlib.Path:
+    """Render the scatterplot of the cluster nuclei outliers from precomputed plot data.
+
+    Args:
+        plot_data (Dict[str, np.ndarray]): Output from `compute_cluster_nuclei_plot_data`.
+        plate_name (str): String of the plate's name or ID.
+        qc_fig_dir (pathlib.Path): Path to the directory to save the plot.
+        dpi (int, optional): Resolution of the saved figure. Defaults to 500.
+
+    Returns:
+        pathlib.Path: Path to the saved figure.
+    """
+    # import in the function so worker processes use a non-interactive backend
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=(10, 6))
+
+    # Create scatter plot (points are rasterized since there can be many)
+    for status, is_failed in (
+        ("Single-cell passed QC", False),
+        ("Single-cell failed QC", True),
+    ):
+        status_mask = plot_data["failed"] == is_failed
+        ax.scatter(
+            plot_data["x"][status_mask],
+            plot_data["y"][status_mask],
+            s=10,
+            color=QC_STATUS_PALETTE[status],
+            alpha=0.2,
+            linewidths=0,
+            label=status,
+            rasterized=True,
+        )
+
+    # Add threshold lines
+    ax.axvline(
+        x=plot_data["x_threshold"],
+        color="r",
+        linestyle="--",
+        label="Min. threshold for Nuclei Mass Displacement",
+    )
+    ax.axhline(
+        y=plot_data["y_threshold"],
+        color="b",
+        linestyle="--",
+        label="Min. threshold for Nuclei Intensity",
+    )
+
+    # Customize plot
+    ax.set_title(
+        f"Nuclei Mass Displacement vs. Nuclei Integrated Intensity for plate {plate_name}"
+    )
+    ax.set_xlabel("Nuclei Mass Displacement (Hoechst)")
+    ax.set_ylabel("Nuclei Integrated Intensity (Hoechst)")
+    fig.tight_layout()
+
+    # Show legend
+    ax.legend(loc="upper right", bbox_to_anchor=(1.0, 1.0), prop={"size": 10})
+
+    # Save figure without showing it
+    output_path = pathlib.Path(f"{qc_fig_dir}/{plate_name}_cluster_nuclei_outliers.png")
+    fig.savefig(output_path, dpi=dpi)
+    plt.close(fig)
+
+    return output_path
+
+
+def render_nuclei_solidity_histogram(
+    hist_data: Dict[str, np.ndarray],
+    plate_name: str,
+    qc_fig_dir: pathlib.Path,
+    dpi: int = 500,
+) -> pathlib.Path:
+    """Render the stacked histogram of the nuclei solidity outliers from precomputed counts.
+
+    Args:
+        hist_data (Dict[str, np.ndarray]): Output from `compute_solidity_histogram_data`.
+        plate_name (str): String of the plate's name or ID.
+        qc_fig_dir (pathlib.Path): Path to the directory to save the plot.
+        dpi (int, optional): Resolution of the saved figure. Defaults to 500.
+
+    Returns:
+        pathlib.Path: Path to the saved figure.
+    """
+    # import in the function so worker processes use a non-interactive backend
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    bin_edges = hist_data["bin_edges"]
+    bin_widths = np.diff(bin_edges)
+
+    fig, ax = plt.subplots(figsize=(10, 6))
+
+    # Create histogram with the failed counts stacked on the passed counts
+    ax.bar(
+        bin_edges[:-1],
+        hist_data["passed_counts"],
+        width=bin_widths,
+        align="edge",
+        color=QC_STATUS_PALETTE["Single-cell passed QC"],
+        alpha=0.75,
+        label="Single-cell passed QC",
+    )
+    ax.bar(
+        bin_edges[:-1],
+        hist_data["failed_counts"],
+        width=bin_widths,
+        align="edge",
+        bottom=hist_data["passed_counts"],
+        color=QC_STATUS_PALETTE["Single-cell failed QC"],
+        alpha=0.75,
+        label="Single-cell failed QC",
+    )
+
+    # Add threshold line
+    max_threshold = hist_data["threshold"]
+    ax.axvline(
+        x=max_threshold,
+        color="r",
+        linestyle="--",
+        label=f"Threshold for Outliers: < {max_threshold}",
+    )
+
+    # Customize plot
+    ax.set_ylabel("Count")
+    ax.set_xlabel("Nuclei Solidity")
+    ax.set_title(f"Distribution of Nuclei Solidity for plate {plate_name}")
+    ax.legend()
+    fig.tight_layout()
+
+    # Save figure without showing it
+    output_path = pathlib.Path(
+        f"{qc_fig_dir}/{plate_name}_nuclei_solidity_outliers_histogram.png"
+    )
+    fig.savefig(output_path, dpi=dpi)
+    plt.close(fig)
+
+    return output_path
@@ -0,0 +1,190 @@
+"""
+This collection of functions generates the single-cell QC report from the QC results without annotating every
+single-cell. The single-cells segmented and failing QC are first counted per well from the QC results, and only
+the per-well counts are joined to the platemap and summed by the platemap conditions. Plates processed before the
+QC results were saved as Parquet are counted from their CSV of failing single-cells. Plates are processed in
+parallel threads.
+"""
+
+import pathlib
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from qc_results_utils import read_failed_qc_indices, read_qc_results
+
+# platemap and plate columns the QC report is grouped by
+QC_REPORT_GROUP_COLUMNS = [
+    "Metadata_cell_line",
+    "Metadata_seeding_density",
+    "Metadata_time_point",
+    "Metadata_condition",
+    "Metadata_Plate",
+]
+
+
+def count_qc_failures_by_well(
+    qc_results_path: pathlib.Path, well_column: str = "Image_Metadata_Well"
+) -> pd.DataFrame:
+    """Count the single-cells segmented and failing any QC condition in each well of a plate.
+
+    Args:
+        qc_results_path (pathlib.Path): Path to the QC results Parquet file of the plate.
+        well_column (str, optional): Name of the well column in the QC results. Defaults to "Image_Metadata_Well".
+
+    Returns:
+        pd.DataFrame: Dataframe with one row per well and the columns Metadata_Well, total_nuclei_segmented, and
+            total_failed_qc.
+    """
+    qc_df = read_qc_results(qc_results_path, columns=[well_column])
+
+    return (
+        qc_df.groupby(well_column, observed=True)["failed_qc"]
+        .agg(total_nuclei_segmented="count", total_failed_qc="sum")
+        .reset_index()
+        .rename(columns={well_column: "Metadata_Well"})
+    )
+
+
+def count_legacy_qc_failures_by_well(
+    failed_qc_indices_path: pathlib.Path,
+    converted_path: pathlib.Path,
+    well_column: str = "Image_Metadata_Well",
+) -> pd.DataFrame:
+    """Count the single-cells segmented and failing any QC condition in each well of a plate processed before the
+    QC results were saved as Parquet. Only the failing single-cells are in the CSV, so the single-cells segmented
+    are counted from the well column of the converted profiles.
+
+    Args:
+        failed_qc_indices_path (pathlib.Path): Path to the CSV of failing single-cells of the plate
+            (`{plate}_failed_qc_indices.csv.gz`).
+        converted_path (pathlib.Path): Path to the converted profiles of the plate (Parquet).
+        well_column (str, optional): Name of the well column in both files. Defaults to "Image_Metadata_Well".
+
+    Returns:
+        pd.DataFrame: Dataframe with one row per well and the columns Metadata_Well, total_nuclei_segmented, and
+            total_failed_qc (see `count_qc_failures_by_well`).
+    """
+    segmented_counts = (
+        pd.read_parquet(converted_path, columns=[well_column])[well_column]
+        .astype(str)
+        .value_counts()
+        .rename("total_nuclei_segmented")
+    )
+    failed_counts = (
+        read_failed_qc_indices(failed_qc_indices_path, columns=[well_column])[
+            well_column
+        ]
+        .astype(str)
+        .value_counts()
+        .rename("total_failed_qc")
+    )
+
+    well_counts_df = pd.concat([segmented_counts, failed_counts], axis="columns")
+    well_counts_df = well_counts_df.fillna(0).astype("int64")
+    well_counts_df.index.name = "Metadata_Well"
+
+    return well_counts_df.sort_index().reset_index()
+
+
+def plate_qc_report(
+    plate: str,
+    info: dict,
+    group_columns: List[str] = QC_REPORT_GROUP_COLUMNS,
+) -> Optional[pd.DataFrame]:
+    """Generate the QC report of one plate from its per-well QC counts and platemap.
+
+    Args:
+        plate (str): Name of the plate.
+        info (dict): Plate information with the qc_results_path, converted_path, platemap_path, and time_point. For
+            plates without a QC results Parquet file, failed_qc_indices_path is used instead.
+        group_columns (List[str], optional): Platemap and plate columns to group the wells by.
+            Defaults to QC_REPORT_GROUP_COLUMNS.
+
+    Raises:
+        ValueError: If the QC results do not have the same number of single-cells as the converted profiles.
+
+    Returns:
+        Optional[pd.DataFrame]: QC report with the total single-cells segmented, failing QC, and the percentage
+            failing for each group, or None (with a warning) if the plate has no QC results.
+    """
+    if info.get("qc_results_path") is not None:
+        well_counts_df = count_qc_failures_by_well(info["qc_results_path"])
+    elif info.get("failed_qc_indices_path") is not None:
+        well_counts_df = count_legacy_qc_failures_by_well(
+            info["failed_qc_indices_path"], info["converted_path"]
+        )
+    else:
+        warnings.warn(f"Skipping {plate}, which has no QC results.")
+        return None
+
+    # make sure the QC results cover every single-cell (only reads the Parquet file metadata)
+    num_qc_cells = int(well_counts_df["total_nuclei_segmented"].sum())
+    num_converted_cells = pq.ParquetFile(info["converted_path"]).metadata.num_rows
+    if num_qc_cells != num_converted_cells:
+        raise ValueError(
+            f"Mismatch for {plate}: {num_qc_cells} != {num_converted_cells}"
+        )
+
+    # join the per-well counts to the platemap (wells missing from the platemap are dropped, as with annotate)
+    platemap_df = (
+        pd.read_csv(info["platemap_path"])
+        .add_prefix("Metadata_")
+        .rename(columns={"Metadata_well": "Metadata_Well"})
+    )
+    well_counts_df = well_counts_df.merge(platemap_df, on="Metadata_Well", how="inner")
+    well_counts_df["Metadata_Plate"] = plate
+    well_counts_df["Metadata_time_point"] = info["time_point"]
+
+    report_df = (
+        well_counts_df.groupby(group_columns)[
+            ["total_nuclei_segmented", "total_failed_qc"]
+        ]
+        .sum()
+        .reset_index()
+    )
+    report_df["percentage_failing_cells"] = (
+        100 * report_df["total_failed_qc"] / report_df["total_nuclei_segmented"]
+    )
+
+    return report_df
+
+
+def generate_qc_report(
+    plate_info_dictionary: Dict[str, dict],
+    group_columns: List[str] = QC_REPORT_GROUP_COLUMNS,
+    max_workers: Optional[int] = None,
+) -> pd.DataFrame:
+    """Generate the QC report of every plate in parallel threads.
+
+    Args:
+        plate_info_dictionary (Dict[str, dict]): Dictionary of plate name to its information (see
+            `plate_qc_report`).
+        group_columns (List[str], optional): Platemap and plate columns to group the wells by.
+            Defaults to QC_REPORT_GROUP_COLUMNS.
+        max_workers (Optional[int], optional): Number of plates processed at once. Defaults to None, which uses
+            the ThreadPoolExecutor default.
+
+    Raises:
+        ValueError: If none of the plates have QC results.
+
+    Returns:
+        pd.DataFrame: QC report of all plates, in the order of the plate information dictionary (plates without
+            QC results are skipped).
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        plate_reports = list(
+            executor.map(
+                lambda item: plate_qc_report(item[0], item[1], group_columns),
+                plate_info_dictionary.items(),
+            )
+        )
+
+    plate_reports = [report_df for report_df in plate_reports if report_df is not None]
+    if not plate_reports:
+        raise ValueError("None of the plates have QC results.")
+
+    return pd.concat(plate_reports, ignore_index=True)
@@ -0,0 +1,129 @@
+"""
+This collection of functions writes and reads the single-cell quality control results as a compact
+Parquet file with one boolean column per QC condition, aligned to the row order of the converted profiles.
+The QC conditions and their thresholds are stored in the file metadata. Plates processed before this format
+have only the failing single-cells saved as a gzipped CSV, which can also be read.
+"""
+
+import json
+import pathlib
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# key in the Parquet file metadata that holds the QC conditions and thresholds
+QC_RULES_METADATA_KEY = b"qc_rules"
+
+# metadata columns stored with the QC flags so that reports do not need to reload the profiles
+QC_METADATA_COLUMNS = ["Image_Metadata_Plate", "Image_Metadata_Well"]
+
+
+def write_qc_results(
+    plate_df: pd.DataFrame,
+    qc_flags: Dict[str, np.ndarray],
+    qc_rules: dict,
+    output_path: pathlib.Path,
+) -> None:
+    """Write the per-cell QC flags for one plate as a Parquet file of boolean columns.
+
+    Args:
+        plate_df (pd.DataFrame): Dataframe of the converted profiles, in the same row order as the converted file.
+        qc_flags (Dict[str, np.ndarray]): Dictionary of QC condition name (e.g., Failed_ClusteredNuclei) to a
+            boolean array the length of plate_df where True means the single-cell failed the condition.
+        qc_rules (dict): Dictionary of QC condition name to the rule used to detect it (e.g., compartment and
+            feature thresholds), which is saved in the file metadata.
+        output_path (pathlib.Path): Path to save the QC results Parquet file.
+
+    Raises:
+        ValueError: If the QC flags are not the same length as the plate dataframe.
+    """
+    num_rows = plate_df.shape[0]
+
+    columns = {
+        col: pa.array(plate_df[col].astype(str).to_numpy()).dictionary_encode()
+        for col in QC_METADATA_COLUMNS
+    }
+    for condition, flags in qc_flags.items():
+        flags = np.asarray(flags, dtype=bool)
+        if flags.shape[0] != num_rows:
+            raise ValueError(
+                f"QC flags for '{condition}' have {flags.shape[0]} rows, expected {num_rows}"
+            )
+        columns[condition] = pa.array(flags, type=pa.bool_())
+
+    qc_table = pa.table(columns)
+
+    # store the rules, thresholds, and row count with the flags so the file is self-describing
+    file_metadata = {
+        "plate_id": str(plate_df["Image_Metadata_Plate"].iloc[0]) if num_rows else None,
+        "num_rows": num_rows,
+        "rules": qc_rules,
+    }
+    qc_table = qc_table.replace_schema_metadata(
+        {QC_RULES_METADATA_KEY: json.dumps(file_metadata).encode("utf-8")}
+    )
+
+    pathlib.Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    pq.write_table(qc_table, output_path)
+
+
+def read_qc_rules(qc_results_path: pathlib.Path) -> dict:
+    """Read the QC conditions and thresholds from the metadata of a QC results file without loading the flags.
+
+    Args:
+        qc_results_path (pathlib.Path): Path to the QC results Parquet file.
+
+    Returns:
+        dict: Dictionary with the plate ID, number of rows, and the QC rules used.
+    """
+    schema_metadata = pq.read_schema(qc_results_path).metadata or {}
+    return json.loads(schema_metadata[QC_RULES_METADATA_KEY].decode("utf-8"))
+
+
+def read_qc_results(
+    qc_results_path: pathlib.Path, columns: Optional[List[str]] = None
+) -> pd.DataFrame:
+    """Read the QC results for one plate with an added `failed_qc` column for cells that failed any condition.
+
+    Args:
+        qc_results_path (pathlib.Path): Path to the QC results Parquet file.
+        columns (Optional[List[str]], optional): Metadata columns to load with the QC flags. Defaults to None,
+            which loads all metadata columns.
+
+    Returns:
+        pd.DataFrame: Dataframe in the row order of the converted profiles with the metadata and QC flags.
+    """
+    qc_conditions = list(read_qc_rules(qc_results_path)["rules"].keys())
+    metadata_columns = QC_METADATA_COLUMNS if columns is None else columns
+
+    qc_df = pd.read_parquet(qc_results_path, columns=metadata_columns + qc_conditions)
+    qc_df["failed_qc"] = qc_df[qc_conditions].any(axis="columns")
+
+    return qc_df
+
+
+def read_failed_qc_indices(
+    failed_qc_indices_path: pathlib.Path, columns: Optional[List[str]] = None
+) -> pd.DataFrame:
+    """Read the single-cells that failed QC from a plate processed before the QC results were saved as Parquet
+    (`{plate}_failed_qc_indices.csv.gz`), with one row per failing single-cell.
+
+    Args:
+        failed_qc_indices_path (pathlib.Path): Path to the gzipped CSV of the failing single-cells.
+        columns (Optional[List[str]], optional): Metadata columns to load with the original indices. Defaults to
+            None, which loads all metadata columns.
+
+    Returns:
+        pd.DataFrame: Dataframe with the original row index in the converted profiles and the metadata of each
+            failing single-cell (a single-cell failing multiple conditions is only included once).
+    """
+    metadata_columns = QC_METADATA_COLUMNS if columns is None else columns
+
+    failed_df = pd.read_csv(
+        failed_qc_indices_path, usecols=["original_indices"] + metadata_columns
+    )
+
+    return failed_df.drop_duplicates(subset="original_indices").reset_index(drop=True)
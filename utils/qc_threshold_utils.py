@@ -0,0 +1,258 @@
+"""
+This collection of functions precomputes the z-score distributions of the single-cell QC features across plates
+so the number of failing single-cells for any QC threshold can be looked up without rerunning QC.
+Z-scores and outlier conditions follow coSMicQC `find_outliers` (population z-score per plate, positive thresholds
+detect cells above the threshold and negative thresholds detect cells below it, features in a condition are combined with AND).
+"""
+
+import pathlib
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from qc_results_utils import read_qc_rules
+
+
+def _count_beyond_threshold(sorted_zscores: np.ndarray, threshold: float) -> int:
+    """Count the z-scores beyond a threshold with a binary search of the sorted z-scores.
+
+    Args:
+        sorted_zscores (np.ndarray): Sorted z-scores of one feature.
+        threshold (float): Positive threshold counts z-scores above it, otherwise z-scores below it.
+
+    Returns:
+        int: Number of z-scores beyond the threshold.
+    """
+    if threshold > 0:
+        return sorted_zscores.shape[0] - int(
+            np.searchsorted(sorted_zscores, threshold, side="right")
+        )
+    return int(np.searchsorted(sorted_zscores, threshold, side="left"))
+
+
+class QCThresholdTuner:
+    """
+    Precomputed z-scores of the QC features per plate and QC condition for fast threshold tuning.
+
+    For every plate, QC condition, and feature, the z-scores are sorted once. The number of failing single-cells
+    for a condition with one feature is a binary search (O(log n)). For conditions with multiple features, a binary
+    search on each feature finds the slice of single-cells beyond its threshold, and only the smallest slice is
+    checked against the other thresholds.
+
+    Attributes:
+        qc_rules (dict): Dictionary of QC condition name to a rule with the `feature_thresholds` used for QC.
+        num_cells (Dict[str, Dict[str, int]]): Number of single-cells used for each plate and QC condition.
+    """
+
+    def __init__(self, converted_paths: Dict[str, pathlib.Path], qc_rules: dict):
+        """Load the QC features for each plate and precompute the sorted z-scores.
+
+        Args:
+            converted_paths (Dict[str, pathlib.Path]): Dictionary of plate name to the converted profiles path.
+            qc_rules (dict): Dictionary of QC condition name to a rule with the `feature_thresholds` used for QC.
+        """
+        self.qc_rules = qc_rules
+        self.num_cells = {}
+
+        # sorted z-scores per plate, condition, and feature along with the z-scores of the other features of
+        # the condition in the same order
+        self._sorted_zscores = {}
+
+        qc_features = sorted(
+            {
+                feature
+                for rule in qc_rules.values()
+                for feature in rule["feature_thresholds"]
+            }
+        )
+        for plate, converted_path in converted_paths.items():
+            # only load the QC features from the converted profiles
+            plate_df = pd.read_parquet(converted_path, columns=qc_features)
+
+            self.num_cells[plate] = {}
+            self._sorted_zscores[plate] = {}
+            for condition, rule in qc_rules.items():
+                features = list(rule["feature_thresholds"])
+
+                # single-cells with NaN in the condition features are dropped before computing z-scores
+                feature_values = plate_df[features].dropna().to_numpy(dtype=np.float64)
+                zscores = (
+                    feature_values - feature_values.mean(axis=0)
+                ) / feature_values.std(axis=0)
+                self.num_cells[plate][condition] = zscores.shape[0]
+
+                self._sorted_zscores[plate][condition] = {}
+                for feature_index, feature in enumerate(features):
+                    order = np.argsort(zscores[:, feature_index], kind="stable")
+                    self._sorted_zscores[plate][condition][feature] = zscores[order]
+
+    @classmethod
+    def from_qc_results(
+        cls, converted_paths: Dict[str, pathlib.Path], qc_results_path: pathlib.Path
+    ) -> "QCThresholdTuner":
+        """Create a tuner with the QC conditions and thresholds saved in a QC results file.
+
+        Args:
+            converted_paths (Dict[str, pathlib.Path]): Dictionary of plate name to the converted profiles path.
+            qc_results_path (pathlib.Path): Path to a QC results Parquet file with the QC rules in its metadata.
+
+        Returns:
+            QCThresholdTuner: Tuner with the precomputed z-scores.
+        """
+        return cls(
+            converted_paths=converted_paths,
+            qc_rules=read_qc_rules(qc_results_path)["rules"],
+        )
+
+    def _count_plate_failing(
+        self, plate: str, condition: str, feature_thresholds: Dict[str, float]
+    ) -> int:
+        """Count the failing single-cells of one plate for a QC condition.
+
+        Args:
+            plate (str): Name of the plate.
+            condition (str): Name of the QC condition.
+            feature_thresholds (Dict[str, float]): Z-score threshold for each feature of the condition.
+
+        Returns:
+            int: Number of single-cells failing the condition.
+        """
+        features = list(self.qc_rules[condition]["feature_thresholds"])
+        sorted_zscores = self._sorted_zscores[plate][condition]
+
+        # count the single-cells beyond the threshold of each feature with a binary search
+        num_beyond = {
+            feature: _count_beyond_threshold(
+                sorted_zscores[feature][:, feature_index], feature_thresholds[feature]
+            )
+            for feature_index, feature in enumerate(features)
+        }
+        if len(features) == 1:
+            return num_beyond[features[0]]
+
+        # check the other thresholds only on the smallest slice of single-cells beyond a threshold
+        primary_feature = min(features, key=lambda feature: num_beyond[feature])
+        num_cells = sorted_zscores[primary_feature].shape[0]
+        primary_slice = (
+            slice(num_cells - num_beyond[primary_feature], num_cells)
+            if feature_thresholds[primary_feature] > 0
+            else slice(0, num_beyond[primary_feature])
+        )
+        candidates = sorted_zscores[primary_feature][primary_slice]
+        is_failing = np.ones(candidates.shape[0], dtype=bool)
+        for feature_index, feature in enumerate(features):
+            threshold = feature_thresholds[feature]
+            is_failing &= (
+                candidates[:, feature_index] > threshold
+                if threshold > 0
+                else candidates[:, feature_index] < threshold
+            )
+
+        return int(is_failing.sum())
+
+    def count_failing(
+        self,
+        condition: str,
+        feature_thresholds: Optional[Dict[str, float]] = None,
+        plates: Optional[Iterable[str]] = None,
+    ) -> pd.DataFrame:
+        """Count the single-cells failing a QC condition for every plate.
+
+        Args:
+            condition (str): Name of the QC condition (e.g., Failed_SolidityNuclei).
+            feature_thresholds (Optional[Dict[str, float]], optional): Z-score thresholds to use for the features
+                of the condition. Features that are not provided use the thresholds from the QC rules.
+                Defaults to None.
+            plates (Optional[Iterable[str]], optional): Plates to count. Defaults to None, which uses all plates.
+
+        Returns:
+            pd.DataFrame: Dataframe with the number and percentage of failing single-cells per plate.
+        """
+        thresholds = {
+            **self.qc_rules[condition]["feature_thresholds"],
+            **(feature_thresholds or {}),
+        }
+        plates = list(self.num_cells) if plates is None else list(plates)
+
+        counts = [
+            {
+                "plate": plate,
+                "condition": condition,
+                **{
+                    f"{feature}_threshold": value
+                    for feature, value in thresholds.items()
+                },
+                "num_cells": self.num_cells[plate][condition],
+                "num_failed": self._count_plate_failing(plate, condition, thresholds),
+            }
+            for plate in plates
+        ]
+        counts_df = pd.DataFrame(counts)
+        counts_df["percentage_failed"] = (
+            counts_df["num_failed"] / counts_df["num_cells"] * 100
+        )
+
+        return counts_df
+
+    def sweep(
+        self, condition: str, feature: str, thresholds: Iterable[float]
+    ) -> pd.DataFrame:
+        """Count the failing single-cells for every plate over a range of thresholds for one feature,
+        keeping the thresholds of the other features in the condition from the QC rules.
+
+        Args:
+            condition (str): Name of the QC condition.
+            feature (str): Feature of the condition to vary the threshold for.
+            thresholds (Iterable[float]): Z-score thresholds to evaluate.
+
+        Returns:
+            pd.DataFrame: Dataframe with the number and percentage of failing single-cells per plate and threshold.
+        """
+        return pd.concat(
+            [
+                self.count_failing(condition, feature_thresholds={feature: threshold})
+                for threshold in thresholds
+            ],
+            ignore_index=True,
+        )
+
+    def zscore_histogram(
+        self, condition: str, feature: str, bin_edges: Optional[np.ndarray] = None
+    ) -> pd.DataFrame:
+        """Get the histogram of the z-scores of a QC feature for every plate on shared bins.
+
+        Args:
+            condition (str): Name of the QC condition.
+            feature (str): Feature of the condition.
+            bin_edges (Optional[np.ndarray], optional): Edges of the bins. Defaults to None, which uses 0.1
+                wide bins from -10 to 10.
+
+        Returns:
+            pd.DataFrame: Long dataframe with the plate, bin edges, and count of single-cells in each bin.
+        """
+        if bin_edges is None:
+            bin_edges = np.linspace(-10, 10, 201)
+
+        feature_index = list(self.qc_rules[condition]["feature_thresholds"]).index(
+            feature
+        )
+        histograms: List[pd.DataFrame] = []
+        for plate in self.num_cells:
+            feature_zscores = self._sorted_zscores[plate][condition][feature][
+                :, feature_index
+            ]
+            # the z-scores are sorted so the bin counts are differences of binary searches
+            cumulative_counts = np.searchsorted(feature_zscores, bin_edges, side="left")
+            histograms.append(
+                pd.DataFrame(
+                    {
+                        "plate": plate,
+                        "bin_start": bin_edges[:-1],
+                        "bin_end": bin_edges[1:],
+                        "count": np.diff(cumulative_counts),
+                    }
+                )
+            )
+
+        return pd.concat(histograms, ignore_index=True)
@@ -0,0 +1,333 @@
+"""
+This collection of functions registers the Parquet outputs of every round (converted, cleaned, bulk, and QC results)
+as DuckDB views with consistent metadata column names, so reports can be written as SQL queries over the whole
+atlas. DuckDB only scans the columns and files a query needs, using multiple threads, without loading the files
+into memory first.
+"""
+
+import pathlib
+from typing import Dict, List, Optional, Tuple
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from plate_registry import get_plate_registry, index_plate_files
+from qc_results_utils import read_qc_rules
+
+# DuckDB is optional, so only the functions that query profiles need it to be installed
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# view name to the directory (relative to 3.preprocessing_features, with the round filled in) and file suffix
+PROFILE_OUTPUTS = {
+    "converted": ("data/converted_profiles/{round_id}", "_converted.parquet"),
+    "cleaned": ("data/cleaned_profiles/{round_id}", "_cleaned.parquet"),
+    "bulk": ("data/bulk_profiles/{round_id}", "_bulk_feature_selected.parquet"),
+    "qc_results": ("qc_results/{round_id}", "_qc_results.parquet"),
+}
+
+# legacy QC outputs with the indices of the failing single-cells, saved in qc_results (Round_1 plates at the top
+# level and the other rounds in subdirectories)
+LEGACY_QC_SUFFIX = "_failed_qc_indices.csv.gz"
+
+
+def _quote(identifier: str) -> str:
+    """Quote a column or view name for SQL."""
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def _file_list(paths: List[str]) -> str:
+    """Format file paths as a SQL list of strings."""
+    return (
+        "["
+        + ", ".join("'" + str(path).replace("'", "''") + "'" for path in paths)
+        + "]"
+    )
+
+
+def connect(
+    threads: Optional[int] = None, memory_limit: Optional[str] = None
+) -> "duckdb.DuckDBPyConnection":
+    """Create an in-memory DuckDB connection.
+
+    Args:
+        threads (Optional[int], optional): Number of threads for scans and aggregations. Defaults to None, which
+            uses the DuckDB default (the number of CPUs).
+        memory_limit (Optional[str], optional): Memory limit before DuckDB spills to disk (e.g., "16GB").
+            Defaults to None, which uses the DuckDB default.
+
+    Raises:
+        ImportError: If DuckDB is not installed.
+
+    Returns:
+        duckdb.DuckDBPyConnection: DuckDB connection.
+    """
+    if duckdb is None:
+        raise ImportError(
+            "DuckDB is required to query profiles, install it with `pip install duckdb`."
+        )
+
+    connection = duckdb.connect(database=":memory:")
+    if threads is not None:
+        connection.execute(f"SET threads TO {int(threads)}")
+    if memory_limit is not None:
+        connection.execute(f"SET memory_limit = '{memory_limit}'")
+
+    return connection
+
+
+def _select_round_files(
+    round_id: str, paths: List[str], failed_qc_conditions: Optional[List[str]] = None
+) -> str:
+    """Create the SQL selecting the files of one round with consistent metadata column names.
+
+    Image metadata columns (e.g., Image_Metadata_Plate) are renamed to Metadata columns (e.g., Metadata_Plate)
+    unless the files already have the Metadata column, and the round is added as Metadata_round.
+
+    Args:
+        round_id (str): Round of data (e.g., Round_4_data).
+        paths (List[str]): Parquet files of the round.
+        failed_qc_conditions (Optional[List[str]], optional): QC conditions combined into a failed_qc column.
+            Defaults to None, which does not add the column.
+
+    Returns:
+        str: SQL select statement.
+    """
+    column_names = []
+    for path in paths:
+        for name in pq.read_schema(path).names:
+            if name not in column_names:
+                column_names.append(name)
+
+    renamed_columns = {
+        name: name[len("Image_") :]
+        for name in column_names
+        if name.startswith("Image_Metadata_")
+        and name[len("Image_") :] not in column_names
+    }
+
+    select_columns = ["*"]
+    if renamed_columns:
+        select_columns = [
+            f"* EXCLUDE ({', '.join(_quote(name) for name in renamed_columns)})"
+        ] + [
+            f"{_quote(name)} AS {_quote(new_name)}"
+            for name, new_name in renamed_columns.items()
+        ]
+    select_columns.append(f"'{round_id}' AS Metadata_round")
+    if failed_qc_conditions:
+        select_columns.append(
+            "("
+            # conditions missing from a plate's file are NULL, so they do not count as failing
+            + " OR ".join(
+                f"COALESCE({_quote(condition)}, false)"
+                for condition in failed_qc_conditions
+            )
+            + ") AS failed_qc"
+        )
+
+    return (
+        f"SELECT {', '.join(select_columns)} "
+        f"FROM read_parquet({_file_list(paths)}, union_by_name = true)"
+    )
+
+
+def _select_legacy_qc_files(
+    round_id: str, legacy_plate_files: Dict[str, Tuple[str, str]]
+) -> str:
+    """Create the SQL selecting one row per single-cell of plates with legacy failed QC index files.
+
+    The single-cells are read from the converted profiles, and a single-cell fails QC if its row number in the
+    converted profiles is one of the failed QC indices.
+
+    Args:
+        round_id (str): Round of data (e.g., Round_4_data).
+        legacy_plate_files (Dict[str, Tuple[str, str]]): Dictionary of plate barcode to the paths of its converted
+            profiles and failed QC indices CSV file.
+
+    Returns:
+        str: SQL select statement with the Metadata_Plate, Metadata_Well, Metadata_round, and failed_qc columns.
+    """
+    plate_selects = []
+    for plate, (converted_path, failed_qc_indices_path) in legacy_plate_files.items():
+        converted_columns = pq.read_schema(converted_path).names
+        well_column = (
+            "Metadata_Well"
+            if "Metadata_Well" in converted_columns
+            else "Image_Metadata_Well"
+        )
+        plate_selects.append(
+            f"SELECT '{plate}' AS Metadata_Plate, "
+            f"converted.{_quote(well_column)} AS Metadata_Well, "
+            f"'{round_id}' AS Metadata_round, "
+            "failed.original_indices IS NOT NULL AS failed_qc "
+            f"FROM read_parquet({_file_list([converted_path])}, file_row_number = true) AS converted "
+            "LEFT JOIN (SELECT DISTINCT original_indices "
+            f"FROM read_csv({_file_list([failed_qc_indices_path])})) AS failed "
+            "ON converted.file_row_number = failed.original_indices"
+        )
+
+    return " UNION ALL ".join(plate_selects)
+
+
+def platemap_metadata(platemap_dir: pathlib.Path) -> pd.DataFrame:
+    """Combine the platemaps of every plate in the barcode platemap into one table of well metadata.
+
+    Args:
+        platemap_dir (pathlib.Path): Directory with the platemap CSV files and the barcode platemap.
+
+    Returns:
+        pd.DataFrame: Dataframe with one row per plate and well, with the platemap columns prefixed with
+            "Metadata_" and the Metadata_Plate and Metadata_time_point columns.
+    """
+    registry = get_plate_registry(pathlib.Path(platemap_dir))
+
+    platemap_dfs = []
+    for barcode, info in registry.barcodes.items():
+        if info["platemap_path"] is None:
+            continue
+        platemap_df = pd.read_csv(info["platemap_path"]).add_prefix("Metadata_")
+        platemap_df["Metadata_Plate"] = barcode
+        platemap_df["Metadata_time_point"] = info["time_point"]
+        platemap_dfs.append(platemap_df)
+
+    return pd.concat(platemap_dfs, ignore_index=True).rename(
+        columns={"Metadata_well": "Metadata_Well"}
+    )
+
+
+def register_profile_views(
+    connection: "duckdb.DuckDBPyConnection",
+    preprocessing_dir: pathlib.Path,
+    platemap_dir: pathlib.Path,
+    round_ids: Optional[List[str]] = None,
+) -> Dict[str, int]:
+    """Register every round's Parquet outputs and the platemaps as views on a DuckDB connection.
+
+    The views are converted, cleaned, bulk (feature-selected bulk profiles), qc_results (with a failed_qc
+    column for single-cells failing any QC condition), and platemaps (well metadata of every plate). Metadata
+    columns use the Metadata_Plate and Metadata_Well names in every view, so they can be joined directly.
+    Plates without QC results but with a legacy failed QC indices file are added to the qc_results view with
+    only the metadata and failed_qc columns.
+
+    Args:
+        connection (duckdb.DuckDBPyConnection): DuckDB connection (e.g., from `connect`).
+        preprocessing_dir (pathlib.Path): Path to the 3.preprocessing_features directory.
+        platemap_dir (pathlib.Path): Directory with the platemap CSV files and the barcode platemap.
+        round_ids (Optional[List[str]], optional): Rounds to register. Defaults to None, which uses every round
+            with converted profiles.
+
+    Raises:
+        FileNotFoundError: If round_ids is None and there is no converted profiles directory to find the rounds.
+
+    Returns:
+        Dict[str, int]: Dictionary of view name to the number of files registered.
+    """
+    preprocessing_dir = pathlib.Path(preprocessing_dir)
+    if round_ids is None:
+        converted_dir = preprocessing_dir / "data/converted_profiles"
+        if not converted_dir.exists():
+            raise FileNotFoundError(
+                f"Can not find the rounds to register because {converted_dir} does not exist, run "
+                "0.convert_cytotable or pass round_ids."
+            )
+        round_ids = sorted(
+            path.name for path in converted_dir.iterdir() if path.is_dir()
+        )
+
+    converted_directory, converted_suffix = PROFILE_OUTPUTS["converted"]
+    legacy_qc_files = (
+        index_plate_files(preprocessing_dir / "qc_results", LEGACY_QC_SUFFIX)
+        if (preprocessing_dir / "qc_results").exists()
+        else {}
+    )
+
+    num_files = {}
+    for view, (directory, suffix) in PROFILE_OUTPUTS.items():
+        round_selects = []
+        num_files[view] = 0
+        for round_id in round_ids:
+            round_dir = preprocessing_dir / directory.format(round_id=round_id)
+            plate_files = (
+                index_plate_files(round_dir, suffix) if round_dir.exists() else {}
+            )
+            paths = list(plate_files.values())
+
+            failed_qc_conditions = None
+            if view == "qc_results":
+                failed_qc_conditions = sorted(
+                    {
+                        condition
+                        for path in paths
+                        for condition in read_qc_rules(path)["rules"]
+                    }
+                )
+
+                # plates of the round without QC results fall back to their legacy failed QC indices
+                converted_dir = preprocessing_dir / converted_directory.format(
+                    round_id=round_id
+                )
+                converted_files = (
+                    index_plate_files(converted_dir, converted_suffix)
+                    if converted_dir.exists()
+                    else {}
+                )
+                legacy_plate_files = {
+                    plate: (converted_path, legacy_qc_files[plate])
+                    for plate, converted_path in converted_files.items()
+                    if plate in legacy_qc_files and plate not in plate_files
+                }
+                if legacy_plate_files:
+                    round_selects.append(
+                        _select_legacy_qc_files(round_id, legacy_plate_files)
+                    )
+                    num_files[view] += len(legacy_plate_files)
+
+            if paths:
+                round_selects.append(
+                    _select_round_files(round_id, paths, failed_qc_conditions)
+                )
+                num_files[view] += len(paths)
+
+        if round_selects:
+            connection.execute(
+                f"CREATE OR REPLACE VIEW {_quote(view)} AS "
+                + " UNION ALL BY NAME ".join(round_selects)
+            )
+
+    connection.register("platemaps", platemap_metadata(platemap_dir))
+    num_files["platemaps"] = 1
+
+    return num_files
+
+
+def query_qc_report(connection: "duckdb.DuckDBPyConnection") -> pd.DataFrame:
+    """Count the single-cells segmented and failing QC per platemap condition across all registered rounds.
+
+    Args:
+        connection (duckdb.DuckDBPyConnection): DuckDB connection with the views from `register_profile_views`.
+
+    Returns:
+        pd.DataFrame: QC report with one row per round, plate, cell line, seeding density, time point, and
+            condition, with the total single-cells segmented, failing QC, and the percentage failing.
+    """
+    return connection.execute("""
+        SELECT
+            qc.Metadata_round,
+            platemaps.Metadata_cell_line,
+            platemaps.Metadata_seeding_density,
+            platemaps.Metadata_time_point,
+            platemaps.Metadata_condition,
+            qc.Metadata_Plate,
+            COUNT(*) AS total_nuclei_segmented,
+            SUM(CAST(qc.failed_qc AS INTEGER)) AS total_failed_qc,
+            100 * AVG(CAST(qc.failed_qc AS DOUBLE)) AS percentage_failing_cells
+        FROM qc_results AS qc
+        JOIN platemaps
+            ON qc.Metadata_Plate = platemaps.Metadata_Plate
+            AND qc.Metadata_Well = platemaps.Metadata_Well
+        GROUP BY ALL
+        ORDER BY ALL
+        """).df()
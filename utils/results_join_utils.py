@@ -0,0 +1,206 @@
+"""
+This collection of functions joins the Pearson correlation results of the optimization with the QC report. Both
+tables are loaded with enforced dtypes (categorical cell line, seeding density, and time point, and a boolean
+Shuffled column), so dtype drift raises an error instead of silently dropping rows from the join. The join is done
+on the integer codes of shared categories and the merged table is cached by the hashes of the input files.
+"""
+
+import hashlib
+import pathlib
+from typing import List
+
+import pandas as pd
+
+from results_store import file_hash
+
+# metadata columns the results are joined on and the dtype of their values before they are made categorical
+JOIN_COLUMN_DTYPES = {
+    "Metadata_cell_line": "str",
+    "Metadata_seeding_density": "int64",
+    "Metadata_time_point": "int64",
+}
+
+# values of the Shuffled column written as strings by the pairwise comparisons
+SHUFFLED_VALUES = {"True": True, "False": False, True: True, False: False}
+
+
+def _enforce_dtypes(
+    df: pd.DataFrame, required_columns: List[str], table_name: str
+) -> pd.DataFrame:
+    """Strip the column names, check the required columns, and cast the join columns to categorical dtypes.
+
+    Args:
+        df (pd.DataFrame): Table to type.
+        required_columns (List[str]): Columns the table must have besides the join columns.
+        table_name (str): Name of the table used in error messages.
+
+    Raises:
+        ValueError: If columns are missing or join column values cannot be cast to their dtype.
+
+    Returns:
+        pd.DataFrame: Typed copy of the table.
+    """
+    df = df.copy()
+    df.columns = df.columns.str.strip()
+
+    missing_columns = [
+        column
+        for column in list(JOIN_COLUMN_DTYPES) + required_columns
+        if column not in df.columns
+    ]
+    if missing_columns:
+        raise ValueError(
+            f"The {table_name} table is missing columns {missing_columns}."
+        )
+
+    for column, dtype in JOIN_COLUMN_DTYPES.items():
+        values = df[column]
+        if dtype == "str":
+            typed_values = values.where(values.isna(), values.astype(str).str.strip())
+        else:
+            typed_values = pd.to_numeric(values, errors="coerce")
+            is_invalid = typed_values.notna() & (typed_values % 1 != 0)
+            if (typed_values.isna() & values.notna()).any() or is_invalid.any():
+                raise ValueError(
+                    f"The {table_name} column {column} has values that are not integers: "
+                    f"{values[(typed_values.isna() & values.notna()) | is_invalid].unique().tolist()}."
+                )
+            # missing values need the nullable integer dtype
+            typed_values = typed_values.astype(
+                "Int64" if typed_values.isna().any() else "int64"
+            )
+        df[column] = typed_values.astype("category")
+
+    return df
+
+
+def load_pearson_results(pearson_path: pathlib.Path) -> pd.DataFrame:
+    """Load the Pearson correlation results with typed join columns and a boolean Shuffled column.
+
+    Args:
+        pearson_path (pathlib.Path): Path to the Pearson correlation results (Parquet).
+
+    Raises:
+        ValueError: If columns are missing or have values that cannot be typed.
+
+    Returns:
+        pd.DataFrame: Typed Pearson correlation results.
+    """
+    pearson_df = _enforce_dtypes(
+        pd.read_parquet(pearson_path),
+        required_columns=["pearsons_correlation", "Shuffled"],
+        table_name="Pearson correlation",
+    )
+
+    shuffled = pearson_df["Shuffled"].map(SHUFFLED_VALUES)
+    if shuffled.isna().any():
+        raise ValueError(
+            f"The Shuffled column has values that are not True or False: "
+            f"{pearson_df.loc[shuffled.isna(), 'Shuffled'].unique().tolist()}."
+        )
+    pearson_df["Shuffled"] = shuffled.astype(bool)
+
+    return pearson_df
+
+
+def load_qc_results(qc_path: pathlib.Path) -> pd.DataFrame:
+    """Load the QC report with typed join columns.
+
+    Args:
+        qc_path (pathlib.Path): Path to the QC report (Parquet).
+
+    Raises:
+        ValueError: If columns are missing or have values that cannot be typed.
+
+    Returns:
+        pd.DataFrame: Typed QC report.
+    """
+    return _enforce_dtypes(
+        pd.read_parquet(qc_path),
+        required_columns=["percentage_failing_cells"],
+        table_name="QC report",
+    )
+
+
+def join_pearson_qc(
+    pearson_df: pd.DataFrame, qc_df: pd.DataFrame, shuffled: bool = False
+) -> pd.DataFrame:
+    """Join the typed Pearson correlation results and QC report on the integer codes of the join columns.
+
+    Args:
+        pearson_df (pd.DataFrame): Typed Pearson correlation results (see `load_pearson_results`).
+        qc_df (pd.DataFrame): Typed QC report (see `load_qc_results`).
+        shuffled (bool, optional): Whether to keep the results of the shuffled profiles. Defaults to False.
+
+    Returns:
+        pd.DataFrame: Inner join of the results, with categorical join columns.
+    """
+    pearson_df = pearson_df[pearson_df["Shuffled"] == shuffled].copy()
+    qc_df = qc_df.copy()
+
+    code_columns = []
+    for column in JOIN_COLUMN_DTYPES:
+        # both tables use the same categories, so equal values have equal codes
+        categories = (
+            pd.Index(pearson_df[column].cat.categories)
+            .union(qc_df[column].cat.categories)
+            .sort_values()
+        )
+        dtype = pd.CategoricalDtype(categories)
+        pearson_df[column] = pearson_df[column].astype(dtype)
+        qc_df[column] = qc_df[column].astype(dtype)
+
+        code_column = f"{column}__code"
+        pearson_df[code_column] = pearson_df[column].cat.codes
+        qc_df[code_column] = qc_df[column].cat.codes
+        code_columns.append(code_column)
+
+    merged_df = pd.merge(
+        pearson_df,
+        qc_df.drop(columns=list(JOIN_COLUMN_DTYPES)),
+        on=code_columns,
+        how="inner",
+    )
+
+    return merged_df.drop(columns=code_columns)
+
+
+def cached_join_pearson_qc(
+    pearson_path: pathlib.Path,
+    qc_path: pathlib.Path,
+    cache_dir: pathlib.Path,
+    shuffled: bool = False,
+) -> pd.DataFrame:
+    """Load and join the Pearson correlation results and QC report, reusing the cached join if the inputs did not
+    change.
+
+    Args:
+        pearson_path (pathlib.Path): Path to the Pearson correlation results (Parquet).
+        qc_path (pathlib.Path): Path to the QC report (Parquet).
+        cache_dir (pathlib.Path): Directory of the cached joins, saved as `pearson_qc_{hash}.parquet`.
+        shuffled (bool, optional): Whether to keep the results of the shuffled profiles. Defaults to False.
+
+    Returns:
+        pd.DataFrame: Inner join of the results (see `join_pearson_qc`).
+    """
+    cache_key = hashlib.sha256(
+        f"{file_hash(pearson_path)}{file_hash(qc_path)}{shuffled}".encode()
+    ).hexdigest()[:16]
+    cache_path = pathlib.Path(cache_dir) / f"pearson_qc_{cache_key}.parquet"
+
+    if cache_path.exists():
+        merged_df = pd.read_parquet(cache_path)
+        # Parquet keeps the categorical dtype of strings but not of integers
+        for column in JOIN_COLUMN_DTYPES:
+            merged_df[column] = merged_df[column].astype("category")
+
+        return merged_df
+
+    merged_df = join_pearson_qc(
+        load_pearson_results(pearson_path), load_qc_results(qc_path), shuffled=shuffled
+    )
+
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    merged_df.to_parquet(cache_path)
+
+    return merged_df
@@ -0,0 +1,142 @@
+"""
+This collection of functions stores results computed per plate (e.g., pairwise correlations) as one Parquet file
+per plate, with a manifest of the hash of each plate's input file and the parameters used. When plates are added
+or changed, only those plates are recomputed, and the combined results are made by concatenating the plate files.
+"""
+
+import hashlib
+import json
+import pathlib
+from typing import Callable, Dict, List, Optional
+
+import pandas as pd
+
+
+def file_hash(path: pathlib.Path, chunk_size: int = 1024 * 1024) -> str:
+    """Compute the SHA-256 hash of a file, reading it in chunks.
+
+    Args:
+        path (pathlib.Path): Path to the file.
+        chunk_size (int, optional): Number of bytes read at a time. Defaults to 1 MB.
+
+    Returns:
+        str: Hexadecimal hash of the file contents.
+    """
+    file_hasher = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            file_hasher.update(chunk)
+
+    return file_hasher.hexdigest()
+
+
+class PlateResultsStore:
+    """
+    Results saved per plate with the hash of the input file and the parameters they were computed from.
+
+    Attributes:
+        store_dir (pathlib.Path): Directory with the plate result files and the manifest.
+        parameters (dict): Parameters of the computation (e.g., the shuffle seed). Plates computed with other
+            parameters are recomputed.
+        manifest (Dict[str, dict]): Dictionary of plate name to its input path, input hash, parameters, result
+            file, and number of rows.
+    """
+
+    def __init__(self, store_dir: pathlib.Path, parameters: Optional[dict] = None):
+        self.store_dir = pathlib.Path(store_dir)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        self.parameters = parameters or {}
+
+        self._manifest_path = self.store_dir / "manifest.json"
+        self.manifest: Dict[str, dict] = (
+            json.loads(self._manifest_path.read_text())
+            if self._manifest_path.exists()
+            else {}
+        )
+
+    def _result_path(self, plate: str) -> pathlib.Path:
+        return self.store_dir / f"{plate}_results.parquet"
+
+    def is_current(self, plate: str, input_path: pathlib.Path) -> bool:
+        """Check if a plate's saved results were computed from the same input file and parameters.
+
+        Args:
+            plate (str): Name of the plate.
+            input_path (pathlib.Path): Path to the plate's input file.
+
+        Returns:
+            bool: True if the plate does not need to be recomputed.
+        """
+        entry = self.manifest.get(plate)
+
+        return (
+            entry is not None
+            and self._result_path(plate).exists()
+            and entry["parameters"] == self.parameters
+            and entry["input_hash"] == file_hash(input_path)
+        )
+
+    def write(
+        self, plate: str, input_path: pathlib.Path, results_df: pd.DataFrame
+    ) -> None:
+        """Save a plate's results and record the hash of its input file in the manifest.
+
+        Args:
+            plate (str): Name of the plate.
+            input_path (pathlib.Path): Path to the plate's input file.
+            results_df (pd.DataFrame): Results of the plate.
+        """
+        results_df.to_parquet(self._result_path(plate), index=False)
+        self.manifest[plate] = {
+            "input_path": str(input_path),
+            "input_hash": file_hash(input_path),
+            "parameters": self.parameters,
+            "result_file": self._result_path(plate).name,
+            "num_rows": int(results_df.shape[0]),
+        }
+        # write the manifest after every plate so finished plates are kept if a later plate fails
+        self._manifest_path.write_text(json.dumps(self.manifest, indent=4))
+
+    def update(
+        self,
+        plate_inputs: Dict[str, pathlib.Path],
+        compute: Callable[[str, pathlib.Path], pd.DataFrame],
+    ) -> List[str]:
+        """Compute the results of plates that are new or whose input file or parameters changed.
+
+        Args:
+            plate_inputs (Dict[str, pathlib.Path]): Dictionary of plate name to its input file.
+            compute (Callable[[str, pathlib.Path], pd.DataFrame]): Function called as `compute(plate, input_path)`
+                that returns the plate's results.
+
+        Returns:
+            List[str]: Plates that were recomputed.
+        """
+        recomputed_plates = []
+        for plate, input_path in plate_inputs.items():
+            if self.is_current(plate, input_path):
+                continue
+            print(f"Computing results for {plate}")
+            self.write(plate, input_path, compute(plate, input_path))
+            recomputed_plates.append(plate)
+
+        return recomputed_plates
+
+    def read(self, plates: Optional[List[str]] = None) -> pd.DataFrame:
+        """Combine the saved results of plates.
+
+        Args:
+            plates (Optional[List[str]], optional): Plates to read. Defaults to None, which reads every plate in
+                the manifest.
+
+        Returns:
+            pd.DataFrame: Concatenated results, in sorted plate order (empty if there are no plates).
+        """
+        plates = sorted(self.manifest if plates is None else plates)
+        if not plates:
+            return pd.DataFrame()
+
+        return pd.concat(
+            [pd.read_parquet(self._result_path(plate)) for plate in plates],
+            axis=0,
+        )
@@ -0,0 +1,221 @@
+"""
+This collection of functions measures reproducibility at the single-cell level with bounded memory. A fixed number
+of cells is sampled from each well by streaming the single-cell profiles in batches of rows and keeping a reservoir
+per well, so the full plate is never loaded. The similarities between sampled cells of the same condition (in
+different wells) and of different conditions are computed in chunks of rows and accumulated as histograms.
+"""
+
+import pathlib
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from correlation_utils import _group_codes
+from similarity_utils import normalize_profiles
+
+# types of pairs of cells, in the order of their codes
+PAIR_TYPES = ["within_well", "within_condition", "across_condition"]
+
+
+def sample_cells_per_well(
+    profile_path: pathlib.Path,
+    cells_per_well: int = 50,
+    well_column: str = "Metadata_Well",
+    columns: Optional[List[str]] = None,
+    batch_size: int = 100000,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """Sample cells uniformly from each well without loading the whole plate.
+
+    Every cell gets a random key and each well keeps the cells with the smallest keys seen so far (a reservoir
+    of at most `cells_per_well` cells), so only the reservoirs and one batch of rows are in memory. The sample
+    does not depend on the batch size.
+
+    Args:
+        profile_path (pathlib.Path): Path to the single-cell profiles of one plate
+            (e.g., `{plate}_sc_feature_selected.parquet`).
+        cells_per_well (int, optional): Maximum number of cells sampled from each well. Defaults to 50.
+        well_column (str, optional): Column with the well of each cell. Defaults to "Metadata_Well".
+        columns (Optional[List[str]], optional): Columns to read. Defaults to None, which reads all columns.
+        batch_size (int, optional): Maximum number of rows read at a time. Defaults to 100000.
+        seed (int, optional): Seed of the random keys. Defaults to 0.
+
+    Returns:
+        pd.DataFrame: Sampled cells sorted by well, with all cells of wells with fewer cells than
+            `cells_per_well`.
+    """
+    if columns is not None and well_column not in columns:
+        columns = [well_column] + list(columns)
+
+    rng = np.random.default_rng(seed)
+    reservoir = None
+    for record_batch in pq.ParquetFile(profile_path).iter_batches(
+        batch_size=batch_size, columns=columns
+    ):
+        batch_df = record_batch.to_pandas()
+        # keys are drawn for every row in file order, so they are the same for any batch size
+        batch_df["_sample_key"] = rng.random(batch_df.shape[0])
+        batch_df = batch_df.dropna(subset=[well_column])
+
+        candidates = (
+            batch_df if reservoir is None else pd.concat([reservoir, batch_df])
+        ).sort_values([well_column, "_sample_key"], kind="stable")
+        reservoir = candidates[
+            candidates.groupby(well_column, sort=False).cumcount() < cells_per_well
+        ]
+
+    if reservoir is None:
+        return pd.DataFrame(columns=columns)
+
+    return reservoir.drop(columns="_sample_key").reset_index(drop=True)
+
+
+def similarity_histograms(
+    profiles: pd.DataFrame,
+    feature_columns: List[str],
+    condition_columns: List[str] = [
+        "Metadata_cell_line",
+        "Metadata_seeding_density",
+        "Metadata_time_point",
+    ],
+    reference_columns: Optional[List[str]] = None,
+    well_column: str = "Metadata_Well",
+    metric: str = "pearsons_correlation",
+    num_bins: int = 200,
+    chunk_size: int = 1000,
+) -> pd.DataFrame:
+    """Compute the histograms of the similarities between cells of each condition and all other cells.
+
+    The similarities of a chunk of cells (rows) to all cells are computed with one matrix product, and only the
+    histogram counts, sums, and sums of squares per condition and pair type are kept, so memory is bounded by
+    the chunk size. Each pair is counted once for the condition of each of its cells.
+
+    Args:
+        profiles (pd.DataFrame): Sampled single-cell profiles (e.g., from `sample_cells_per_well`).
+        feature_columns (List[str]): Feature columns used for the similarities.
+        condition_columns (List[str], optional): Columns defining the condition of a cell.
+            Defaults to ["Metadata_cell_line", "Metadata_seeding_density", "Metadata_time_point"].
+        reference_columns (Optional[List[str]], optional): Columns whose values must be the same for two cells to
+            be compared (e.g., seeding density and time point, so cell lines are compared at the same condition).
+            Defaults to None, which compares every pair of cells.
+        well_column (str, optional): Column with the well of each cell. Defaults to "Metadata_Well".
+        metric (str, optional): Similarity metric (see SIMILARITY_METRICS). Defaults to "pearsons_correlation".
+        num_bins (int, optional): Number of equal bins from -1 to 1. Defaults to 200.
+        chunk_size (int, optional): Number of cells compared to all cells at a time. Defaults to 1000.
+
+    Returns:
+        pd.DataFrame: Dataframe with the condition columns, pair type (within_well, within_condition in
+            different wells, or across_condition), bin edges, and the count, sum, and sum of squares of the
+            similarities in each bin.
+    """
+    group_columns = list(
+        dict.fromkeys(list(reference_columns or []) + condition_columns)
+    )
+    normalized = normalize_profiles(profiles[feature_columns].to_numpy(), [metric])[
+        metric
+    ]
+
+    condition_codes = _group_codes(profiles, group_columns)
+    well_codes = _group_codes(profiles, [well_column])
+    reference_codes = (
+        _group_codes(profiles, reference_columns)
+        if reference_columns
+        else np.zeros(profiles.shape[0], dtype=np.int64)
+    )
+    num_conditions = condition_codes.max() + 1
+    num_types = len(PAIR_TYPES)
+    num_cells = profiles.shape[0]
+
+    num_histogram_bins = num_conditions * num_types * num_bins
+    counts = np.zeros(num_histogram_bins, dtype=np.int64)
+    sums = np.zeros(num_histogram_bins)
+    sums_squares = np.zeros(num_histogram_bins)
+    for start in range(0, num_cells, chunk_size):
+        rows = np.arange(start, min(start + chunk_size, num_cells))
+        similarity = normalized[rows] @ normalized.T
+
+        # pairs of cells with the same reference values, without a cell compared to itself
+        keep = (
+            reference_codes[rows][:, np.newaxis] == reference_codes[np.newaxis, :]
+        ) & (rows[:, np.newaxis] != np.arange(num_cells)[np.newaxis, :])
+        keep &= (condition_codes[rows] >= 0)[:, np.newaxis] & (condition_codes >= 0)[
+            np.newaxis, :
+        ]
+        keep &= ~np.isnan(similarity)
+
+        same_well = well_codes[rows][:, np.newaxis] == well_codes[np.newaxis, :]
+        same_condition = (
+            condition_codes[rows][:, np.newaxis] == condition_codes[np.newaxis, :]
+        )
+        pair_types = np.where(same_condition, np.where(same_well, 0, 1), 2)
+        bins = np.clip(
+            ((np.nan_to_num(similarity) + 1) / 2 * num_bins).astype(np.int64),
+            0,
+            num_bins - 1,
+        )
+        bin_index = (
+            condition_codes[rows][:, np.newaxis] * num_types + pair_types
+        ) * num_bins + bins
+
+        counts += np.bincount(bin_index[keep], minlength=num_histogram_bins)
+        sums += np.bincount(
+            bin_index[keep], weights=similarity[keep], minlength=num_histogram_bins
+        )
+        sums_squares += np.bincount(
+            bin_index[keep], weights=similarity[keep] ** 2, minlength=num_histogram_bins
+        )
+
+    condition_rows = [
+        np.flatnonzero(condition_codes == code)[0] for code in range(num_conditions)
+    ]
+    histogram_df = (
+        profiles[group_columns]
+        .iloc[np.repeat(condition_rows, num_types * num_bins)]
+        .reset_index(drop=True)
+    )
+    bin_edges = np.linspace(-1, 1, num_bins + 1)
+    histogram_df["pair_type"] = np.tile(np.repeat(PAIR_TYPES, num_bins), num_conditions)
+    histogram_df["bin_lower"] = np.tile(bin_edges[:-1], num_conditions * num_types)
+    histogram_df["bin_upper"] = np.tile(bin_edges[1:], num_conditions * num_types)
+    histogram_df["count"] = counts
+    histogram_df["sum"] = sums
+    histogram_df["sum_squares"] = sums_squares
+
+    return histogram_df[histogram_df["count"] > 0].reset_index(drop=True)
+
+
+def summarize_similarity_histograms(
+    histogram_df: pd.DataFrame, group_columns: List[str]
+) -> pd.DataFrame:
+    """Summarize the similarity histograms of each condition and pair type (e.g., merged across plates).
+
+    Args:
+        histogram_df (pd.DataFrame): Histograms from `similarity_histograms`.
+        group_columns (List[str]): Columns of the conditions to summarize (e.g., cell line, seeding density, and
+            time point).
+
+    Returns:
+        pd.DataFrame: Dataframe with one row per condition and pair type with the number of pairs and the mean
+            and standard deviation of the similarities.
+    """
+    summary_df = (
+        histogram_df.groupby(group_columns + ["pair_type"], observed=True)[
+            ["count", "sum", "sum_squares"]
+        ]
+        .sum()
+        .reset_index()
+    )
+    summary_df["mean_similarity"] = summary_df["sum"] / summary_df["count"]
+    summary_df["std_similarity"] = np.sqrt(
+        np.maximum(
+            summary_df["sum_squares"] / summary_df["count"]
+            - summary_df["mean_similarity"] ** 2,
+            0,
+        )
+    )
+
+    return summary_df.drop(columns=["sum", "sum_squares"]).rename(
+        columns={"count": "num_pairs"}
+    )
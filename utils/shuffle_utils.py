@@ -0,0 +1,120 @@
+"""
+This collection of functions generates shuffled profiles for the null model of replicate reproducibility.
+Every feature column is permuted independently within groups of rows (e.g., time point) in one NumPy operation,
+by sorting a matrix of random numbers offset by the group of each row. Each shuffled replicate has its own seed
+derived from one base seed, so replicates are reproducible and can be generated in any order or in parallel.
+"""
+
+from typing import Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+
+
+def encode_groups(profiles: pd.DataFrame, group_columns: List[str]) -> np.ndarray:
+    """Encode the combination of group column values of each row as an integer code.
+
+    Args:
+        profiles (pd.DataFrame): Profiles with the group columns.
+        group_columns (List[str]): Columns defining the groups (e.g., ["Metadata_time_point"]).
+
+    Returns:
+        np.ndarray: Integer group code of each row (0 to the number of groups - 1).
+    """
+    if not group_columns:
+        return np.zeros(profiles.shape[0], dtype=np.int64)
+
+    return profiles.groupby(group_columns, sort=True, dropna=False).ngroup().to_numpy()
+
+
+def shuffle_within_groups(
+    features: np.ndarray,
+    group_codes: np.ndarray,
+    rng: np.random.Generator,
+) -> np.ndarray:
+    """Permute each feature column independently within groups of rows.
+
+    Args:
+        features (np.ndarray): Matrix of profiles (rows) by features (columns).
+        group_codes (np.ndarray): Integer group code of each row (e.g., from `encode_groups`).
+        rng (np.random.Generator): Random number generator.
+
+    Returns:
+        np.ndarray: Shuffled matrix where every column has the same values in each group as the input, in a
+            random order that is different for each column.
+    """
+    group_codes = np.asarray(group_codes)
+
+    # rows in group order, which is the same block structure for every column after sorting the random keys
+    group_order = np.argsort(group_codes, kind="stable")
+
+    # random numbers in [0, 1) offset by the group code sort the rows by group and randomly within each group
+    random_keys = group_codes[:, np.newaxis] + rng.random(features.shape)
+    permutation = np.argsort(random_keys, axis=0)
+
+    shuffled = np.empty_like(features)
+    shuffled[group_order] = np.take_along_axis(features, permutation, axis=0)
+
+    return shuffled
+
+
+def iter_shuffled_replicates(
+    features: np.ndarray,
+    group_codes: np.ndarray,
+    n_replicates: int,
+    seed: int = 0,
+    start: int = 0,
+) -> Iterator[np.ndarray]:
+    """Yield shuffled replicates of a feature matrix, each with its own seed derived from the base seed.
+
+    Replicate i is the same whether it is generated alone, in a chunk (with `start`), or with all replicates.
+
+    Args:
+        features (np.ndarray): Matrix of profiles (rows) by features (columns).
+        group_codes (np.ndarray): Integer group code of each row.
+        n_replicates (int): Number of replicates to generate.
+        seed (int, optional): Base seed of the replicates. Defaults to 0.
+        start (int, optional): Index of the first replicate (e.g., the first replicate of a chunk).
+            Defaults to 0.
+
+    Yields:
+        np.ndarray: Shuffled feature matrix.
+    """
+    seed_sequences = np.random.SeedSequence(seed).spawn(start + n_replicates)[start:]
+    for seed_sequence in seed_sequences:
+        yield shuffle_within_groups(
+            features, group_codes, np.random.default_rng(seed_sequence)
+        )
+
+
+def shuffle_profiles_within_groups(
+    profiles: pd.DataFrame,
+    feature_columns: List[str],
+    group_columns: Optional[List[str]] = None,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """Shuffle the feature columns of profiles independently within groups, keeping the metadata unchanged.
+
+    Args:
+        profiles (pd.DataFrame): Profiles with the feature and group columns.
+        feature_columns (List[str]): Feature columns to shuffle.
+        group_columns (Optional[List[str]], optional): Columns defining the groups the features are shuffled
+            within (e.g., ["Metadata_time_point"]). Defaults to None, which shuffles across all rows.
+        seed (int, optional): Seed of the shuffle. Defaults to 0.
+
+    Returns:
+        pd.DataFrame: Copy of the profiles with shuffled features.
+    """
+    shuffled_features = next(
+        iter_shuffled_replicates(
+            profiles[feature_columns].to_numpy(),
+            encode_groups(profiles, group_columns or []),
+            n_replicates=1,
+            seed=seed,
+        )
+    )
+
+    shuffled_df = profiles.copy()
+    shuffled_df[feature_columns] = shuffled_features
+
+    return shuffled_df
@@ -0,0 +1,245 @@
+"""
+This collection of functions computes several similarity metrics between profiles in one pass. The profiles are
+normalized once per metric (centered and scaled for Pearson, rank-transformed then centered and scaled for Spearman,
+and scaled for cosine), so every metric of the pairs in a group comes from a matrix product of the same rows. Mean
+average precision (mAP) measures how well the replicate wells of a condition are retrieved among all other wells.
+"""
+
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+from scipy.stats import rankdata
+
+from correlation_utils import PairwisePearson, _group_codes, standardize_rows
+
+SIMILARITY_METRICS = [
+    "pearsons_correlation",
+    "spearmans_correlation",
+    "cosine_similarity",
+]
+
+
+def normalize_profiles(
+    features: np.ndarray, metrics: List[str] = SIMILARITY_METRICS
+) -> Dict[str, np.ndarray]:
+    """Normalize the profiles (rows) so the similarity of two profiles is the dot product of their rows.
+
+    Args:
+        features (np.ndarray): Matrix of profiles (rows) by features (columns).
+        metrics (List[str], optional): Similarity metrics to normalize the profiles for.
+            Defaults to SIMILARITY_METRICS.
+
+    Raises:
+        ValueError: If a metric is not in SIMILARITY_METRICS.
+
+    Returns:
+        Dict[str, np.ndarray]: Dictionary of metric to the normalized matrix (float64).
+    """
+    unknown_metrics = set(metrics) - set(SIMILARITY_METRICS)
+    if unknown_metrics:
+        raise ValueError(
+            f"Unknown similarity metrics {sorted(unknown_metrics)}. Choose from {SIMILARITY_METRICS}."
+        )
+
+    features = np.asarray(features, dtype=np.float64)
+    normalized = {}
+    if "pearsons_correlation" in metrics:
+        normalized["pearsons_correlation"] = standardize_rows(features)
+    if "spearmans_correlation" in metrics:
+        # the Spearman correlation is the Pearson correlation of the ranks of the features in each profile
+        normalized["spearmans_correlation"] = standardize_rows(
+            rankdata(features, axis=1)
+        )
+    if "cosine_similarity" in metrics:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            normalized["cosine_similarity"] = features / np.linalg.norm(
+                features, axis=1, keepdims=True
+            )
+
+    return {metric: normalized[metric] for metric in metrics}
+
+
+class PairwiseSimilarity(PairwisePearson):
+    """
+    Similarities between profiles in the same groups and different groups of other columns (see PairwisePearson),
+    with one column per metric computed from the same pairs.
+
+    Attributes:
+        metrics (List[str]): Similarity metrics, in the order of the output columns.
+    """
+
+    def __init__(
+        self,
+        profiles: pd.DataFrame,
+        feature_columns: List[str],
+        same_columns: List[str],
+        different_columns: List[str],
+        drop_columns: Optional[List[str]] = None,
+        metrics: List[str] = SIMILARITY_METRICS,
+    ):
+        """
+        Args:
+            profiles (pd.DataFrame): Profiles with the feature and group columns.
+            feature_columns (List[str]): Feature columns used for the similarities.
+            same_columns (List[str]): Columns whose values must be the same for both profiles of a pair.
+            different_columns (List[str]): Columns whose values must all be different for both profiles of a pair.
+            drop_columns (Optional[List[str]], optional): Group columns not saved in the output.
+                Defaults to None.
+            metrics (List[str], optional): Similarity metrics to compute. Defaults to SIMILARITY_METRICS.
+
+        Raises:
+            ValueError: If no metrics are given, or as raised by PairwisePearson.
+        """
+        if not metrics:
+            raise ValueError("At least one similarity metric is required.")
+
+        super().__init__(
+            profiles=profiles,
+            feature_columns=feature_columns,
+            same_columns=same_columns,
+            different_columns=different_columns,
+            drop_columns=drop_columns,
+            comparison_name=metrics[0],
+        )
+        self.metrics = list(metrics)
+
+    def similarities(
+        self, features: Optional[np.ndarray] = None
+    ) -> Dict[str, np.ndarray]:
+        """Compute every similarity metric of every pair.
+
+        Args:
+            features (Optional[np.ndarray], optional): Matrix of profiles by features with the same rows as the
+                profiles. Defaults to None, which uses the features of the profiles.
+
+        Returns:
+            Dict[str, np.ndarray]: Dictionary of metric to the similarity of each pair, in the order of
+                `pair_metadata`.
+        """
+        normalized = normalize_profiles(
+            self.features if features is None else features, self.metrics
+        )
+
+        similarities = {metric: [] for metric in self.metrics}
+        for rows, pairs in zip(self._group_rows, self._group_pairs):
+            for metric, matrix in normalized.items():
+                similarities[metric].append(
+                    (matrix[rows] @ matrix[rows].T)[pairs[0], pairs[1]]
+                )
+
+        return {
+            metric: np.concatenate(values) if values else np.array([])
+            for metric, values in similarities.items()
+        }
+
+    def correlations(self, features: Optional[np.ndarray] = None) -> np.ndarray:
+        """Compute the first similarity metric of every pair (see `similarities`)."""
+        return self.similarities(features)[self.metrics[0]]
+
+    def __call__(self, features: Optional[np.ndarray] = None) -> pd.DataFrame:
+        """Compute every similarity metric of every pair with the group columns of each profile.
+
+        Args:
+            features (Optional[np.ndarray], optional): Matrix of profiles by features with the same rows as the
+                profiles. Defaults to None, which uses the features of the profiles.
+
+        Returns:
+            pd.DataFrame: Dataframe with one column per metric and the same group columns as PairwisePearson.
+        """
+        comparisons_df = pd.DataFrame(self.similarities(features))
+
+        return pd.concat([comparisons_df, self.pair_metadata], axis="columns")
+
+
+def average_precision(similarity: np.ndarray, positives: np.ndarray) -> np.ndarray:
+    """Compute the average precision of each query (row) when ranking the other profiles by similarity.
+
+    Args:
+        similarity (np.ndarray): Square matrix of the similarity of each query to each profile.
+        positives (np.ndarray): Boolean matrix of the profiles to retrieve for each query (False on the diagonal).
+
+    Returns:
+        np.ndarray: Average precision of each query, missing for queries without positives.
+    """
+    similarity = np.where(np.isnan(similarity), -np.inf, similarity)
+    # the query itself is ranked last and then removed
+    np.fill_diagonal(similarity, np.nan)
+    order = np.argsort(-similarity, axis=1, kind="stable")[:, :-1]
+    hits = np.take_along_axis(positives, order, axis=1)
+
+    precision = np.cumsum(hits, axis=1) / np.arange(1, hits.shape[1] + 1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (precision * hits).sum(axis=1) / hits.sum(axis=1)
+
+
+def mean_average_precision(
+    profiles: pd.DataFrame,
+    feature_columns: List[str],
+    condition_columns: List[str] = [
+        "Metadata_cell_line",
+        "Metadata_seeding_density",
+        "Metadata_time_point",
+    ],
+    reference_columns: Optional[List[str]] = None,
+    well_column: str = "Metadata_Well",
+    metric: str = "pearsons_correlation",
+) -> pd.DataFrame:
+    """Compute the mean average precision of retrieving the replicate wells of each condition.
+
+    Each profile is a query that ranks all other profiles with the same reference columns (e.g., shuffled or not)
+    by similarity, and the positives are the profiles of the same condition in other wells.
+
+    Args:
+        profiles (pd.DataFrame): Profiles of one plate (e.g., feature-selected bulk profiles).
+        feature_columns (List[str]): Feature columns used for the similarities.
+        condition_columns (List[str], optional): Columns defining the replicate wells of a condition.
+            Defaults to ["Metadata_cell_line", "Metadata_seeding_density", "Metadata_time_point"].
+        reference_columns (Optional[List[str]], optional): Columns whose values must be the same for a profile to
+            be ranked by a query. Defaults to None, which ranks every profile.
+        well_column (str, optional): Column with the well of each profile. Defaults to "Metadata_Well".
+        metric (str, optional): Similarity metric used to rank the profiles. Defaults to "pearsons_correlation".
+
+    Returns:
+        pd.DataFrame: Dataframe with one row per condition (and reference group) with the mean average precision
+            and the number of queries with positives.
+    """
+    group_columns = list(reference_columns or []) + list(condition_columns)
+    normalized = normalize_profiles(profiles[feature_columns].to_numpy(), [metric])[
+        metric
+    ]
+
+    condition_codes = _group_codes(profiles, group_columns)
+    well_codes = _group_codes(profiles, [well_column])
+    reference_codes = (
+        _group_codes(profiles, reference_columns)
+        if reference_columns
+        else np.zeros(profiles.shape[0], dtype=np.int64)
+    )
+
+    average_precisions = np.full(profiles.shape[0], np.nan)
+    for reference_code in np.unique(reference_codes[reference_codes >= 0]):
+        rows = np.flatnonzero(reference_codes == reference_code)
+        if rows.size < 2:
+            continue
+        codes = condition_codes[rows]
+        positives = (
+            (codes[:, np.newaxis] == codes[np.newaxis, :])
+            & (codes[:, np.newaxis] >= 0)
+            & (well_codes[rows][:, np.newaxis] != well_codes[rows][np.newaxis, :])
+        )
+        average_precisions[rows] = average_precision(
+            normalized[rows] @ normalized[rows].T, positives
+        )
+
+    precision_df = profiles[group_columns].copy()
+    precision_df["average_precision"] = average_precisions
+
+    return (
+        precision_df.groupby(group_columns, observed=True)
+        .agg(
+            mean_average_precision=("average_precision", "mean"),
+            num_queries=("average_precision", "count"),
+        )
+        .reset_index()
+    )
@@ -0,0 +1,97 @@
+"""
+Tests for building the single-cell crop cache from full-field images and CellProfiler outline images.
+"""
+
+import pathlib
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import tifffile
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+from crop_cache_utils import CropCache, build_crop_cache
+
+
+@pytest.fixture
+def field_of_view(tmp_path):
+    rng = np.random.default_rng(0)
+    image_dir = tmp_path / "images"
+    outline_dir = tmp_path / "outlines"
+    image_dir.mkdir()
+    outline_dir.mkdir()
+
+    for channel in ["OrigDNA", "OrigAGP"]:
+        tifffile.imwrite(
+            image_dir / f"{channel}.tiff",
+            rng.integers(0, 60000, size=(32, 32), dtype=np.uint16),
+        )
+
+    # CellProfiler saves outlines in color, with a different color for each object
+    outline = np.zeros((32, 32, 3), dtype=np.uint8)
+    outline[8, 4:12, 0] = 255
+    outline[20:28, 16, 1] = 128
+    tifffile.imwrite(
+        outline_dir / "NucleiOutlines_BR00000001_A01_1.tiff",
+        outline,
+        photometric="rgb",
+    )
+
+    single_cell_df = pd.DataFrame(
+        {
+            "Image_Metadata_Plate": ["BR00000001"] * 2,
+            "Image_Metadata_Well": ["A01"] * 2,
+            "Image_Metadata_Site": [1, 1],
+            "Nuclei_AreaShape_BoundingBoxMinimum_X": [4, 12],
+            "Nuclei_AreaShape_BoundingBoxMaximum_X": [12, 20],
+            "Nuclei_AreaShape_BoundingBoxMinimum_Y": [4, 20],
+            "Nuclei_AreaShape_BoundingBoxMaximum_Y": [12, 28],
+        },
+        index=[10, 11],
+    )
+    for channel in ["OrigDNA", "OrigAGP"]:
+        single_cell_df[f"Image_PathName_{channel}"] = str(image_dir)
+        single_cell_df[f"Image_FileName_{channel}"] = f"{channel}.tiff"
+
+    return single_cell_df, image_dir, outline_dir, outline
+
+
+def test_color_outlines_are_reduced_to_one_channel(tmp_path, field_of_view):
+    single_cell_df, image_dir, outline_dir, outline = field_of_view
+
+    cache_dir = build_crop_cache(
+        single_cell_df,
+        compartment="Nuclei",
+        cache_dir=tmp_path / "cache",
+        outline_dir=outline_dir,
+        max_workers=2,
+    )
+    crop_cache = CropCache(cache_dir)
+
+    assert crop_cache.channels == ["OrigDNA", "OrigAGP", "NucleiOutlines"]
+    assert crop_cache.crops.dtype == np.uint16
+
+    # the first single-cell is centered at (8, 8) with a crop size of 8
+    dna_image = tifffile.imread(image_dir / "OrigDNA.tiff")
+    np.testing.assert_array_equal(
+        crop_cache.get_crop(10, channel="OrigDNA"), dna_image[4:12, 4:12]
+    )
+    np.testing.assert_array_equal(
+        crop_cache.get_crop(10, channel="NucleiOutlines"),
+        outline.max(axis=-1)[4:12, 4:12],
+    )
+    np.testing.assert_array_equal(
+        crop_cache.get_crop(11, channel="NucleiOutlines"),
+        outline.max(axis=-1)[20:28, 12:20],
+    )
+
+
+def test_image_stacks_raise(tmp_path, field_of_view):
+    single_cell_df, image_dir, _, _ = field_of_view
+    tifffile.imwrite(image_dir / "OrigDNA.tiff", np.zeros((2, 32, 32), dtype=np.uint16))
+
+    with pytest.raises(ValueError, match="Expected a 2D image"):
+        build_crop_cache(
+            single_cell_df, compartment="Nuclei", cache_dir=tmp_path / "cache"
+        )
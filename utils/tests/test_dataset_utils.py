@@ -0,0 +1,56 @@
+"""
+Tests for writing plates to the dataset partitioned by round, plate, and well.
+"""
+
+import pathlib
+import sys
+
+import pandas as pd
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+from dataset_utils import read_partitioned_profiles, write_partitioned_profiles
+
+
+def _write_plate(tmp_path, plate, wells):
+    profile_path = tmp_path / f"{plate}_sc_feature_selected.parquet"
+    pd.DataFrame(
+        {
+            "Metadata_Plate": [plate] * len(wells),
+            "Metadata_Well": wells,
+            "Cells_AreaShape_Area": range(len(wells)),
+        }
+    ).to_parquet(profile_path, index=False)
+
+    return profile_path
+
+
+def test_rewriting_a_plate_removes_its_old_wells(tmp_path):
+    dataset_dir = tmp_path / "dataset"
+    for plate in ["BR00000001", "BR00000002"]:
+        write_partitioned_profiles(
+            _write_plate(tmp_path, plate, ["A01", "A02", "B01"]),
+            dataset_dir,
+            "Round_4_data",
+        )
+
+    # rewrite the first plate without B01
+    write_partitioned_profiles(
+        _write_plate(tmp_path, "BR00000001", ["A01", "A02"]),
+        dataset_dir,
+        "Round_4_data",
+    )
+
+    plate_dir = dataset_dir / "Metadata_round=Round_4_data/Metadata_Plate=BR00000001"
+    assert sorted(path.name for path in plate_dir.iterdir()) == [
+        "Metadata_Well=A01",
+        "Metadata_Well=A02",
+    ]
+
+    profiles_df = read_partitioned_profiles(dataset_dir)
+    wells_by_plate = profiles_df.groupby("Metadata_Plate", observed=True)[
+        "Metadata_Well"
+    ].apply(lambda wells: sorted(wells.astype(str)))
+    assert wells_by_plate.to_dict() == {
+        "BR00000001": ["A01", "A02"],
+        "BR00000002": ["A01", "A02", "B01"],
+    }
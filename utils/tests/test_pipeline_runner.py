@@ -0,0 +1,178 @@
+"""
+Tests for running the pipeline as a graph of tasks, using small shell commands as stand-ins for the notebooks.
+"""
+
+import pathlib
+import sys
+
+import pytest
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+from pipeline_runner import PipelineRunner, PipelineTask, build_round_tasks
+
+
+def _shell_task(name, script, tmp_path, inputs, outputs, depends_on=None):
+    return PipelineTask(
+        name=name,
+        command=["bash", "-c", script],
+        cwd=tmp_path,
+        inputs=[tmp_path / path for path in inputs],
+        outputs=[tmp_path / path for path in outputs],
+        depends_on=depends_on,
+    )
+
+
+def _statuses(summary_df):
+    return dict(zip(summary_df["task"], summary_df["status"]))
+
+
+@pytest.fixture
+def stub_tasks(tmp_path):
+    (tmp_path / "raw.txt").write_text("raw\n")
+
+    return [
+        _shell_task(
+            "extract",
+            "cat raw.txt > out/extract.txt",
+            tmp_path,
+            ["raw.txt"],
+            ["out/extract.txt"],
+        ),
+        _shell_task(
+            "process/plate_a",
+            "cat out/extract.txt > out/plate_a.txt && echo a >> out/plate_a.txt",
+            tmp_path,
+            ["out/extract.txt"],
+            ["out/plate_a.txt"],
+            depends_on=["extract"],
+        ),
+        _shell_task(
+            "process/plate_b",
+            "cat out/extract.txt > out/plate_b.txt && echo b >> out/plate_b.txt",
+            tmp_path,
+            ["out/extract.txt"],
+            ["out/plate_b.txt"],
+            depends_on=["extract"],
+        ),
+        _shell_task(
+            "combine",
+            "cat out/plate_a.txt out/plate_b.txt > out/combined.txt",
+            tmp_path,
+            ["out/plate_a.txt", "out/plate_b.txt"],
+            ["out/combined.txt"],
+            depends_on=["process/plate_a", "process/plate_b"],
+        ),
+    ]
+
+
+def test_run_skips_tasks_that_are_not_stale(tmp_path, stub_tasks):
+    state_path = tmp_path / "state" / "state.json"
+
+    summary_df = PipelineRunner(stub_tasks, state_path=state_path).run(max_workers=2)
+    assert set(summary_df["status"]) == {"completed"}
+    assert (tmp_path / "out/combined.txt").read_text() == "raw\na\nraw\nb\n"
+
+    # nothing changed, so every task is skipped
+    runner = PipelineRunner(stub_tasks, state_path=state_path)
+    assert runner.stale_tasks() == []
+    assert set(runner.run(max_workers=2)["status"]) == {"skipped"}
+
+    # a modified output reruns its task, and the tasks that depend on it are skipped if the rerun writes the
+    # same output again
+    (tmp_path / "out/plate_b.txt").write_text("tampered\n")
+    runner = PipelineRunner(stub_tasks, state_path=state_path)
+    assert runner.stale_tasks() == ["process/plate_b", "combine"]
+    assert _statuses(runner.run(max_workers=2)) == {
+        "extract": "skipped",
+        "process/plate_a": "skipped",
+        "process/plate_b": "completed",
+        "combine": "skipped",
+    }
+
+    # a modified input reruns every task downstream of it
+    (tmp_path / "raw.txt").write_text("new raw\n")
+    runner = PipelineRunner(stub_tasks, state_path=state_path)
+    assert runner.stale_tasks() == [task.name for task in stub_tasks]
+    runner.run(max_workers=2)
+    assert (tmp_path / "out/combined.txt").read_text() == "new raw\na\nnew raw\nb\n"
+
+
+def test_failed_task_blocks_dependent_tasks(tmp_path, stub_tasks):
+    stub_tasks[2] = _shell_task(
+        "process/plate_b",
+        "exit 1",
+        tmp_path,
+        ["out/extract.txt"],
+        ["out/plate_b.txt"],
+        depends_on=["extract"],
+    )
+    state_path = tmp_path / "state.json"
+
+    summary_df = PipelineRunner(stub_tasks, state_path=state_path).run(max_workers=2)
+    assert _statuses(summary_df) == {
+        "extract": "completed",
+        "process/plate_a": "completed",
+        "process/plate_b": "failed",
+        "combine": "blocked",
+    }
+    assert (tmp_path / "logs/process__plate_b.log").exists()
+
+    # the failed task and the task it blocked run again
+    assert PipelineRunner(stub_tasks, state_path=state_path).stale_tasks() == [
+        "process/plate_b",
+        "combine",
+    ]
+
+
+def test_missing_output_fails_task(tmp_path):
+    task = _shell_task("no_output", "true", tmp_path, [], ["out/never_written.txt"])
+
+    summary_df = PipelineRunner([task], state_path=tmp_path / "state.json").run()
+    assert summary_df.loc[0, "status"] == "failed"
+    assert "missing outputs" in summary_df.loc[0, "error"]
+
+
+def test_invalid_graphs_raise(tmp_path):
+    cycle = [
+        _shell_task("a", "true", tmp_path, [], [], depends_on=["b"]),
+        _shell_task("b", "true", tmp_path, [], [], depends_on=["a"]),
+    ]
+    with pytest.raises(ValueError, match="cycle"):
+        PipelineRunner(cycle, state_path=tmp_path / "state.json")
+
+    missing = [_shell_task("a", "true", tmp_path, [], [], depends_on=["b"])]
+    with pytest.raises(ValueError, match="do not exist"):
+        PipelineRunner(missing, state_path=tmp_path / "state.json")
+
+
+def test_round_tasks_connect_outputs_to_inputs(tmp_path):
+    tasks = build_round_tasks(tmp_path, "Round_4_data", ["BR00000001", "BR00000002"])
+    tasks_by_name = {task.name: task for task in tasks}
+
+    # building the tasks (e.g., for a dry run) does not create any directories
+    runner = PipelineRunner(tasks, state_path=tmp_path / "pipeline_state/state.json")
+    assert len(runner.stale_tasks()) == len(tasks)
+    assert list(tmp_path.iterdir()) == []
+
+    # every task reads an output of each task it depends on (the same path, or a file in or directory of it)
+    outputs_by_task = {task.name: task.outputs for task in tasks}
+    for task in tasks:
+        for dependency in task.depends_on:
+            assert any(
+                path == output or output in path.parents or path in output.parents
+                for path in task.inputs
+                for output in outputs_by_task[dependency]
+            ), (task.name, dependency)
+
+    analysis_task = tasks_by_name["analysis/Round_4_data/BR00000001"]
+    assert (
+        analysis_task.inputs[-1]
+        in tasks_by_name["analysis_loaddata/Round_4_data"].outputs
+    )
+    assert analysis_task.outputs == [
+        tmp_path / "2.feature_extraction/sqlite_outputs/Round_4_data/BR00000001"
+    ]
+
+    # the round is passed to every script and notebook
+    for task in tasks:
+        assert "Round_4_data" in task.command, task.name
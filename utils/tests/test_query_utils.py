@@ -0,0 +1,119 @@
+"""
+Tests for registering the Parquet outputs of every round as DuckDB views and querying the QC report.
+"""
+
+import pathlib
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("duckdb")
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+from plate_registry import index_plate_files
+from qc_results_utils import write_qc_results
+from query_utils import connect, query_qc_report, register_profile_views
+
+
+@pytest.fixture
+def preprocessing_dir(tmp_path):
+    index_plate_files.cache_clear()
+    preprocessing_dir = tmp_path / "3.preprocessing_features"
+    platemap_dir = tmp_path / "metadata"
+    platemap_dir.mkdir()
+
+    pd.DataFrame(
+        {
+            "barcode": ["BR00000001", "BR00000002"],
+            "platemap_file": ["platemap", "platemap"],
+            "time_point": [24, 48],
+        }
+    ).to_csv(platemap_dir / "Barcode_platemap_pilot_data.csv", index=False)
+    pd.DataFrame(
+        {
+            "well": ["A01", "A02"],
+            "cell_line": ["U2-OS", "A673"],
+            "seeding_density": [1000, 1000],
+            "condition": ["control", "treatment"],
+        }
+    ).to_csv(platemap_dir / "platemap.csv", index=False)
+
+    # each plate has 3 single-cells in A01 and 2 in A02
+    for round_id, plate in [
+        ("Round_1_data", "BR00000001"),
+        ("Round_2_data", "BR00000002"),
+    ]:
+        converted_path = (
+            preprocessing_dir
+            / f"data/converted_profiles/{round_id}/{plate}_converted.parquet"
+        )
+        converted_path.parent.mkdir(parents=True)
+        pd.DataFrame(
+            {
+                "Image_Metadata_Plate": [plate] * 5,
+                "Image_Metadata_Well": ["A01", "A01", "A01", "A02", "A02"],
+                "Nuclei_AreaShape_Area": np.arange(5, dtype=float),
+            }
+        ).to_parquet(converted_path, index=False)
+
+    # the first plate only has the legacy failed QC indices, at the top level of qc_results and with a cell
+    # failing two conditions
+    (preprocessing_dir / "qc_results").mkdir()
+    pd.DataFrame(
+        {
+            "original_indices": [0, 0, 4],
+            "Image_Metadata_Plate": ["BR00000001"] * 3,
+            "Image_Metadata_Well": ["A01", "A01", "A02"],
+            "Failed_ClusteredNuclei": [True, False, True],
+            "Failed_LargeNuclei": [False, True, False],
+        }
+    ).to_csv(
+        preprocessing_dir / "qc_results/BR00000001_failed_qc_indices.csv.gz",
+        index=False,
+    )
+
+    # the second plate has QC results
+    plate_df = pd.read_parquet(
+        preprocessing_dir
+        / "data/converted_profiles/Round_2_data/BR00000002_converted.parquet"
+    )
+    write_qc_results(
+        plate_df,
+        {"Failed_ClusteredNuclei": np.array([False, True, False, False, False])},
+        {"Failed_ClusteredNuclei": {}},
+        preprocessing_dir / "qc_results/Round_2_data/BR00000002_qc_results.parquet",
+    )
+
+    return preprocessing_dir, platemap_dir
+
+
+def test_legacy_failed_qc_indices_are_in_qc_report(preprocessing_dir):
+    preprocessing_dir, platemap_dir = preprocessing_dir
+    connection = connect(threads=1)
+
+    num_files = register_profile_views(connection, preprocessing_dir, platemap_dir)
+    assert num_files["qc_results"] == 2
+
+    qc_report_df = query_qc_report(connection).set_index(
+        ["Metadata_Plate", "Metadata_cell_line"]
+    )
+    assert qc_report_df["total_nuclei_segmented"].to_dict() == {
+        ("BR00000001", "A673"): 2,
+        ("BR00000001", "U2-OS"): 3,
+        ("BR00000002", "A673"): 2,
+        ("BR00000002", "U2-OS"): 3,
+    }
+    assert qc_report_df["total_failed_qc"].to_dict() == {
+        ("BR00000001", "A673"): 1,
+        ("BR00000001", "U2-OS"): 1,
+        ("BR00000002", "A673"): 0,
+        ("BR00000002", "U2-OS"): 1,
+    }
+    assert set(qc_report_df["Metadata_round"]) == {"Round_1_data", "Round_2_data"}
+
+
+def test_missing_converted_profiles_raise(tmp_path):
+    with pytest.raises(FileNotFoundError, match="converted_profiles"):
+        register_profile_views(connect(threads=1), tmp_path, tmp_path)